@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The report queries of query.py, computed in memory with NumPy and pandas.
+
+Analytics reads the tag tables of a database once into one columnar frame
+(source, id, key, value) whose key and value columns are categoricals, and
+the users of the nodes and ways into an array of category codes. Every
+report is then a few vectorized passes over integer codes:
+
+- counts by value are np.bincount over the value codes of the matching rows,
+  sorted by count and then value, as the categories are sorted
+- the borough of a postcode is looked up in an array indexed by value code,
+  filled once for the distinct postcode values with the rules of
+  query.QUERY0 (a text BETWEEN, LIKE prefixes)
+- the capacity values are converted to numbers once at load, per category,
+  instead of running pd.to_numeric over the rows of every query result
+
+Each report takes milliseconds once the frame is loaded. The results are
+DataFrames with the columns and row order of the SQL queries, which running
+this file with --check verifies (query.QUERIES with the summary tables of
+summary.py, query.TABLE_QUERIES or TEXT_TABLE_QUERIES without them).
+"""
+
+import argparse
+import sqlite3
+import time
+import timeit
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import query
+from summary import best_time, has_summaries, has_users
+
+# borough names in the order of the CASE of query.QUERY0, the last entry is for no borough (NULL)
+BOROUGHS = ('manhattan', 'brooklyn', 'bronx', 'nj', 'queens', None)
+NO_BOROUGH = len(BOROUGHS) - 1
+
+# the text range of query.QUERY0 (value is TEXT, so BETWEEN 10000 AND 10299 compares strings)
+MANHATTAN_RANGE = (u'10000', u'10299')
+
+TAG_TABLES = (('node', 'nodes_tags'), ('way', 'ways_tags'))
+
+
+def borough_codes(values):
+    """Return the index in BOROUGHS of each postcode in values (unicode strings), as query.QUERY0 groups them"""
+    s = pd.Series(values, dtype=object)
+    starts = s.str.startswith
+    conditions = [
+        (s >= MANHATTAN_RANGE[0]) & (s <= MANHATTAN_RANGE[1]),
+        starts(u'112'),
+        starts(u'104') | (s == u'11370'),
+        starts(u'07'),
+        starts(u'111') | (starts(u'113') & (s != u'11370')) | starts(u'114') | starts(u'116')
+        | ((s >= u'11004') & (s <= u'11005')),
+    ]
+    return np.select([c.values.astype(bool) for c in conditions], range(len(conditions)), NO_BOROUGH)
+
+
+def top_counts(counts, labels, columns, limit=None):
+    """DataFrame of the labels with a non-zero count, by count descending then label, as ORDER BY n DESC, label
+
+    labels must be in ascending order with None first, so a stable sort on the
+    counts leaves the ties in label order.
+    """
+    order = np.argsort(-counts, kind='mergesort')
+    order = order[counts[order] > 0][:limit]
+    return pd.DataFrame({columns[0]: [labels[i] for i in order], columns[1]: counts[order]},
+                        columns=columns)
+
+
+def scalar(name, value):
+    return pd.DataFrame({name: [int(value)]}, columns=[name])
+
+
+class Analytics(object):
+    """The tags and users of a database as columnar frames, with a method per report query"""
+
+    def __init__(self, con):
+        self.tags = self.load_tags(con)
+        self.source = self.tags['source'].cat.codes.values
+        self.ids = self.tags['id'].values
+        self.key_codes = self.tags['key'].cat.codes.values
+        self.value_codes = self.tags['value'].cat.codes.values
+        self.keys = self.tags['key'].cat.categories
+        self.values = self.tags['value'].cat.categories
+        # value codes are shifted by one in the counts, so that NULL (code -1) comes first
+        self.value_labels = [None] + list(self.values)
+        # numeric value of every category, NaN for the values that are not numbers
+        self.numbers = pd.to_numeric(pd.Series(self.values, dtype=object), errors='coerce').values
+        self.boroughs = None
+        self.load_users(con)
+
+    @staticmethod
+    def load_tags(con):
+        frames = []
+        for source, table in TAG_TABLES:
+            df = pd.read_sql_query('SELECT id, key, value FROM {}'.format(table), con)
+            df['source'] = source
+            frames.append(df)
+        tags = pd.concat(frames, ignore_index=True)
+        # categories shared by both tables and sorted, so code order is value order
+        for column in ('key', 'value'):
+            tags[column] = union_categoricals([frame[column].astype('category') for frame in frames],
+                                              sort_categories=True)
+        tags['source'] = pd.Categorical(tags['source'], categories=[source for source, _ in TAG_TABLES])
+        return tags[['source', 'id', 'key', 'value']]
+
+    def load_users(self, con):
+        """The user of every node and way, as codes into self.user_names (-1 for no user)"""
+        self.node_count = con.execute('SELECT count(*) FROM nodes').fetchone()[0]
+        self.way_count = con.execute('SELECT count(*) FROM ways').fetchone()[0]
+        if has_users(con):
+            uids = pd.read_sql_query('SELECT uid FROM nodes UNION ALL SELECT uid FROM ways', con)['uid']
+            users = pd.read_sql_query('SELECT uid, user FROM users', con).set_index('uid')['user']
+            uids = uids.dropna().astype(np.int64).values
+            self.uids, uid_codes = np.unique(uids, return_inverse=True)
+            # like the JOIN of query.QUERY_topUsers, uids not in users have no user
+            names = pd.Categorical(users.reindex(self.uids).values)
+            self.user_codes = names.codes[uid_codes]
+        else:
+            # databases imported from the csv files of data.py have the user names on every row
+            rows = pd.read_sql_query('SELECT user, uid FROM nodes UNION ALL SELECT user, uid FROM ways', con)
+            self.uids = np.unique(rows['uid'].dropna().astype(np.int64).values)
+            names = pd.Categorical(rows['user'].values)
+            self.user_codes = names.codes
+        self.user_names = list(names.categories)
+
+    def key_mask(self, key, source=None):
+        """Boolean mask of the tag rows with key (from source, 'node' or 'way', or both)"""
+        if key not in self.keys:
+            return np.zeros(len(self.ids), dtype=bool)
+        mask = self.key_codes == self.keys.get_loc(key)
+        if source is not None:
+            mask &= self.source == [s for s, _ in TAG_TABLES].index(source)
+        return mask
+
+    def value_counts(self, mask):
+        """Number of rows in mask per value code, shifted by one so index 0 counts NULL"""
+        return np.bincount(self.value_codes[mask] + 1, minlength=len(self.values) + 1)
+
+    def borough_lookup(self):
+        """Array of the index in BOROUGHS of every value code, plus NULL at the end (see value_counts)"""
+        if self.boroughs is None:
+            codes = np.unique(self.value_codes[self.key_mask('postcode')])
+            codes = codes[codes >= 0]
+            lookup = np.full(len(self.values) + 1, NO_BOROUGH, dtype=np.int8)
+            lookup[codes] = borough_codes(self.values[codes])
+            self.boroughs = lookup
+        return self.boroughs
+
+    # the report queries, by their names in query.QUERIES
+
+    def postcode_tags(self):
+        return scalar('total_postalTags', (self.value_codes[self.key_mask('postcode')] >= 0).sum())
+
+    def postcodes_by_borough(self):
+        codes = self.value_codes[self.key_mask('postcode')]
+        boroughs = self.borough_lookup()[codes]  # NULL values (-1) take the last entry, NO_BOROUGH
+        rows = np.bincount(boroughs, minlength=len(BOROUGHS))
+        # COUNT(value) does not count NULL values, but their rows still make a group
+        counts = np.bincount(boroughs[codes >= 0], minlength=len(BOROUGHS))
+        # ORDER BY numTags DESC, borough, where NULL sorts first
+        order = sorted((i for i in range(len(BOROUGHS)) if rows[i]),
+                       key=lambda i: (-counts[i], BOROUGHS[i] is not None, BOROUGHS[i]))
+        return pd.DataFrame({'borough': [BOROUGHS[i] for i in order], 'numTags': counts[order]},
+                            columns=['borough', 'numTags'])
+
+    def num_nodes(self):
+        return scalar('numNodes', self.node_count)
+
+    def num_ways(self):
+        return scalar('numWays', self.way_count)
+
+    def num_users(self):
+        return scalar('numUsers', len(self.uids))
+
+    def user_counts(self):
+        return np.bincount(self.user_codes[self.user_codes >= 0], minlength=len(self.user_names))
+
+    def top_users(self):
+        return top_counts(self.user_counts(), self.user_names, ['user', 'num'], 10)
+
+    def num_onetime_users(self):
+        return scalar('numOnetimeUsers', (self.user_counts() == 1).sum())
+
+    def top_zips(self):
+        return top_counts(self.value_counts(self.key_mask('postcode', 'node')), self.value_labels,
+                          ['value', 'numTags'], 5)
+
+    def top_manhattan_zips(self):
+        counts = self.value_counts(self.key_mask('postcode', 'node'))
+        low, high = self.values.searchsorted(MANHATTAN_RANGE[0]), self.values.searchsorted(MANHATTAN_RANGE[1], 'right')
+        # the categories are sorted, so the text range is a range of codes (shifted by one for NULL)
+        counts[:low + 1] = 0
+        counts[high + 1:] = 0
+        return top_counts(counts, self.value_labels, ['value', 'numTags'], 5)
+
+    def top_amenities(self):
+        return top_counts(self.value_counts(self.key_mask('amenity', 'node')), self.value_labels,
+                          ['value', 'num'], 10)
+
+    def bikerack_mask(self):
+        """Mask of the capacity tags of nodes that have any tag with the value bicycle_parking"""
+        node = self.source == 0
+        if 'bicycle_parking' not in self.values:
+            return np.zeros(len(self.ids), dtype=bool)
+        racks = np.unique(self.ids[node & (self.value_codes == self.values.get_loc('bicycle_parking'))])
+        mask = self.key_mask('capacity', 'node')
+        mask[mask] = np.in1d(self.ids[mask], racks)
+        return mask
+
+    def bikerack_capacities(self):
+        codes = self.value_codes[self.bikerack_mask()]
+        return pd.DataFrame({'value': [self.value_labels[code + 1] for code in codes]}, columns=['value'])
+
+    def top_bikerack_capacities(self):
+        return top_counts(self.value_counts(self.bikerack_mask()), self.value_labels, ['capacity', 'num'], 10)
+
+    def capacity_stats(self):
+        """Statistics of the bike rack capacities, as numbers (values that are not numbers are counted apart)"""
+        codes = self.value_codes[self.bikerack_mask()]
+        numbers = np.where(codes >= 0, self.numbers[codes], np.nan)
+        valid = numbers[~np.isnan(numbers)]
+        return {
+            'racks': len(codes),
+            'not_numeric': len(codes) - len(valid),
+            'zero': int((valid == 0).sum()),
+            'total': valid.sum(),
+            'mean': valid.mean() if len(valid) else None,
+            'median': np.median(valid) if len(valid) else None,
+            'max': valid.max() if len(valid) else None,
+        }
+
+    def report(self, names=None):
+        """Return {name: DataFrame} of the report queries, all of them by default"""
+        return dict((name, getattr(self, name)()) for name in (names or sorted(query.QUERIES)))
+
+
+def load(filename):
+    """Return the Analytics of the database filename, read through the pooled connection of query.py"""
+    return Analytics(query.connection(filename))
+
+
+def same_rows(name, df, rows):
+    """Whether a report DataFrame holds the rows of its SQL query"""
+    result = [tuple(row) for row in df.itertuples(index=False)]
+    if name == 'bikerack_capacities':
+        # no ORDER BY
+        return sorted(result) == sorted(rows)
+    return result == rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the report queries in memory with NumPy and pandas')
+    parser.add_argument('db', nargs='?', default=query.DB_PATH)
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='reports to compute, all by default: ' + ', '.join(sorted(query.QUERIES)))
+    parser.add_argument('--check', action='store_true',
+                        help='time every report against its SQL query and check that the results are the same')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in query.QUERIES]
+    if unknown:
+        parser.error('unknown reports: {}'.format(', '.join(unknown)))
+
+    start = time.time()
+    analytics = load(args.db)
+    print 'loaded {} tags in {:.2f} s'.format(len(analytics.tags), time.time() - start)
+
+    if not args.check:
+        for name, df in sorted(analytics.report(args.names).items()):
+            print '# {}'.format(name)
+            print df
+            print
+        print 'bike rack capacities: {}'.format(analytics.capacity_stats())
+    else:
+        con = sqlite3.connect(args.db)
+        try:
+            tables = set(row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+            table_queries = query.TABLE_QUERIES if has_users(con) else query.TEXT_TABLE_QUERIES
+            catalogs = [table_queries] + ([query.QUERIES] if has_summaries(tables) else [])
+            print '{:<26}{:>11}{:>12}{:>10}{:>8}'.format('report', 'tables ms', 'catalog ms', 'frame ms', 'same')
+            failed = False
+            for name in args.names or sorted(query.QUERIES):
+                df = getattr(analytics, name)()
+                same = all(same_rows(name, df, con.execute(catalog[name]).fetchall()) for catalog in catalogs)
+                sql_ms = [1000 * best_time(con, catalog[name]) for catalog in catalogs]
+                frame_ms = 1000 * min(timeit.repeat(getattr(analytics, name), number=1, repeat=3))
+                failed |= not same
+                print '{:<26}{:>11}{:>12}{:>10.2f}{:>8}'.format(
+                    name, *['{:.2f}'.format(ms) for ms in sql_ms] + ['-'] * (2 - len(sql_ms)) +
+                    [frame_ms, 'yes' if same else 'NO'])
+        finally:
+            con.close()
+        if failed:
+            raise SystemExit('some reports differ from the SQL queries')
@@ -9,14 +9,21 @@ Your task in this exercise has two steps:
     The function takes a string with street name as an argument and should return the fixed name
     We have provided a simple test so that you see what exactly is expected
 """
-import xml.etree.cElementTree as ET
-from collections import defaultdict
+from collections import defaultdict, Counter
+import argparse
 import re
 import pprint
 import pdb
+import sys
+
+from lru import LRUCache
+from progress import Progress, INTERVAL
+from stream import iter_elements
 
 OSMFILE = "manhattan_new-york.osm"
 type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
+# same as data.PROBLEMCHARS
+problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\.\t\r\n]')
 
 
 st_expected = ["Street", "Avenue", "Boulevard", "Drive",
@@ -43,6 +50,8 @@ st_mapping = { "St": "Street", 'street': 'Street',
             'Macdougal': 'MacDougal Street',
             '41st': '41st Street', '42nd': '42nd Street'}
 
+zip_special_cases = {'100014': '10014', '320': '07024', '97657': '07657'}
+
 def is_attrib(elem, key):
     return (elem.attrib['k'] == key)
 
@@ -55,7 +64,7 @@ def is_attrib(elem, key):
 def audit_type(types, name, expected, mapping):
     # first update street name before auditing to check for more
     # anamolous street names (more generalized form to handle other attributes like city, etc.)
-    name = update_name(name, mapping)
+    name = get_normalizer(mapping).street(name)
     m = type_re.search(name)
     if m:
         type_ = m.group()
@@ -63,28 +72,143 @@ def audit_type(types, name, expected, mapping):
             types[type_].add(name)
 
 
-def audit(osmfile, keyword):
-    osm_file = open(osmfile, "rb")
-    street_types = defaultdict(set)
-    zip_types = set()
-    city_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+class Auditor(object):
+    """Collects one audit from the tags of the elements seen by run_audits
+
+    keys lists the tag keys the auditor wants to see, None means every tag.
+    By default the values of those tags are counted.
+    """
+    name = None
+    keys = None
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def audit_tag(self, key, value):
+        self.counts[value] += 1
+
+    def report(self):
+        return self.counts
+
+
+class StreetTypeAuditor(Auditor):
+    """Unexpected street types left after update_name, with the names that have them"""
+    name = 'street'
+    keys = ['addr:street']
+
+    def __init__(self, expected=st_expected, mapping=st_mapping):
+        self.expected = expected
+        self.mapping = mapping
+        self.types = defaultdict(set)
+
+    def audit_tag(self, key, value):
+        audit_type(self.types, value, self.expected, self.mapping)
+
+    def report(self):
+        return self.types
+
+
+class PostcodeAuditor(Auditor):
+    """Distinct postcodes after update_zip"""
+    name = 'zip'
+    keys = ['addr:postcode']
+
+    def __init__(self):
+        self.zips = set()
+
+    def audit_tag(self, key, value):
+        self.zips.add(normalizer.zip(value))
+
+    def report(self):
+        return self.zips
+
+
+class CityAuditor(Auditor):
+    """Number of tags per city name"""
+    name = 'city'
+    keys = ['addr:city']
+
+
+class ProblemKeyAuditor(Auditor):
+    """Tag keys containing problem characters, with counts"""
+    name = 'problem_keys'
+
+    def __init__(self):
+        self.keys_seen = {}
+        self.problems = Counter()
+
+    def audit_tag(self, key, value):
+        # keys repeat heavily, so every distinct key is matched once
+        problem = self.keys_seen.get(key)
+        if problem is None:
+            problem = self.keys_seen[key] = bool(problemchars.search(key))
+        if problem:
+            self.problems[key] += 1
+
+    def report(self):
+        return self.problems
+
+
+class KeyFrequencyAuditor(Auditor):
+    """The most used tag keys"""
+    name = 'keys'
+
+    def __init__(self, top=50):
+        self.top = top
+        self.counts = Counter()
 
-        if elem.tag == "node" or elem.tag == "way":
+    def audit_tag(self, key, value):
+        self.counts[key] += 1
+
+    def report(self):
+        return self.counts.most_common(self.top)
+
+
+AUDITORS = dict((auditor.name, auditor) for auditor in
+                [StreetTypeAuditor, PostcodeAuditor, CityAuditor, ProblemKeyAuditor, KeyFrequencyAuditor])
+
+
+def run_audits(osmfile, auditors=None, tags=('node', 'way'), progress=None):
+    """Run several audits in one pass over osmfile, return {auditor name: report}
+
+    auditors is a list of auditor names from AUDITORS or Auditor instances, all of them by default.
+    progress, a progress.Progress, reports on the elements audited as they go by.
+    """
+    auditors = [AUDITORS[a]() if isinstance(a, basestring) else a
+                for a in (sorted(AUDITORS) if auditors is None else auditors)]
+    by_key = defaultdict(list)
+    every_key = []
+    for auditor in auditors:
+        if auditor.keys is None:
+            every_key.append(auditor.audit_tag)
+        else:
+            for key in auditor.keys:
+                by_key[key].append(auditor.audit_tag)
+
+    source = osmfile
+    if progress is not None:
+        source = progress.open_input(osmfile)
+    elements = iter_elements(source, tags)
+    if progress is not None:
+        elements = progress.track(elements)
+    try:
+        # elements are cleared as soon as their tags have been audited
+        for elem in elements:
             for tag in elem.iter("tag"):
-                # if is_street_name(tag):
-                if is_attrib(tag, 'addr:street'):
-                    audit_type(street_types, tag.attrib['v'], st_expected, st_mapping)
-                # if is_zip(tag):
-                if is_attrib(tag, 'addr:postcode'):
-                    zipname = tag.attrib['v']
-                    zipname = update_zip(tag.attrib['v'])
-                    zip_types.add(zipname)
-    osm_file.close()
-    if keyword == 'street':
-        return street_types
-    if keyword == 'zip':
-        return zip_types
+                key, value = tag.attrib['k'], tag.attrib['v']
+                for audit_tag in every_key:
+                    audit_tag(key, value)
+                for audit_tag in by_key.get(key, ()):
+                    audit_tag(key, value)
+    finally:
+        if source is not osmfile:
+            source.close()
+    return dict((auditor.name, auditor.report()) for auditor in auditors)
+
+
+def audit(osmfile, keyword):
+    # a single audit, use run_audits to get several from one pass over the file
+    return run_audits(osmfile, [keyword])[keyword]
 
 
 def update_name(name, mapping):
@@ -116,20 +240,93 @@ def update_zip(zip_name):
             betterzip = zip_name.split('-')[0]
         elif 'NY' in zip_name:
             betterzip = zip_name.split()[-1]
+        else:
+            betterzip = zip_name
         return betterzip
     else: # special cases
-        if zip_name == '100014':
-            zip_name = '10014'
-        elif zip_name == '320':
-            zip_name = '07024'
-        elif zip_name == '97657':
-            zip_name = '07657'
-        return zip_name
+        return zip_special_cases.get(zip_name, zip_name)
+
+
+# special cases of update_name, keyed on the last word of the street name
+def _strip_nyc(name, normalize):
+    return name[:name.find('NYC')-1]
+
+def _before_comma(name, normalize):
+    return normalize(name.split(',')[0])
+
+def _before_new_york(name, normalize):
+    return normalize(name[:name.find('New York')-1])
+
+def _americas(name, normalize):
+    return '6th Avenue'
+
+st_special_cases = {'10024': _strip_nyc,
+            'USA': _before_comma, 'Unidos': _before_comma, 'Uniti': _before_comma,
+            'NY': _before_new_york,
+            'Americas': _americas}
+
+
+class Normalizer(object):
+    """Table driven update_name/update_zip that memoizes each distinct raw value
+
+    The same few thousand street names and postcodes occur over and over in an
+    extract, so each one is normalized once and then served from a bounded cache.
+    """
+
+    def __init__(self, mapping=st_mapping, maxsize=50000):
+        # last word -> special case rule, mapped suffixes take precedence like in update_name
+        self.rules = dict(st_special_cases)
+        for word, better in mapping.items():
+            self.rules[word] = better
+        self.streets = LRUCache(maxsize)
+        self.zips = LRUCache(maxsize)
+        self.street = self.streets.memoize(self._update_name)
+        self.zip = self.zips.memoize(self._update_zip)
+
+    def _update_name(self, name):
+        word_list = name.split()
+        rule = self.rules.get(word_list[-1])
+        if callable(rule):
+            return rule(name, self.street)
+        if rule is not None:
+            word_list[-1] = rule
+        return ' '.join(word_list)
+
+    def _update_zip(self, zip_name):
+        if zip_name.isdigit():
+            return zip_special_cases.get(zip_name, zip_name)
+        return update_zip(zip_name)
+
+    def stats(self):
+        return {'street': self.streets.stats(), 'zip': self.zips.stats()}
+
+
+normalizer = Normalizer(st_mapping)
+
+def get_normalizer(mapping):
+    # the shared normalizer caches results for st_mapping only
+    if mapping is st_mapping:
+        return normalizer
+    return Normalizer(mapping)
 
 
 if __name__ == '__main__':
-    st_types = audit(OSMFILE, 'street')
-    pprint.pprint(dict(st_types))
+    parser = argparse.ArgumentParser(description='Audit the tags of an OSM XML file in one pass')
+    parser.add_argument('osm_file', nargs='?', default=OSMFILE)
+    parser.add_argument('--audits', nargs='+', choices=sorted(AUDITORS),
+                        help='audits to run, all of them by default')
+    parser.add_argument('--progress', action='store_true', help='report progress to stderr')
+    parser.add_argument('--progress-interval', type=float, default=INTERVAL, metavar='SECONDS')
+    parser.add_argument('--metrics', metavar='FILE', help='append the progress reports to FILE as JSON lines')
+    args = parser.parse_args()
 
-    # zip_types = audit(OSMFILE, 'zip')
-    # pprint.pprint(zip_types)
+    progress = None
+    if args.progress or args.metrics:
+        progress = Progress(out=sys.stderr if args.progress else None, metrics_path=args.metrics,
+                            interval=args.progress_interval)
+    reports = run_audits(args.osm_file, args.audits, progress=progress)
+    if progress is not None:
+        progress.close()
+    for name, report in sorted(reports.items()):
+        print '== {} =='.format(name)
+        pprint.pprint(dict(report) if isinstance(report, defaultdict) else report)
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark each stage of the ingest pipeline on its own.
+
+Stages (see STAGES), each timed on elements prepared before the clock starts:
+
+- parse: stream the top level elements with data.get_element
+- shape: data.shape_rows, as used by write_elements
+- shape_element: data.shape_element, the dict version
+- normalize: audit.update_name and update_zip on every street and postcode value
+- normalize_cached: the same with the memoizing audit.normalizer used by data.py
+- validate: the compiled checks of validation.py
+- validate_cerberus: data.validate_element, on the first CERBERUS_LIMIT elements
+  only since it handles about a hundred per second
+- write: UnicodeRowWriter on the shape_rows output
+- write_dict: UnicodeDictWriter on the shape_element output
+
+Every stage runs in a fresh process, repeat times, and the fastest run is
+kept. For each stage the results hold the items per second, the peak RSS of
+the process and how much the stage raised it. One more, untimed run counts
+allocations (see count_allocations): the objects the stage allocated and
+the most of them alive at once. With --profile the hottest functions of
+each stage are captured with cProfile too.
+
+Besides the given osm files the stages run on synthetic inputs made of
+several copies of the first one (--scale), with the ids of every copy
+shifted so they stay unique. The results are written to a JSON file and can
+be compared with an earlier one (--compare) to spot regressions.
+"""
+
+import argparse
+import cProfile
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import pstats
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.cElementTree as ET
+
+import data
+from audit import normalizer, update_name, update_zip, st_mapping
+from compress import open_input
+from stream import TOP_LEVEL_TAGS
+
+SAMPLE_PATH = "sample.osm"
+RESULTS_PATH = "bench.json"
+
+REPEAT = 3
+SCALES = [5]
+TOP_FUNCTIONS = 15  # hottest functions kept per stage with --profile
+ID_STEP = 10 ** 11  # id offset between the copies of a scaled input, above any real OSM id
+REGRESSION = 1.1  # a stage this much slower than in the compared results is flagged
+CERBERUS_LIMIT = 1000
+
+
+def load_elements(osm_file):
+    """Return the top level elements of osm_file as a list of cElementTree elements"""
+    f = open_input(osm_file)
+    try:
+        return [elem for elem in ET.parse(f).getroot() if elem.tag in TOP_LEVEL_TAGS]
+    finally:
+        f.close()
+
+
+def shaped_rows(osm_file):
+    return [rows for rows in (data.shape_rows(elem) for elem in load_elements(osm_file)) if rows]
+
+
+def shaped_elements(osm_file):
+    return [el for el in (data.shape_element(elem) for elem in load_elements(osm_file)) if el]
+
+
+def tag_values(osm_file):
+    """Return the (key, value) of every street and postcode tag"""
+    return [(tag.attrib['k'], tag.attrib['v'])
+            for elem in load_elements(osm_file) for tag in elem.iter('tag')
+            if tag.attrib['k'] in data.TAG_CLEANERS]
+
+
+# Each stage is (name, prepare, run, unit, limit): prepare(osm_file) returns
+# the input of run, cut to its first limit items if limit is set, and run
+# returns the number of items it processed
+
+
+def parse(osm_file):
+    n = 0
+    for _ in data.get_element(osm_file):
+        n += 1
+    return n
+
+
+def shape(elements):
+    for elem in elements:
+        data.shape_rows(elem)
+    return len(elements)
+
+
+def shape_element(elements):
+    for elem in elements:
+        data.shape_element(elem)
+    return len(elements)
+
+
+def normalize(values):
+    for key, value in values:
+        if key == 'addr:postcode':
+            update_zip(value)
+        else:
+            update_name(value, st_mapping)
+    return len(values)
+
+
+def normalize_cached(values):
+    for key, value in values:
+        data.TAG_CLEANERS[key](value)
+    return len(values)
+
+
+def validate(shaped):
+    validator = data.CompiledValidator(max_errors=len(shaped) + 1)
+    for rows in shaped:
+        validator.validate(data.rows_to_element(rows))
+    return len(shaped)
+
+
+def validate_cerberus(elements):
+    validator = data.cerberus.Validator()
+    for el in elements:
+        try:
+            data.validate_element(el, validator)
+        except data.ValidationError:
+            pass
+    return len(elements)
+
+
+def write(shaped):
+    tmp_dir = tempfile.mkdtemp(prefix='osm-bench-')
+    try:
+        files = dict((key, open(os.path.join(tmp_dir, os.path.basename(path)), 'wb'))
+                     for key, path, _ in data.CSV_TABLES + data.RELATION_CSV_TABLES)
+        writers = dict((key, data.UnicodeRowWriter(files[key], fields))
+                       for key, _, fields in data.CSV_TABLES + data.RELATION_CSV_TABLES)
+        for rows in shaped:
+            for key, key_rows in rows.iteritems():
+                writers[key].writerows(key_rows)
+        for f in files.values():
+            f.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+    return len(shaped)
+
+
+def write_dict(elements):
+    tmp_dir = tempfile.mkdtemp(prefix='osm-bench-')
+    try:
+        files = dict((key, open(os.path.join(tmp_dir, os.path.basename(path)), 'wb'))
+                     for key, path, _ in data.CSV_TABLES + data.RELATION_CSV_TABLES)
+        writers = dict((key, data.UnicodeDictWriter(files[key], fields))
+                       for key, _, fields in data.CSV_TABLES + data.RELATION_CSV_TABLES)
+        for el in elements:
+            for key, value in el.iteritems():
+                if isinstance(value, dict):
+                    writers[key].writerow(value)
+                else:
+                    writers[key].writerows(value)
+        for f in files.values():
+            f.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+    return len(elements)
+
+
+STAGES = [
+    ('parse', lambda osm_file: osm_file, parse, 'elements', None),
+    ('shape', load_elements, shape, 'elements', None),
+    ('shape_element', load_elements, shape_element, 'elements', None),
+    ('normalize', tag_values, normalize, 'values', None),
+    ('normalize_cached', tag_values, normalize_cached, 'values', None),
+    ('validate', shaped_rows, validate, 'elements', None),
+    ('validate_cerberus', shaped_elements, validate_cerberus, 'elements', CERBERUS_LIMIT),
+    ('write', shaped_rows, write, 'elements', None),
+    ('write_dict', shaped_elements, write_dict, 'elements', None),
+]
+STAGE_NAMES = [stage[0] for stage in STAGES]
+
+
+def max_rss():
+    """Peak RSS of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def hot_functions(profile, top=TOP_FUNCTIONS):
+    """Return the top functions of a cProfile.Profile by own time"""
+    stats = pstats.Stats(profile)
+    functions = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        functions.append({'function': '{}:{}({})'.format(os.path.basename(filename), line, name),
+                          'calls': calls, 'tottime': round(tottime, 4), 'cumtime': round(cumtime, 4)})
+    functions.sort(key=lambda f: f['tottime'], reverse=True)
+    return functions[:top]
+
+
+def count_allocations(run, stage_input):
+    """Run a stage with the cyclic gc off, return (objects allocated, most extra objects alive at once)
+
+    With collection disabled, the generation 0 count of the gc goes up for
+    every container object allocated (list, dict, tuple, instance, ...) and
+    down for every one freed. It is read at every function call and return.
+    Objects allocated and freed again between two reads, and objects that are
+    not containers (str, int), are not counted, so both are lower bounds.
+    """
+    # last count read, objects allocated, peak
+    counts = [0, 0, 0]
+
+    def sample(frame, event, arg):
+        n = gc.get_count()[0]
+        if n > counts[0]:
+            counts[1] += n - counts[0]
+            if n > counts[2]:
+                counts[2] = n
+        counts[0] = n
+
+    gc.collect()  # starts the count from 0
+    gc.disable()
+    sys.setprofile(sample)
+    try:
+        run(stage_input)
+    finally:
+        sys.setprofile(None)
+        gc.enable()
+    return counts[1], counts[2]
+
+
+def run_stage(args):
+    """Prepare and time one stage in this process, return its results
+
+    With count, count its allocations instead (which slows it down a lot).
+    """
+    name, osm_file, profile, count = args
+    prepare, run, unit, limit = dict((stage[0], stage[1:]) for stage in STAGES)[name]
+    stage_input = prepare(osm_file)
+    if limit is not None:
+        stage_input = stage_input[:limit]
+    if count:
+        allocated, peak = count_allocations(run, stage_input)
+        return {'allocated_objects': allocated, 'peak_objects': peak}
+    gc.collect()
+    rss_before = max_rss()
+    profiler = cProfile.Profile() if profile else None
+
+    start = time.time()
+    if profiler is not None:
+        items = profiler.runcall(run, stage_input)
+    else:
+        items = run(stage_input)
+    seconds = time.time() - start
+
+    result = {'items': items, 'unit': unit, 'seconds': round(seconds, 4),
+              'per_sec': round(items / max(seconds, 1e-9), 1),
+              'peak_rss_mb': round(max_rss(), 1), 'stage_rss_mb': round(max_rss() - rss_before, 1)}
+    if profiler is not None:
+        result['profile'] = hot_functions(profiler)
+    return result
+
+
+def time_stage(name, osm_file, repeat=REPEAT, profile=False):
+    """Run a stage repeat times, each in a fresh process, return the fastest run with the allocation counts"""
+    runs = []
+    for count in [False] * repeat + [True]:
+        pool = multiprocessing.Pool(1)
+        runs.append(pool.apply(run_stage, [(name, osm_file, profile, count)]))
+        pool.close()
+        pool.join()
+    result = min(runs[:-1], key=lambda run: run['seconds'])
+    result.update(runs[-1])
+    return result
+
+
+ID_ATTRIBUTE = re.compile(r'(<(?:node|way|relation)\b[^>]*?\sid=")(-?\d+)"')
+REF_ATTRIBUTE = re.compile(r'(<(?:nd|member)\b[^>]*?\sref=")(-?\d+)"')
+
+
+def scale_input(osm_file, scaled_file, copies):
+    """Write copies of the elements of osm_file to scaled_file, nodes first, with shifted ids"""
+    spans = dict((tag, []) for tag in TOP_LEVEL_TAGS)
+    for elem in load_elements(osm_file):
+        spans[elem.tag].append(ET.tostring(elem, encoding='utf-8').split('?>', 1)[-1].strip())
+    with open(scaled_file, 'wb') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n')
+        for tag in TOP_LEVEL_TAGS:
+            for copy in range(copies):
+                offset = copy * ID_STEP
+
+                def shift(m):
+                    return '{}{}"'.format(m.group(1), int(m.group(2)) + offset)
+
+                for span in spans[tag]:
+                    out.write(REF_ATTRIBUTE.sub(shift, ID_ATTRIBUTE.sub(shift, span)))
+                    out.write('\n')
+        out.write('</osm>\n')
+
+
+def compare(results, previous):
+    """Print the change in speed of every stage and input found in both results, return the regressions"""
+    regressions = []
+    print
+    if bool(results.get('profile')) != bool(previous.get('profile')):
+        print 'only one of the runs was profiled, which slows the stages down'
+    print '{:<20}{:<18}{:>14}{:>14}{:>9}'.format('input', 'stage', 'before /s', 'now /s', 'change')
+    for input_name, stages in sorted(results['inputs'].items()):
+        for stage in STAGE_NAMES:
+            old = previous.get('inputs', {}).get(input_name, {}).get('stages', {}).get(stage)
+            new = stages['stages'].get(stage)
+            if not old or not new:
+                continue
+            ratio = new['per_sec'] / max(old['per_sec'], 1e-9)
+            slower = ratio * REGRESSION < 1
+            if slower:
+                regressions.append((input_name, stage))
+            print '{:<20}{:<18}{:>14,.0f}{:>14,.0f}{:>8.2f}x{}'.format(
+                input_name, stage, old['per_sec'], new['per_sec'], ratio, '  slower' if slower else '')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the ingest pipeline')
+    parser.add_argument('osm_files', nargs='*', default=[SAMPLE_PATH])
+    parser.add_argument('--stages', nargs='+', default=STAGE_NAMES, choices=STAGE_NAMES)
+    parser.add_argument('--scale', type=int, nargs='*', default=SCALES,
+                        help='also run on inputs made of this many copies of the first file')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--profile', action='store_true',
+                        help='capture the hottest functions of each stage with cProfile')
+    parser.add_argument('-o', '--output', default=RESULTS_PATH, help='JSON file to write the results to')
+    parser.add_argument('--compare', metavar='JSON', help='earlier results to compare with')
+    args = parser.parse_args()
+
+    results = {'python': platform.python_version(), 'machine': platform.machine(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeat': args.repeat, 'profile': args.profile,
+               'inputs': {}}
+    tmp_dir = tempfile.mkdtemp(prefix='osm-bench-')
+    try:
+        inputs = [(os.path.basename(osm_file), osm_file) for osm_file in args.osm_files]
+        for copies in args.scale:
+            name = '{}x{}'.format(inputs[0][0], copies)
+            scaled_file = os.path.join(tmp_dir, name)
+            scale_input(args.osm_files[0], scaled_file, copies)
+            inputs.append((name, scaled_file))
+
+        print '{:<20}{:<18}{:>10}{:>10}{:>14}{:>10}{:>10}{:>12}{:>12}'.format(
+            'input', 'stage', 'items', 'seconds', 'items/s', 'peak MB', 'stage MB', 'allocated', 'peak objs')
+        for name, osm_file in inputs:
+            stages = {}
+            results['inputs'][name] = {'bytes': os.path.getsize(osm_file), 'stages': stages}
+            for stage in args.stages:
+                result = stages[stage] = time_stage(stage, osm_file, args.repeat, args.profile)
+                print '{:<20}{:<18}{:>10}{:>10.3f}{:>14,.0f}{:>10.1f}{:>10.1f}{:>12,}{:>12,}'.format(
+                    name, stage, result['items'], result['seconds'], result['per_sec'],
+                    result['peak_rss_mb'], result['stage_rss_mb'],
+                    result['allocated_objects'], result['peak_objects'])
+                for function in result.get('profile', [])[:5]:
+                    print '{:<38}{:>10}{:>10.3f}  {}'.format('', function['calls'], function['tottime'],
+                                                              function['function'])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print 'results written to {}'.format(args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        if regressions:
+            raise SystemExit('{} stages are more than {:.0%} slower'.format(len(regressions), REGRESSION - 1))
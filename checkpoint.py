@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoints that let an interrupted data.process_map run carry on.
+
+With a checkpoint file, process_map shapes the input in byte ranges of
+whole top level elements (the chunks of data.get_chunks or pbf.get_chunks)
+and appends each range to the csvs as one unit. Once a range is written and
+the csvs are synced, the checkpoint records:
+- the input byte offset where the next range starts
+- the type and id of the last element written
+- the length of every output file
+- the element and tag counts so far
+
+The chunk list itself is saved in the first checkpoint, so a resumed run
+goes over the same ranges whatever its number of workers. Resuming cuts
+every output back to its recorded length, which drops whatever a dying run
+wrote after its last checkpoint, and starts at the recorded offset.
+
+Each range is written as its own gzip member or zstd frame, so compressed
+csvs decompress to the same data as an uninterrupted run. Plain csvs are
+byte for byte the same. The checkpoint file is replaced atomically and
+removed when the run completes.
+"""
+
+import json
+import os
+
+CHECKPOINT_PATH = "process_map.checkpoint"
+CHECKPOINT_BYTES = 64 << 20  # input bytes per range, at most this much work is lost
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def input_signature(file_in):
+    """Identify the input file, so a checkpoint is not resumed on another one"""
+    st = os.stat(file_in)
+    return {'path': os.path.abspath(file_in), 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def new_checkpoint(file_in, chunks, options, paths):
+    """Return the state of a run that has only written the csv headers"""
+    return {
+        'input': input_signature(file_in),
+        'options': options,
+        'chunks': [list(chunk) for chunk in chunks],
+        'done': 0,
+        'offset': chunks[0][0] if chunks else None,
+        'last': None,
+        'outputs': dict((path, os.path.getsize(path)) for path in paths),
+        'counts': {},
+        'stats': {},
+    }
+
+
+def save_checkpoint(path, state):
+    """Write the checkpoint to a temporary file and rename it over path, so it is never half written"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def load_checkpoint(path, file_in, options):
+    """Read a checkpoint and check that it belongs to this input and these options"""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except IOError:
+        raise CheckpointError('no checkpoint at {}, run without resuming'.format(path))
+    if state['input'] != input_signature(file_in):
+        raise CheckpointError('{} was made for {}, not for this input or version of it'.format(
+            path, state['input']['path']))
+    if state['options'] != options:
+        raise CheckpointError('{} was made with other options: {}'.format(path, state['options']))
+    return state
+
+
+def sync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def record_chunk(state, paths, end, last, counts, stats):
+    """Update the state after the range ending at end was appended to the outputs at paths"""
+    for path in paths:
+        sync_file(path)
+        state['outputs'][path] = os.path.getsize(path)
+    state['done'] += 1
+    state['offset'] = end
+    state['last'] = last
+    for key, counter in (('counts', counts), ('stats', stats)):
+        for name, n in counter.iteritems():
+            state[key][name] = state[key].get(name, 0) + n
+
+
+def truncate_outputs(state):
+    """Cut every output back to its length at the checkpoint"""
+    for path, length in state['outputs'].iteritems():
+        if not os.path.exists(path) or os.path.getsize(path) < length:
+            raise CheckpointError('{} is shorter than at the checkpoint, start again without resuming'.format(path))
+        with open(path, 'r+b') as f:
+            f.truncate(length)
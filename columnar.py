@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Write the five tables produced by data.py as typed, compressed Parquet files
+instead of csv files.
+
+Every value in the csv files is text, so every reader has to parse ids,
+coordinates and changesets again. Here the shaped rows are buffered by
+column and written one row group at a time with proper types (int64 ids,
+float64 coordinates, UTC timestamps). The low cardinality string columns
+(tag keys and types, user names) are dictionary encoded, which keeps the
+files small and makes them load as pandas categoricals:
+
+    import pandas as pd
+    pd.read_parquet('ways_nodes.parquet', columns=['id', 'node_id'])
+
+Requires pyarrow.
+"""
+
+import argparse
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from data import get_element, write_elements, \
+    NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS, \
+    RELATION_FIELDS, RELATION_MEMBERS_FIELDS, RELATION_TAGS_FIELDS
+
+OSM_PATH = "manhattan_new-york.osm"
+
+NODES_PATH = "nodes.parquet"
+NODE_TAGS_PATH = "nodes_tags.parquet"
+WAYS_PATH = "ways.parquet"
+WAY_NODES_PATH = "ways_nodes.parquet"
+WAY_TAGS_PATH = "ways_tags.parquet"
+RELATIONS_PATH = "relations.parquet"
+RELATION_MEMBERS_PATH = "relation_members.parquet"
+RELATION_TAGS_PATH = "relations_tags.parquet"
+
+ROW_GROUP_SIZE = 1 << 20  # rows buffered per row group
+COMPRESSION = 'snappy'
+
+# columns with few distinct values, stored as dictionaries
+DICTIONARY_FIELDS = ['user', 'key', 'type', 'role']
+# columns shape_rows already emits as ints, everything else arrives as text
+INT_FIELDS = ['position']
+
+
+def column_type(field):
+    """Return the arrow type used to store a field"""
+    if field in DICTIONARY_FIELDS:
+        return pa.dictionary(pa.int32(), pa.string())
+    return {
+        'id': pa.int64(),
+        'node_id': pa.int64(),
+        'ref': pa.int64(),
+        'uid': pa.int64(),
+        'changeset': pa.int64(),
+        'version': pa.int32(),
+        'position': pa.int32(),
+        'lat': pa.float64(),
+        'lon': pa.float64(),
+        'timestamp': pa.timestamp('s', tz='UTC'),
+    }.get(field, pa.string())
+
+
+def to_array(field, values):
+    """Convert a column of shaped values to an arrow array of the field's type"""
+    if field in INT_FIELDS:
+        return pa.array(values, type=column_type(field))
+    # let arrow parse the text in one go instead of calling int()/float() per value
+    array = pa.array(values, type=pa.string())
+    if field in DICTIONARY_FIELDS:
+        return array.dictionary_encode()
+    return array.cast(column_type(field))
+
+
+class ParquetRowWriter(object):
+    """Write rows to a parquet file, one row group every row_group_size rows
+
+    Takes rows in fieldnames order through the writerow/writerows interface of
+    csv.writer, so it can be used with data.write_elements. None is stored as null.
+    """
+
+    def __init__(self, path, fieldnames, row_group_size=ROW_GROUP_SIZE, compression=COMPRESSION):
+        if pa is None:
+            raise ImportError('pyarrow is required to write parquet files')
+        self.fieldnames = fieldnames
+        self.row_group_size = row_group_size
+        self.schema = pa.schema([pa.field(f, column_type(f)) for f in fieldnames])
+        self.columns = [[] for _ in fieldnames]
+        self.writer = pq.ParquetWriter(path, self.schema, compression=compression,
+                                       use_dictionary=[f for f in fieldnames if f in DICTIONARY_FIELDS])
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        for column, values in zip(self.columns, zip(*rows)):
+            column.extend(values)
+        if len(self.columns[0]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.columns[0]:
+            return
+        arrays = [to_array(f, column) for f, column in zip(self.fieldnames, self.columns)]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.columns = [[] for _ in self.fieldnames]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+# shape_rows output key, parquet path and columns of each table
+PARQUET_TABLES = [
+    ('node', NODES_PATH, NODE_FIELDS),
+    ('node_tags', NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+    ('way', WAYS_PATH, WAY_FIELDS),
+    ('way_nodes', WAY_NODES_PATH, WAY_NODES_FIELDS),
+    ('way_tags', WAY_TAGS_PATH, WAY_TAGS_FIELDS),
+]
+RELATION_PARQUET_TABLES = [
+    ('relation', RELATIONS_PATH, RELATION_FIELDS),
+    ('relation_members', RELATION_MEMBERS_PATH, RELATION_MEMBERS_FIELDS),
+    ('relation_tags', RELATION_TAGS_PATH, RELATION_TAGS_FIELDS),
+]
+
+
+def process_map(file_in, validate, row_group_size=ROW_GROUP_SIZE, compression=COMPRESSION,
+                relations=False):
+    """Iteratively process each XML element and write to parquet file(s)"""
+
+    tables = PARQUET_TABLES + (RELATION_PARQUET_TABLES if relations else [])
+    tags = ('node', 'way', 'relation', 'member') if relations else ('node', 'way')
+    writers = {}
+    try:
+        for key, path, fields in tables:
+            writers[key] = ParquetRowWriter(path, fields, row_group_size, compression)
+        write_elements(get_element(file_in, tags=tags), writers, validate)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shape an OSM XML file into parquet files')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    parser.add_argument('--validate', action='store_true')
+    parser.add_argument('--compression', default=COMPRESSION,
+                        help='parquet codec: snappy, gzip, brotli, zstd or none')
+    parser.add_argument('--relations', action='store_true',
+                        help='also write relations, their members and tags')
+    args = parser.parse_args()
+
+    process_map(args.osm_file, validate=args.validate, compression=args.compression,
+                relations=args.relations)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Transparent compressed input and output.
+
+open_input reads .osm.bz2, .osm.gz and .osm.zst files as if they were plain
+osm files. Decompression runs alongside parsing: in a separate process when
+the command line tool is installed (lbzip2/pbzip2/bzip2, pigz/gzip, zstd),
+otherwise in a thread using the bz2 or zlib module.
+
+open_output writes a compressed file the same way, piping through the
+command line compressor when it is installed (gzip falls back to the gzip
+module, zstd needs the zstd tool).
+
+Running this file measures the throughput of each codec on an osm file.
+"""
+
+import argparse
+import bz2
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+import Queue
+from distutils.spawn import find_executable
+
+OSM_PATH = "sample.osm"
+
+BLOCK_SIZE = 1 << 20
+QUEUE_SIZE = 16  # decompressed blocks buffered ahead of the parser
+
+# codec -> file suffix, command line tools in order of preference, compression level
+CODECS = {
+    'gzip': ('.gz', ['pigz', 'gzip'], 6),
+    'bzip2': ('.bz2', ['lbzip2', 'pbzip2', 'bzip2'], 9),
+    'zstd': ('.zst', ['zstd'], 3),
+}
+OUTPUT_CODECS = ('gzip', 'zstd')
+
+
+def codec_of(path):
+    """Return the codec of a file from its suffix, None for plain files"""
+    for codec, (suffix, _, _) in CODECS.items():
+        if path.endswith(suffix):
+            return codec
+    return None
+
+
+def find_tool(codec):
+    for name in CODECS[codec][1]:
+        path = find_executable(name)
+        if path:
+            return path
+    return None
+
+
+class ProcessReader(object):
+    """Read the output of a decompressing child process"""
+
+    def __init__(self, args):
+        self.args = args
+        self.proc = subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=BLOCK_SIZE)
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data and size != 0 and self.proc.wait():
+            # a corrupt or truncated file, which would otherwise look like a short one
+            raise IOError('{} exited with {}'.format(self.args[0], self.proc.returncode))
+        return data
+
+    def close(self):
+        # stop a child that is not done yet, rather than have it fail writing to a closed pipe
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+def decompressor(codec):
+    if codec == 'bzip2':
+        return bz2.BZ2Decompressor()
+    if codec == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    raise ValueError('no {} module, install the {} command line tool'.format(codec, codec))
+
+
+class ThreadReader(object):
+    """Decompress a file in a background thread and read the result"""
+
+    def __init__(self, path, codec):
+        self.codec = codec
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        # current decompressed chunk and how much of it was read
+        self.chunk = ''
+        self.pos = 0
+        self.done = False
+        self.closed = threading.Event()
+        decompressor(codec)  # fail here for unsupported codecs, not in the thread
+        self.thread = threading.Thread(target=self.run, args=(path,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, path):
+        try:
+            with open(path, 'rb') as f:
+                d = decompressor(self.codec)
+                while not self.closed.is_set():
+                    block = f.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    while block:
+                        self.queue.put(d.decompress(block))
+                        # concatenated streams (pbzip2, multi member gzip) start a new decompressor
+                        block = d.unused_data
+                        if block:
+                            d = decompressor(self.codec)
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.chunk):
+                if self.done:
+                    break
+                chunk = self.queue.get()
+                if chunk is None or isinstance(chunk, Exception):
+                    self.done = True
+                    if chunk is not None:
+                        raise chunk
+                    break
+                self.chunk, self.pos = chunk, 0
+                continue
+            part = self.chunk[self.pos:] if size < 0 else self.chunk[self.pos:self.pos + size]
+            self.pos += len(part)
+            if size > 0:
+                size -= len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+    def close(self):
+        self.closed.set()
+        # unblock the thread if it is waiting on a full queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+def open_input(path, use_tools=True):
+    """Open an osm file for reading, decompressing it alongside the caller if needed"""
+    codec = codec_of(path)
+    if codec is None:
+        return open(path, 'rb')
+    tool = find_tool(codec) if use_tools else None
+    if tool:
+        return ProcessReader([tool, '-d', '-c', path])
+    return ThreadReader(path, codec)
+
+
+class ProcessWriter(object):
+    """Write through a compressing child process"""
+
+    def __init__(self, args, path, mode):
+        self.args = args
+        self.file = open(path, mode)
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=self.file, bufsize=BLOCK_SIZE)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        returncode = self.proc.wait()
+        self.file.close()
+        if returncode:
+            raise IOError('{} exited with {}'.format(self.args[0], returncode))
+
+
+def open_output(path, codec=None, append=False):
+    """Open path for writing, compressed with codec (None, 'gzip' or 'zstd')
+
+    Appending to a compressed file adds a new gzip member or zstd frame, which
+    decompresses as if it was one stream.
+    """
+    mode = 'ab' if append else 'wb'
+    if codec is None:
+        return open(path, mode)
+    tool = find_tool(codec)
+    if tool:
+        return ProcessWriter([tool, '-c', '-{}'.format(CODECS[codec][2])], path, mode)
+    if codec == 'gzip':
+        return gzip.open(path, mode, CODECS[codec][2])
+    raise ValueError('writing {} needs the {} command line tool'.format(codec, codec))
+
+
+def output_path(path, codec=None):
+    return path + CODECS[codec][0] if codec else path
+
+
+def read_lines(f):
+    """Yield the lines of f, which may be one of the readers of open_input"""
+    rest = ''
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if not block:
+            break
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
+def read_all(f, size=-1):
+    """Read and discard size bytes of f (everything by default), return the number of bytes read"""
+    n = 0
+    while size < 0 or n < size:
+        block = f.read(BLOCK_SIZE if size < 0 else min(BLOCK_SIZE, size - n))
+        if not block:
+            break
+        n += len(block)
+    return n
+
+
+if __name__ == '__main__':
+    import data
+
+    parser = argparse.ArgumentParser(description='Measure the throughput of each codec')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    args = parser.parse_args()
+
+    size = os.path.getsize(args.osm_file)
+    tmp_dir = tempfile.mkdtemp(prefix='osm-codecs-')
+    cwd = os.getcwd()
+    osm_file = os.path.abspath(args.osm_file)
+    try:
+        os.chdir(tmp_dir)
+        print '{} ({:.1f} MB)'.format(args.osm_file, size / 1e6)
+        print '{:<7}{:<9}{:>10}{:>14}{:>16}'.format('codec', 'reader', 'ratio', 'read MB/s', 'shape s')
+        start = time.time()
+        data.write_csvs(data.get_element(osm_file, ('node', 'way')), data.CSV_TABLES, False)
+        print '{:<7}{:<9}{:>10}{:>14}{:>16.2f}'.format('none', '', '1.00', '', time.time() - start)
+
+        for codec in sorted(CODECS):
+            tool = find_tool(codec)
+            if tool is None and codec == 'zstd':
+                print '{:<7}no zstd tool, skipped'.format(codec)
+                continue
+            compressed = os.path.join(tmp_dir, 'input.osm' + CODECS[codec][0])
+            with open(osm_file, 'rb') as src:
+                out = open_output(compressed, codec)
+                shutil.copyfileobj(src, out, BLOCK_SIZE)
+                out.close()
+            ratio = float(size) / os.path.getsize(compressed)
+            for use_tools in ([True, False] if codec != 'zstd' else [True]):
+                if use_tools and tool is None:
+                    continue
+                reader = 'process' if use_tools else 'thread'
+                start = time.time()
+                f = open_input(compressed, use_tools)
+                read_all(f)
+                f.close()
+                read_rate = size / 1e6 / (time.time() - start)
+                start = time.time()
+                f = open_input(compressed, use_tools)
+                try:
+                    data.write_csvs(data.get_element(f, ('node', 'way')), data.CSV_TABLES, False)
+                finally:
+                    f.close()
+                print '{:<7}{:<9}{:>10.2f}{:>14.1f}{:>16.2f}'.format(
+                    codec, reader, ratio, read_rate, time.time() - start)
+
+        print
+        print '{:<7}{:>12}{:>16}'.format('output', 'csv MB', 'process_map s')
+        for codec in (None,) + OUTPUT_CODECS:
+            if codec == 'zstd' and find_tool('zstd') is None:
+                continue
+            start = time.time()
+            data.process_map(osm_file, validate=False, compression=codec)
+            seconds = time.time() - start
+            csv_size = sum(os.path.getsize(output_path(path, codec)) for _, path, _ in data.CSV_TABLES)
+            print '{:<7}{:>12.2f}{:>16.2f}'.format(codec or 'none', csv_size / 1e6, seconds)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
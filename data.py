@@ -5,7 +5,7 @@
 After auditing is complete the next step is to prepare the data to be inserted into a SQL database. To do so you will parse the elements in the OSM XML file, transforming them from document format to tabular format, thus making it possible to write to .csv files.  These csv files can then easily be imported to a SQL database as tables.
 
 The process for this transformation is as follows:
-- Use iterparse to iteratively step through each top level element in the XML
+- Use iterparse to iteratively step through each top level element in the XML (see stream.py)
 - Shape each element into several data structures using a custom function
 - Utilize a schema and validation library to ensure the transformed data is in the correct format
 - Write each data structure to the appropriate .csv files
@@ -138,16 +138,37 @@ The final return value for a "way" element should look something like:
                'key': 'building_id',
                'type': 'chicago',
                'value': '366409'}]}
+
+### If the element top level tag is "relation":
+The dictionary has the format {"relation": ..., "relation_members": ..., "relation_tags": ...}
+with the same attributes as a way, the tags shaped like "way_tags" and one dictionary per
+member child tag with the fields id (the relation id), type, ref, role and position.
+Relations are only processed when process_map is called with relations=True. The parser then
+yields the members one by one as they are read (see stream.py), and shape_rows turns each into
+its "relation_members" row, so a relation never holds all its members in memory.
 """
 
+import argparse
 import csv
-import codecs
+import io
+import multiprocessing
+import os
 import pprint
 import re
-import xml.etree.cElementTree as ET
+import shutil
+import sys
+import tempfile
 
 import cerberus
+import pbf
 import schema
+from checkpoint import CheckpointError, load_checkpoint, new_checkpoint, record_chunk, save_checkpoint, \
+    truncate_outputs, CHECKPOINT_BYTES, CHECKPOINT_PATH
+from compress import codec_of, open_input, open_output, output_path, read_lines, OUTPUT_CODECS
+from integrity import RefChecker, DANGLING_PATH
+from progress import Progress, INTERVAL
+from stream import iter_elements, BACKEND, BACKENDS, TOP_LEVEL_TAGS
+from validation import CompiledValidator, ValidationError
 
 OSM_PATH = "manhattan_new-york.osm"
 
@@ -156,10 +177,15 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relation_members.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
 
 LOWER_COLON = re.compile(r'^([\w|_]+):([\w|_:]+)')
 LOWER_PERIOD = re.compile(r'^([\w|_]+)\.([\w|_:]+)')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\.\t\r\n]')
+# start of a top level element; '<' cannot appear unescaped in attribute values
+TOP_LEVEL_START = re.compile(r'<(?:node|way|relation)[\s/>]')
 
 SCHEMA = schema.schema
 
@@ -169,19 +195,44 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_MEMBERS_FIELDS = ['id', 'type', 'ref', 'role', 'position']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+
+# shape_element output key, csv path and columns of each table
+CSV_TABLES = [
+    ('node', NODES_PATH, NODE_FIELDS),
+    ('node_tags', NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+    ('way', WAYS_PATH, WAY_FIELDS),
+    ('way_nodes', WAY_NODES_PATH, WAY_NODES_FIELDS),
+    ('way_tags', WAY_TAGS_PATH, WAY_TAGS_FIELDS),
+]
+RELATION_CSV_TABLES = [
+    ('relation', RELATIONS_PATH, RELATION_FIELDS),
+    ('relation_members', RELATION_MEMBERS_PATH, RELATION_MEMBERS_FIELDS),
+    ('relation_tags', RELATION_TAGS_PATH, RELATION_TAGS_FIELDS),
+]
 
 # import update_name and update_zip from audit.py
-from audit import update_name, update_zip, mapping
+from audit import update_name, update_zip, st_mapping, normalizer
+from lru import LRUCache
+
+# value cleaners for the tag keys whose values need fixing, memoized per distinct value
+TAG_CLEANERS = {
+    'addr:postcode': normalizer.zip,
+    'addr:street': normalizer.street,
+}
+
+# tag keys repeat heavily (a few thousand distinct keys across millions of tags),
+# so each raw key is classified once and looked up afterwards
+TAG_KEY_CACHE = LRUCache(maxsize=20000)
 
 def update_dict(elem):
     # updates secondary tags dictionary for a given element if a zip code or street name needs to be changed
-    update_type = elem.attrib['k']
-    if update_type == 'addr:postcode':
-        new = update_zip(elem.attrib['v'])
-    elif update_type == 'addr:street':
-        new = update_name(elem.attrib['v'], mapping)
-    else:
+    cleaner = TAG_CLEANERS.get(elem.attrib['k'])
+    if cleaner is None:
         return False
+    new = cleaner(elem.attrib['v'])
 
     # if the dictionary does not need to be updated, output False
     if new != elem.attrib['v']:
@@ -190,107 +241,162 @@ def update_dict(elem):
     else:
         return False
 
+def classify_key(k):
+    """Return (type, key, skip, cleaner) for a raw tag key
+
+    type is None when the tag gets the default tag type. skip is True when the
+    key contains problematic characters; such rows keep only their id and value.
+    cleaner is the function that fixes the tag value, or None.
+    """
+    cleaner = TAG_CLEANERS.get(k)
+    m = LOWER_COLON.search(k)
+    if m:   # run through keys like 'addr:street'
+        return m.group(1), m.group(2), False, cleaner
+    n = LOWER_PERIOD.search(k)
+    if n:   # run though keys like 'cityracks.housenumber'
+        return n.group(1), n.group(2), False, cleaner
+    if PROBLEMCHARS.search(k):
+        return None, None, True, cleaner
+    return None, k, False, cleaner
+
+cached_classify_key = TAG_KEY_CACHE.memoize(classify_key)
+
+# tags whose key has problematic characters, and values changed by the cleaners
+# of TAG_CLEANERS or the special cases of shape_rows, counted for the progress reports
+TAG_STATS = {'problem_keys': 0, 'cleaned_values': 0}
+
+def tag_stats():
+    return dict(TAG_STATS)
+
+def tag_row(sec_elem, id_, tag_type):
+    """Shape one secondary tag into a row in NODE_TAGS_FIELDS order
+
+    key and type are None for keys with problematic characters.
+    """
+    attrib = sec_elem.attrib
+    type_, key, skip, cleaner = cached_classify_key(attrib['k'])
+
+    value = attrib['v']
+    if cleaner is not None:
+        # update zip code and street if necessary (see update_dict)
+        new = cleaner(value) or value
+        if new != value:
+            TAG_STATS['cleaned_values'] += 1
+            value = new
+
+    if skip:
+        TAG_STATS['problem_keys'] += 1
+        return (id_, None, value, None)
+    return (id_, key, value, type_ or tag_type)
+
 def extract_sec_tags(sec_elem, attributes, tag_type):
     # for each secondary tag, create a dictionary with the elements of NODES_TAGS_FIELDS as keys
-    sec_dict = {}
-    for field in NODE_TAGS_FIELDS:
-        # loop over the node tag fields (id, key, value, type)
-        if field == 'id':
-            sec_dict[field] = attributes[field] # attributes contains 'id', so just that value in our secondary tag dictionary
-        elif field == 'value':
-            sec_dict[field] = sec_elem.attrib['v']
-            update = update_dict(sec_elem)
-            # update zip code and street if necessary (see update_dict module)
-            if update:
-                sec_dict[field] = update
-
-        elif field == 'key':
-            key = sec_elem.attrib['k']
-            m = LOWER_COLON.search(key)
-            n = LOWER_PERIOD.search(key)
-            if m:   # run through keys like 'addr:street'
-                sec_dict['type'] = m.group(1)
-                sec_dict[field] = m.group(2)
-            elif n: # run though keys like 'cityracks.housenumber'
-                sec_dict['type'] = n.group(1)
-                sec_dict[field] = n.group(2)
-            elif PROBLEMCHARS.search(key): # skip this entry if a key contains problematic characters
-                continue
-            else:
-                sec_dict['type'] = tag_type
-                sec_dict[field] = key
-    return sec_dict
-
-def shape_element(element,
+    return row_dict(NODE_TAGS_FIELDS, tag_row(sec_elem, attributes['id'], tag_type))
+
+# shape_rows output key -> columns of its rows
+ROW_FIELDS = {
+    'node': NODE_FIELDS,
+    'node_tags': NODE_TAGS_FIELDS,
+    'way': WAY_FIELDS,
+    'way_nodes': WAY_NODES_FIELDS,
+    'way_tags': WAY_TAGS_FIELDS,
+    'relation': RELATION_FIELDS,
+    'relation_members': RELATION_MEMBERS_FIELDS,
+    'relation_tags': RELATION_TAGS_FIELDS,
+}
+# keys that hold the single row of the element itself
+ELEMENT_KEYS = ('node', 'way', 'relation')
+
+def shape_rows(element,
         node_attr_fields=NODE_FIELDS,
         way_attr_fields=WAY_FIELDS,
-        problem_chars=PROBLEMCHARS,
+        relation_attr_fields=RELATION_FIELDS,
         default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
+    """Shape node, way or relation XML element into rows
 
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
+    Returns the same keys as shape_element, each mapped to a list of tuples in
+    the column order of ROW_FIELDS[key]. Fields shape_element leaves out are None.
+    """
 
-    if element.tag == 'node':
-        for attr in node_attr_fields:
-            # handle node attributes
-            node_attribs[attr] = element.attrib[attr]
+    attrib = element.attrib
 
-        for sec_elem in element.iter('tag'):
-            # handle secondary node tags
-            sec_node_dict = extract_sec_tags(sec_elem, node_attribs, default_tag_type)
-            tags.append(sec_node_dict)
-        return {'node': node_attribs, 'node_tags': tags}
+    if element.tag == 'node':
+        node_id = attrib['id']
+        node = tuple([attrib[attr] for attr in node_attr_fields])
+        tags = [tag_row(sec_elem, node_id, default_tag_type) for sec_elem in element.iter('tag')]
+        return {'node': [node], 'node_tags': tags}
 
 
     elif element.tag == 'way':
-        for attr in way_attr_fields:
-            # handle way attributes
-            way_attribs[attr] = element.attrib[attr]
-
-        for i, node_elem in enumerate(element.iter('nd')):
-            # handle node attributes
-            way_node_dict = {}
-            for field in WAY_NODES_FIELDS:
-                if field == 'id':
-                    way_node_dict[field] = way_attribs[field]
-                elif field == 'node_id':
-                    way_node_dict[field] = node_elem.attrib['ref']
-                elif field == 'position':
-                    way_node_dict[field] = i
-            way_nodes.append(way_node_dict)
-
-        for tag_elem in element.iter('tag'):
-            # handle secondary way tags
-            sec_way_dict = extract_sec_tags(tag_elem, way_attribs, default_tag_type)
-            tags.append(sec_way_dict)
+        way_id = attrib['id']
+        way = tuple([attrib[attr] for attr in way_attr_fields])
+        way_nodes = [(way_id, node_elem.attrib['ref'], i) for i, node_elem in enumerate(element.iter('nd'))]
+        tags = [tag_row(tag_elem, way_id, default_tag_type) for tag_elem in element.iter('tag')]
 
         # special case: update postal code '83' to correct postal codes
         id_zips = {'265347580':'10065', '278366155':'10029'}
-        for id_, zip_ in id_zips.items():
-            if way_attribs['id'] == id_:
-                for tag in tags:
-                    if tag['key'] == 'postcode':
-                        tag['value'] = zip_
-                        print '{} --> {}'.format('83', tag['value'])
+        zip_ = id_zips.get(way_id)
+        if zip_ is not None:
+            for i, (id_, key, value, type_) in enumerate(tags):
+                if key == 'postcode' and value != zip_:
+                    tags[i] = (id_, key, zip_, type_)
+                    TAG_STATS['cleaned_values'] += 1
+
+        return {'way': [way], 'way_nodes': way_nodes, 'way_tags': tags}
+
+
+    elif element.tag == 'relation':
+        relation_id = attrib['id']
+        relation = tuple([attrib[attr] for attr in relation_attr_fields])
+        # members (nodes, ways or other relations) in the order they appear, if the
+        # parser has not already yielded them one by one
+        members = [(relation_id, m.attrib['type'], m.attrib['ref'], m.attrib['role'], i)
+                   for i, m in enumerate(element.iter('member'))]
+        tags = [tag_row(tag_elem, relation_id, default_tag_type) for tag_elem in element.iter('tag')]
+        return {'relation': [relation], 'relation_members': members, 'relation_tags': tags}
+
+    elif element.tag == 'member':
+        # a relation member yielded on its own by get_element, see stream.py
+        return {'relation_members': [(attrib['id'], attrib['type'], attrib['ref'], attrib['role'],
+                                      attrib['position'])]}
+
+def row_dict(fields, row):
+    """Turn a shaped row back into a dict, leaving out the None fields"""
+    return dict((field, value) for field, value in zip(fields, row) if value is not None)
+
+def rows_to_element(rows):
+    """Convert shape_rows output into the dicts returned by shape_element"""
+    el = {}
+    for key, key_rows in rows.iteritems():
+        fields = ROW_FIELDS[key]
+        if key in ELEMENT_KEYS:
+            el[key] = row_dict(fields, key_rows[0])
+        else:
+            el[key] = [row_dict(fields, row) for row in key_rows]
+    return el
 
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+def shape_element(element,
+        node_attr_fields=NODE_FIELDS,
+        way_attr_fields=WAY_FIELDS,
+        relation_attr_fields=RELATION_FIELDS,
+        problem_chars=PROBLEMCHARS,
+        default_tag_type='regular'):
+    """Clean and shape node, way or relation XML element to Python dict
+
+    Built from shape_rows, which write_elements uses directly.
+    """
+    rows = shape_rows(element, node_attr_fields, way_attr_fields, relation_attr_fields, default_tag_type)
+    if rows is None:
+        return None
+    return rows_to_element(rows)
 
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+def get_element(osm_file, tags=TOP_LEVEL_TAGS, backend=BACKEND):
     """Yield element if it is the right type of tag"""
-
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    return iter_elements(osm_file, tags, backend)
 
 
 def validate_element(element, validator, schema=SCHEMA):
@@ -300,7 +406,49 @@ def validate_element(element, validator, schema=SCHEMA):
         message_string = "\nElement of type '{0}' has the following errors:\n{1}"
         error_string = pprint.pformat(errors)
 
-        raise Exception(message_string.format(field, error_string))
+        raise ValidationError(message_string.format(field, error_string))
+
+
+def find_element_start(osm_file, offset, blocksize=1 << 16):
+    """Return the byte offset of the first top level element at or after offset"""
+    osm_file.seek(offset)
+    buf = ''
+    while True:
+        block = osm_file.read(blocksize)
+        if not block:
+            return None
+        buf += block
+        m = TOP_LEVEL_START.search(buf)
+        if m:
+            return offset + m.start()
+        # keep a few bytes in case a tag is split across two blocks
+        offset += len(buf) - 10
+        buf = buf[-10:]
+
+
+def get_chunks(file_in, num_chunks):
+    """Split the osm file into byte ranges that begin and end on top level element boundaries"""
+    with open(file_in, 'rb') as osm_file:
+        size = os.fstat(osm_file.fileno()).st_size
+        osm_file.seek(max(0, size - 1024))
+        tail = osm_file.read()
+        end = size - len(tail) + tail.rfind('</osm>')
+
+        offsets = []
+        for i in range(num_chunks):
+            start = find_element_start(osm_file, size * i // num_chunks)
+            if start is None or start >= end:
+                break
+            if not offsets or start > offsets[-1]:
+                offsets.append(start)
+    return zip(offsets, offsets[1:] + [end])
+
+
+def read_chunk(file_in, start, end):
+    """Return a file-like object holding the elements in [start, end) as a complete osm document"""
+    with open(file_in, 'rb') as osm_file:
+        osm_file.seek(start)
+        return io.BytesIO('<osm>' + osm_file.read(end - start) + '</osm>')
 
 
 class UnicodeDictWriter(csv.DictWriter, object):
@@ -319,46 +467,357 @@ class UnicodeDictWriter(csv.DictWriter, object):
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'wb') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'wb') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'wb') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'wb') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'wb') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node','way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    pprint.pprint(el)
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+class UnicodeRowWriter(object):
+    """csv writer for rows in column order, encoding unicode values to utf-8
+
+    Writes the same bytes as UnicodeDictWriter without building a dict per row.
+    None is written as an empty field.
+    """
+
+    def __init__(self, f, fieldnames):
+        self.writer = csv.writer(f)
+        self.fieldnames = fieldnames
+
+    def writeheader(self):
+        self.writer.writerow(self.fieldnames)
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        self.writer.writerows([[v.encode('utf-8') if type(v) is unicode else v for v in row] for row in rows])
+
+
+def write_elements(elements, writers, validate, checker=None):
+    """Shape each element and write the rows of each part of it with the matching writer
+
+    writers maps the keys of the shape_rows output ('node', 'node_tags', 'way', ...)
+    to a writer of that table taking rows in ROW_FIELDS order. checker, if given,
+    is an integrity.RefChecker that sees the rows of every element.
+    """
+
+    # validate_element (cerberus) is the reference, the compiled checks are much faster
+    validator = CompiledValidator()
+
+    for element in elements:
+        rows = shape_rows(element)
+        if rows:
+            if validate is True and not validator.validate(rows_to_element(rows)):
+                if validator.failed >= validator.max_errors:
+                    raise ValidationError(validator.report())
+
+            if checker is not None:
+                checker.check(rows)
+            for key, key_rows in rows.iteritems():
+                writers[key].writerows(key_rows)
+
+    if validator.failed:
+        raise ValidationError(validator.report())
+
+
+def write_csvs(elements, tables, validate, header=True, compression=None, checker=None, append=False):
+    """Shape each element and write it to the csv file of each (key, path, fields) table
+
+    compression is None, 'gzip' or 'zstd' (see compress.open_output). With
+    append the rows are added to the end of the files.
+    """
+
+    files = []
+    try:
+        writers = {}
+        for key, path, fields in tables:
+            files.append(open_output(path, compression, append))
+            writers[key] = UnicodeRowWriter(files[-1], fields)
+            if header:
+                writers[key].writeheader()
+
+        write_elements(elements, writers, validate, checker)
+    finally:
+        for f in files:
+            f.close()
+
+
+def last_element(elements, last):
+    """Yield elements, keeping [type, id] of the latest one in the list last"""
+    for element in elements:
+        last[:] = [element.tag, element.attrib['id']]
+        yield element
+
+
+def get_chunk_elements(file_in, start, end, tags, backend=BACKEND):
+    """Return the elements of the byte range [start, end) of file_in (see get_chunks)"""
+    if pbf.is_pbf(file_in):
+        return pbf.iter_pbf(file_in, tags, start, end)
+    return get_element(read_chunk(file_in, start, end), tags, backend)
+
+
+def write_chunk(file_in, start, end, tables, tags, validate, backend=BACKEND, compression=None,
+                checker=None, append=False, progress=None):
+    """Shape the elements of one byte range of the osm file and write them to headerless csvs
+
+    Returns the number of elements of each type, the TAG_STATS counts of the
+    range and [type, id] of its last element.
+    """
+    # pool processes run several chunks, so their counters are taken as differences
+    stats = tag_stats()
+    counter = Progress(out=None, interval=None)
+    last = []
+    elements = counter.track(last_element(get_chunk_elements(file_in, start, end, tags, backend), last))
+    if progress is not None:
+        elements = progress.track(elements)
+    write_csvs(elements, tables, validate, header=False, compression=compression, checker=checker, append=append)
+    stats = dict((key, n - stats[key]) for key, n in tag_stats().iteritems())
+    return counter.counts, stats, last or None
+
+
+def process_chunk(args):
+    """Write the elements of one byte range of the osm file to headerless csv shards
+
+    Returns the shard paths, followed by what write_chunk returns.
+    """
+    file_in, start, end, shard_tables, tags, validate, backend = args
+    counts, stats, last = write_chunk(file_in, start, end, shard_tables, tags, validate, backend)
+    return [path for _, path, _ in shard_tables], counts, stats, last
+
+
+def input_chunks(file_in, num_chunks):
+    if pbf.is_pbf(file_in):
+        return pbf.get_chunks(file_in, num_chunks)
+    return get_chunks(file_in, num_chunks)
+
+
+def process_map(file_in, validate, workers=1, relations=False, backend=BACKEND, compression=None,
+                check_refs=False, progress=None, checkpoint=None, resume=False):
+    """Iteratively process each XML element and write to csv(s)
+
+    Relations are only shaped (into three more csvs) when relations is True.
+
+    With workers > 1 the file is split into byte ranges on top level element
+    boundaries and each range is shaped in a separate process. The shards are
+    then concatenated in file order, which gives the same bytes as a serial run.
+    Compressed input (.bz2, .gz, .zst) cannot be split and is always shaped
+    serially, with decompression running in a separate process or thread.
+    PBF input (.pbf) is split into ranges of whole blocks instead (see pbf.py).
+
+    With compression ('gzip' or 'zstd') the csvs are written compressed, with
+    the codec's suffix added to their names.
+
+    With check_refs the way node references are checked against the nodes as
+    the elements go by (see integrity.py), the dangling ones are written to
+    DANGLING_PATH, and the integrity.RefChecker is returned.
+
+    progress, a progress.Progress, is kept up to date with the elements
+    shaped and the input read, and reports as it goes.
+
+    With a checkpoint path the run records its progress there after every
+    CHECKPOINT_BYTES of input, and with resume it carries on from the
+    checkpoint of an interrupted run (see checkpoint.py). Compressed input
+    cannot be checkpointed.
+    """
+
+    tables = [(key, output_path(path, compression), fields)
+              for key, path, fields in CSV_TABLES + (RELATION_CSV_TABLES if relations else [])]
+    # members are streamed apart from their relations, so memory stays flat on huge relations
+    tags = ('node', 'way', 'relation', 'member') if relations else ('node', 'way')
+
+    state = None
+    if checkpoint is not None:
+        if codec_of(file_in):
+            raise CheckpointError('compressed input cannot be checkpointed, decompress it first')
+        options = {'relations': relations, 'compression': compression, 'check_refs': check_refs}
+        if resume:
+            state = load_checkpoint(checkpoint, file_in, options)
+            truncate_outputs(state)
+
+    dangling = None
+    checker = None
+    if check_refs:
+        dangling = open(DANGLING_PATH, 'ab' if state else 'wb')
+        writer = UnicodeRowWriter(dangling, WAY_NODES_FIELDS)
+        checker = RefChecker(writer)
+        if state is None:
+            writer.writeheader()
+        else:
+            restore_checker(checker, state, tables)
+    source = file_in
+    try:
+        if checkpoint is not None:
+            process_checkpointed(file_in, validate, workers, tables, tags, backend, compression,
+                                 checker, dangling, progress, checkpoint, state, options)
+        elif workers <= 1 or codec_of(file_in):
+            if progress is not None:
+                source = progress.open_input(file_in)
+            elements = get_element(source, tags, backend)
+            if progress is not None:
+                elements = progress.track(elements)
+            write_csvs(elements, tables, validate, compression=compression, checker=checker)
+        else:
+            # write just the headers, the shards are appended below
+            write_csvs([], tables, validate, compression=compression)
+            # use several chunks per worker so a slow chunk does not hold up the pool
+            process_shards(file_in, validate, workers, tables, tags, backend, compression, checker, progress,
+                           input_chunks(file_in, workers * 4))
+    finally:
+        if source is not file_in:
+            source.close()
+        if dangling is not None:
+            dangling.close()
+    return checker
+
+
+def restore_checker(checker, state, tables):
+    """Give a RefChecker the nodes and counts of the run that wrote the checkpoint"""
+    nodes_path = [path for key, path, _ in tables if key == 'node'][0]
+    f = open_input(nodes_path)
+    try:
+        lines = read_lines(f)
+        next(lines, None)  # header
+        checker.add_nodes(line[:line.index(',')] for line in lines)
+    finally:
+        f.close()
+    checker.refs, checker.dangling, checker.ways = state['checker']
+    checker.seen_way = state['counts'].get('way', 0) > 0
+
+
+def process_checkpointed(file_in, validate, workers, tables, tags, backend, compression,
+                         checker, dangling, progress, checkpoint, state, options):
+    """The checkpointed part of process_map, state is None for a new run"""
+
+    paths = [path for _, path, _ in tables] + ([DANGLING_PATH] if checker is not None else [])
+    if state is None:
+        size = os.path.getsize(file_in)
+        chunks = input_chunks(file_in, max(workers * 4, -(-size // CHECKPOINT_BYTES)))
+        write_csvs([], tables, validate, compression=compression)
+        if dangling is not None:
+            dangling.flush()
+        state = new_checkpoint(file_in, chunks, options, paths)
+        if checker is not None:
+            state['checker'] = [checker.refs, checker.dangling, checker.ways]
+        save_checkpoint(checkpoint, state)
+    else:
+        for key, n in state['stats'].iteritems():
+            TAG_STATS[key] += n
+    if progress is not None and state['chunks']:
+        progress.total_bytes = os.path.getsize(file_in)
+        progress.add(state['counts'], state['offset'] - state['chunks'][0][0])
+
+    def chunk_done(start, end, counts, stats, last):
+        if dangling is not None:
+            dangling.flush()
+        record_chunk(state, paths, end, last, counts, stats)
+        if checker is not None:
+            state['checker'] = [checker.refs, checker.dangling, checker.ways]
+        save_checkpoint(checkpoint, state)
+
+    chunks = [tuple(chunk) for chunk in state['chunks'][state['done']:]]
+    if workers <= 1:
+        for start, end in chunks:
+            # each range is appended in one go, as a gzip member or zstd frame of its own
+            counts, stats, last = write_chunk(file_in, start, end, tables, tags, validate, backend, compression,
+                                              checker, append=True, progress=progress)
+            if progress is not None:
+                progress.bytes_done += end - start
+            chunk_done(start, end, counts, stats, last)
+    else:
+        process_shards(file_in, validate, workers, tables, tags, backend, compression, checker, progress,
+                       chunks, chunk_done)
+    os.remove(checkpoint)
+
+
+def process_shards(file_in, validate, workers, tables, tags, backend, compression, checker, progress,
+                   chunks, chunk_done=None):
+    """Shape the chunks of file_in in a pool of workers and append them to the csvs in order
+
+    With chunk_done, the csvs are closed after each chunk and then
+    chunk_done(start, end, counts, stats, last) is called.
+    """
+
+    shard_dir = tempfile.mkdtemp(prefix='osm-shards-', dir=os.path.dirname(os.path.abspath(NODES_PATH)))
+    try:
+        tasks = []
+        for i, (start, end) in enumerate(chunks):
+            shard_tables = [(key, os.path.join(shard_dir, '{}.{:05d}'.format(os.path.basename(path), i)), fields)
+                            for key, path, fields in tables]
+            tasks.append((file_in, start, end, shard_tables, tags, validate, backend))
+
+        if progress is not None:
+            progress.total_bytes = os.path.getsize(file_in)
+        pool = multiprocessing.Pool(workers)
+        outputs = []
+        try:
+            if chunk_done is None:
+                outputs = [open_output(path, compression, append=True) for _, path, _ in tables]
+            # imap returns shards in chunk order, so they can be merged as they finish
+            for (start, end), (shard_paths, counts, stats, last) in zip(chunks, pool.imap(process_chunk, tasks)):
+                for key, n in stats.iteritems():
+                    TAG_STATS[key] += n
+                if progress is not None:
+                    progress.add(counts, end - start)
+                if checker is not None:
+                    # shards come in file order too, so the nodes still come before the ways
+                    shards = dict((key, path) for (key, _, _), path in zip(tables, shard_paths))
+                    checker.check_csvs(shards['node'], shards['way_nodes'])
+                if chunk_done is not None:
+                    outputs = [open_output(path, compression, append=True) for _, path, _ in tables]
+                for output, shard_path in zip(outputs, shard_paths):
+                    with open(shard_path, 'rb') as shard:
+                        shutil.copyfileobj(shard, output)
+                    os.remove(shard_path)
+                if chunk_done is not None:
+                    for output in outputs:
+                        output.close()
+                    outputs = []
+                    chunk_done(start, end, counts, stats, last)
+        finally:
+            for output in outputs:
+                output.close()
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(shard_dir)
 
 
 if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
-    process_map(OSM_PATH, validate=False)
+    parser = argparse.ArgumentParser(description='Shape an OSM XML or PBF file into csv files')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    # Note: validation uses the compiled checks in validation.py, which about double
+    # the run time. validate_element (cerberus) is ~ 200X slower than those, only use
+    # it on samples. bench.py measures each stage.
+    parser.add_argument('--validate', action='store_true')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of processes used to shape elements')
+    parser.add_argument('--relations', action='store_true',
+                        help='also write relations, their members and tags')
+    parser.add_argument('--parser', default=BACKEND, choices=sorted(BACKENDS),
+                        help='xml parser backend, see stream.py')
+    parser.add_argument('--compression', choices=OUTPUT_CODECS,
+                        help='write compressed csvs')
+    parser.add_argument('--check-refs', action='store_true',
+                        help='report way nodes missing from the file and write them to ' + DANGLING_PATH)
+    parser.add_argument('--progress', action='store_true', help='report progress to stderr')
+    parser.add_argument('--progress-interval', type=float, default=INTERVAL, metavar='SECONDS')
+    parser.add_argument('--metrics', metavar='FILE', help='append the progress reports to FILE as JSON lines')
+    parser.add_argument('--checkpoint', nargs='?', const=CHECKPOINT_PATH, metavar='FILE',
+                        help='record progress so an interrupted run can be resumed (default file: {})'.format(
+                            CHECKPOINT_PATH))
+    parser.add_argument('--resume', action='store_true',
+                        help='carry on from the checkpoint of an interrupted run, same options required')
+    args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        args.checkpoint = CHECKPOINT_PATH
+
+    progress = None
+    if args.progress or args.metrics:
+        progress = Progress(out=sys.stderr if args.progress else None, metrics_path=args.metrics,
+                            interval=args.progress_interval, stats=tag_stats)
+    try:
+        checker = process_map(args.osm_file, validate=args.validate, workers=args.workers,
+                              relations=args.relations, backend=args.parser, compression=args.compression,
+                              check_refs=args.check_refs, progress=progress, checkpoint=args.checkpoint,
+                              resume=args.resume)
+    except CheckpointError as e:
+        parser.error(str(e))
+    if progress is not None:
+        progress.close()
+    if checker is not None:
+        print checker.report()
@@ -40,4 +40,30 @@ CREATE TABLE ways_nodes (
     position INTEGER NOT NULL,
     FOREIGN KEY (id) REFERENCES ways(id),
     FOREIGN KEY (node_id) REFERENCES nodes(id)
+);
+
+CREATE TABLE relations (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE relation_members (
+    id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    ref INTEGER NOT NULL,
+    role TEXT,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES relations(id)
+);
+
+CREATE TABLE relations_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES relations(id)
 );
\ No newline at end of file
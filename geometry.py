@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Materialize way geometries in the SQLite database after a load.
+
+Rebuilding the shape of a way means joining ways_nodes to nodes and sorting
+by position, for every way and every query. This stage does it once for all
+ways: node ids and coordinates are read into NumPy arrays, the coordinates of
+every way node are gathered in one vectorized lookup, and the length, bounding
+box, closed flag and (for closed ways) area of every way are computed with
+array operations in the same pass. The result is one row per way in the
+way_geometry table, with the coordinates stored as a WKB LineString.
+
+Way nodes missing from the nodes table (outside the exported bounding box)
+are left out of the geometry and counted in the missing column. A way with
+fewer than two of its nodes in the nodes table (none at all, or a single
+one) has no valid LineString and gets no row.
+"""
+
+import argparse
+import sqlite3
+import struct
+
+import numpy as np
+
+from load import DB_PATH
+
+EARTH_RADIUS = 6371008.8  # mean radius in meters
+FETCH_SIZE = 100000
+MIN_POINTS = 2  # fewest points of a valid WKB LineString
+
+GEOMETRY_SQL = """
+CREATE TABLE IF NOT EXISTS way_geometry (
+    id INTEGER PRIMARY KEY NOT NULL,
+    num_nodes INTEGER NOT NULL,
+    missing INTEGER NOT NULL,
+    closed INTEGER NOT NULL,
+    length REAL NOT NULL,
+    area REAL NOT NULL,
+    min_lat REAL,
+    max_lat REAL,
+    min_lon REAL,
+    max_lon REAL,
+    wkb BLOB NOT NULL
+)"""
+
+GEOMETRY_FIELDS = ['id', 'num_nodes', 'missing', 'closed', 'length', 'area',
+                   'min_lat', 'max_lat', 'min_lon', 'max_lon', 'wkb']
+
+# little endian WKB LineString header: byte order, geometry type, number of points
+WKB_LINESTRING = struct.Struct('<BII')
+
+
+def read_columns(cursor, dtypes):
+    """Read a query result into one NumPy array per column, FETCH_SIZE rows at a time"""
+    dtype = np.dtype([('f{}'.format(i), t) for i, t in enumerate(dtypes)])
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=dtype))
+    table = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+    return [table[name] for name in dtype.names]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in meters between arrays of points"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def run_starts(keys):
+    """Index of the first element of each run of equal keys"""
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def way_geometries(node_ids, lats, lons, way_ids, way_node_ids):
+    """Compute the geometry rows of the ways in way_ids/way_node_ids
+
+    node_ids must be sorted, way_ids/way_node_ids ordered by way id and position.
+    Returns a list of rows in GEOMETRY_FIELDS order, one per way with at least
+    MIN_POINTS nodes in node_ids.
+    """
+    if not len(way_ids):
+        return []
+
+    # gather the coordinates of every way node with one binary search
+    idx = np.searchsorted(node_ids, way_node_ids)
+    idx[idx == len(node_ids)] = 0
+    present = node_ids[idx] == way_node_ids if len(node_ids) else np.zeros(len(way_ids), bool)
+
+    # per way over all its nodes: closed flag and the number of missing nodes
+    starts = run_starts(way_ids)
+    ends = np.r_[starts[1:], len(way_ids)] - 1
+    all_ways = way_ids[starts]
+    closed = (way_node_ids[starts] == way_node_ids[ends]) & (ends > starts)
+    missing = np.add.reduceat((~present).astype(np.int64), starts)
+
+    # per way over the nodes that are present
+    ids = way_ids[present]
+    lat = lats[idx[present]]
+    lon = lons[idx[present]]
+    if not len(ids):
+        return []
+    starts = run_starts(ids)
+    counts = np.diff(np.r_[starts, len(ids)])
+    ways = ids[starts]
+    same_way = ids[1:] == ids[:-1]
+
+    length = np.add.reduceat(np.r_[haversine(lat[:-1], lon[:-1], lat[1:], lon[1:]) * same_way, 0.], starts)
+
+    # shoelace area on an equirectangular projection centred on each way's first node
+    scale = np.radians(1) * EARTH_RADIUS
+    lat0 = np.repeat(lat[starts], counts)
+    x = (lon - np.repeat(lon[starts], counts)) * np.cos(np.radians(lat0)) * scale
+    y = (lat - lat0) * scale
+    cross = np.r_[(x[:-1] * y[1:] - x[1:] * y[:-1]) * same_way, 0.]
+    area = np.abs(np.add.reduceat(cross, starts)) / 2
+
+    # line up the flags computed over all way nodes with the ways that have geometry
+    pos = np.searchsorted(all_ways, ways)
+    closed = closed[pos]
+    missing = missing[pos]
+    area[~closed | (missing > 0) | (counts < 4)] = 0.
+
+    min_lat = np.minimum.reduceat(lat, starts)
+    max_lat = np.maximum.reduceat(lat, starts)
+    min_lon = np.minimum.reduceat(lon, starts)
+    max_lon = np.maximum.reduceat(lon, starts)
+
+    # a single point is not a LineString, leave those ways out
+    keep = counts >= MIN_POINTS
+    ways, starts, counts, missing, closed, length, area, min_lat, max_lat, min_lon, max_lon = [
+        column[keep] for column in
+        (ways, starts, counts, missing, closed, length, area, min_lat, max_lat, min_lon, max_lon)]
+
+    coords = np.column_stack([lon, lat]).astype('<f8')
+    wkb = [WKB_LINESTRING.pack(1, 2, n) + coords[s:s + n].tobytes()
+           for s, n in zip(starts.tolist(), counts.tolist())]
+
+    return zip(ways.tolist(), counts.tolist(), missing.tolist(), closed.astype(int).tolist(),
+               length.tolist(), area.tolist(), min_lat.tolist(), max_lat.tolist(),
+               min_lon.tolist(), max_lon.tolist(), map(buffer, wkb))
+
+
+def build_way_geometry(con, way_ids=None):
+    """Compute the way_geometry rows of all ways, or only of the ways in way_ids
+
+    Does not commit, so it can be part of a larger transaction.
+    """
+
+    con.execute(GEOMETRY_SQL)
+    if way_ids is None:
+        con.execute('DELETE FROM way_geometry')
+        nodes_sql = 'SELECT id, lat, lon FROM nodes ORDER BY id'
+        ways_nodes_sql = 'SELECT id, node_id FROM ways_nodes ORDER BY id, position'
+    else:
+        con.execute('CREATE TEMP TABLE IF NOT EXISTS geometry_ways (id INTEGER PRIMARY KEY)')
+        con.execute('DELETE FROM geometry_ways')
+        con.executemany('INSERT OR IGNORE INTO geometry_ways VALUES (?)', ((id_,) for id_ in way_ids))
+        con.execute('DELETE FROM way_geometry WHERE id IN (SELECT id FROM geometry_ways)')
+        nodes_sql = """SELECT id, lat, lon FROM nodes WHERE id IN
+                           (SELECT node_id FROM ways_nodes WHERE id IN (SELECT id FROM geometry_ways))
+                       ORDER BY id"""
+        ways_nodes_sql = """SELECT id, node_id FROM ways_nodes
+                            WHERE id IN (SELECT id FROM geometry_ways)
+                            ORDER BY id, position"""
+
+    node_ids, lats, lons = read_columns(con.execute(nodes_sql), [np.int64, np.float64, np.float64])
+    way_ids, way_node_ids = read_columns(con.execute(ways_nodes_sql), [np.int64, np.int64])
+
+    rows = way_geometries(node_ids, lats, lons, way_ids, way_node_ids)
+    con.executemany('INSERT INTO way_geometry VALUES ({})'.format(', '.join('?' * len(GEOMETRY_FIELDS))), rows)
+    return len(rows)
+
+
+def decode_wkb(blob):
+    """Return the (lon, lat) points of a WKB LineString from way_geometry"""
+    _, _, n = WKB_LINESTRING.unpack_from(blob)
+    return np.frombuffer(blob, dtype='<f8', count=2 * n, offset=WKB_LINESTRING.size).reshape(n, 2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the way_geometry table of a loaded database')
+    parser.add_argument('--db', default=DB_PATH)
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.db)
+    try:
+        print '{} way geometries'.format(build_way_geometry(con))
+        con.commit()
+    finally:
+        con.close()
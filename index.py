@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+On-disk index of the top level elements of an OSM XML file.
+
+Finding one element by id used to mean parsing the whole file up to it. The
+index maps (type, id) to the byte offset and length of the element in the
+file, so a lookup is one seek and parsing a few hundred bytes:
+
+    import index
+    print ET.tostring(index.get_specific_element('manhattan_new-york.osm', '265347580', ('way',)))
+
+The index is a small SQLite file next to the osm file (<osm file>.idx). It is
+built in one expat pass on first use, and rebuilt whenever the size or the
+modification time of the osm file no longer match the ones it was built from.
+"""
+
+import argparse
+import os
+import sqlite3
+import xml.etree.cElementTree as ET
+
+from compress import codec_of, open_input, read_all
+from stream import iter_expat, TOP_LEVEL_TAGS
+
+OSM_PATH = "manhattan_new-york.osm"
+INDEX_SUFFIX = '.idx'
+BATCH_SIZE = 10000
+
+INDEX_SQL = [
+    'CREATE TABLE source (path TEXT, size INTEGER, mtime REAL)',
+    """CREATE TABLE elements (
+        type TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        PRIMARY KEY (type, id)
+    ) WITHOUT ROWID""",
+]
+
+
+def index_path(osm_file):
+    return osm_file + INDEX_SUFFIX
+
+
+def scan_elements(osm_file):
+    """Yield (type, id, offset, length) for each top level element of osm_file, in file order"""
+    for elem, offset, length in iter_expat(osm_file, spans=True):
+        yield elem.tag, int(elem.attrib['id']), offset, length
+
+
+def source_stat(osm_file):
+    st = os.stat(osm_file)
+    return st.st_size, st.st_mtime
+
+
+def build_index(osm_file, path=None):
+    """(Re)build the index of osm_file, return the number of elements indexed"""
+    path = path or index_path(osm_file)
+    size, mtime = source_stat(osm_file)
+    # build into a new file and swap it in, so readers never see half an index
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    con = sqlite3.connect(tmp_path)
+    try:
+        con.execute('PRAGMA journal_mode = OFF')
+        con.execute('PRAGMA synchronous = OFF')
+        for sql in INDEX_SQL:
+            con.execute(sql)
+        n = 0
+        rows = scan_elements(osm_file)
+        while True:
+            batch = [row for _, row in zip(xrange(BATCH_SIZE), rows)]
+            if not batch:
+                break
+            # OR IGNORE keeps the first element, like a linear scan would find it
+            con.executemany('INSERT OR IGNORE INTO elements VALUES (?, ?, ?, ?)', batch)
+            n += len(batch)
+        con.execute('INSERT INTO source VALUES (?, ?, ?)', (os.path.abspath(osm_file), size, mtime))
+        con.commit()
+    finally:
+        con.close()
+    os.rename(tmp_path, path)
+    return n
+
+
+def is_current(osm_file, path=None):
+    """Return True if the index of osm_file exists and was built from its current contents"""
+    path = path or index_path(osm_file)
+    if not os.path.exists(path):
+        return False
+    con = sqlite3.connect(path)
+    try:
+        row = con.execute('SELECT size, mtime FROM source').fetchone()
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        con.close()
+    return row is not None and tuple(row) == source_stat(osm_file)
+
+
+def open_index(osm_file, path=None):
+    """Return a connection to the index of osm_file, (re)building it first if needed"""
+    path = path or index_path(osm_file)
+    if not is_current(osm_file, path):
+        build_index(osm_file, path)
+    return sqlite3.connect(path)
+
+
+def find(con, id_, tags=TOP_LEVEL_TAGS):
+    """Return (type, offset, length) of the first element of one of the types in tags with this id"""
+    for tag in tags:
+        row = con.execute('SELECT offset, length FROM elements WHERE type = ? AND id = ?',
+                          (tag, int(id_))).fetchone()
+        if row:
+            return (tag,) + tuple(row)
+    return None
+
+
+def read_element(osm_file, offset, length):
+    """Parse the element stored at [offset, offset + length) of osm_file
+
+    Offsets of a compressed file are into its decompressed contents, which
+    have to be read up to offset: lookups are only fast in plain files.
+    """
+    f = open_input(osm_file)
+    try:
+        if codec_of(osm_file):
+            read_all(f, offset)
+        else:
+            f.seek(offset)
+        return ET.fromstring(f.read(length))
+    finally:
+        f.close()
+
+
+def get_specific_element(osm_file, id_, tags=TOP_LEVEL_TAGS, con=None):
+    """Return the first element of one of the types in tags with this id, or None
+
+    Pass a connection from open_index to skip the freshness check when doing many lookups.
+    """
+    own_con = con is None
+    if own_con:
+        con = open_index(osm_file)
+    try:
+        found = find(con, id_, tags)
+    finally:
+        if own_con:
+            con.close()
+    if found is None:
+        return None
+    _, offset, length = found
+    return read_element(osm_file, offset, length)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index an OSM XML file and look up elements by id')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    parser.add_argument('ids', nargs='*', help='ids to print, optionally prefixed with the type (way/265347580)')
+    parser.add_argument('--rebuild', action='store_true')
+    args = parser.parse_args()
+
+    if args.rebuild or not is_current(args.osm_file):
+        print '{} elements indexed'.format(build_index(args.osm_file))
+    for id_ in args.ids:
+        tags = TOP_LEVEL_TAGS
+        if '/' in id_:
+            tag, id_ = id_.split('/')
+            tags = (tag,)
+        elem = get_specific_element(args.osm_file, id_, tags)
+        print ET.tostring(elem, encoding='utf-8') if elem is not None else '{}: not found'.format(id_)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming check of the way_nodes -> nodes references.
+
+data_wrangling_schema.sql declares ways_nodes.node_id a foreign key of
+nodes.id, but a bounding box export (node(...);<;) has ways that use nodes
+outside the box, which only shows up after the import. RefChecker finds
+them while the file is shaped: the ids of the nodes are recorded in an IdSet
+(at most ~ 2 bytes per id, see idset.py) and the nd refs of each way are
+looked up as it arrives, since osm files have all their nodes first. The
+dangling references are counted and can be written to a csv with the
+columns of ways_nodes.csv.
+
+data.process_map runs the check with --check-refs. Running this file checks
+an osm file without writing any csv.
+"""
+
+import argparse
+import time
+
+from idset import IdSet
+
+OSM_PATH = "manhattan_new-york.osm"
+DANGLING_PATH = "ways_nodes_dangling.csv"
+
+
+class RefChecker(object):
+    """Record node ids and check way node references against them
+
+    writer, if given, gets every dangling way_nodes row in ROW_FIELDS order.
+    """
+
+    def __init__(self, writer=None):
+        self.nodes = IdSet()
+        self.writer = writer
+        self.refs = 0
+        self.dangling = 0
+        self.ways = 0  # ways with at least one dangling reference
+        # set when a node comes after a way, which makes the earlier misses unreliable
+        self.unsorted = False
+        self.seen_way = False
+
+    def add_nodes(self, ids):
+        count = len(self.nodes)
+        self.nodes.update(ids)
+        if self.seen_way and len(self.nodes) > count:
+            self.unsorted = True
+
+    def check_way_nodes(self, rows):
+        """Check the way_nodes rows of one way"""
+        self.seen_way = True
+        self.refs += len(rows)
+        missing = self.nodes.missing([row[1] for row in rows])
+        if missing:
+            if len(missing) < len(rows):
+                missing = set(missing)
+                rows = [row for row in rows if row[1] in missing]
+            self.dangling += len(rows)
+            self.ways += 1
+            if self.writer is not None:
+                self.writer.writerows(rows)
+
+    def check(self, rows):
+        """Check the shape_rows output of one element"""
+        if 'node' in rows:
+            self.add_nodes([rows['node'][0][0]])
+        elif 'way_nodes' in rows:
+            self.check_way_nodes(rows['way_nodes'])
+
+    def check_csvs(self, nodes_path, way_nodes_path):
+        """Check headerless nodes and ways_nodes csvs, such as the shards of data.process_map"""
+        with open(nodes_path, 'rb') as f:
+            self.add_nodes(line[:line.index(',')] for line in f)
+        way_id, rows = None, []
+        with open(way_nodes_path, 'rb') as f:
+            for line in f:
+                row = line.rstrip('\r\n').split(',')
+                if row[0] != way_id:
+                    if rows:
+                        self.check_way_nodes(rows)
+                    way_id, rows = row[0], []
+                rows.append(row)
+        if rows:
+            self.check_way_nodes(rows)
+
+    def report(self):
+        lines = ['{} of {} way node references ({} ways) point to nodes not in the file'.format(
+                     self.dangling, self.refs, self.ways),
+                 '{} node ids recorded in {:.1f} MB'.format(len(self.nodes), self.nodes.nbytes() / 1e6)]
+        if self.unsorted:
+            lines.append('nodes come after ways in the file, some of these nodes may be further on')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from data import get_element, UnicodeRowWriter, WAY_NODES_FIELDS
+
+    parser = argparse.ArgumentParser(description='Check the way node references of an osm file')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    parser.add_argument('--dangling', metavar='CSV', help='write the dangling references to this csv')
+    args = parser.parse_args()
+
+    start = time.time()
+    f = open(args.dangling, 'wb') if args.dangling else None
+    try:
+        writer = None
+        if f is not None:
+            writer = UnicodeRowWriter(f, WAY_NODES_FIELDS)
+            writer.writeheader()
+        checker = RefChecker(writer)
+        for element in get_element(args.osm_file, ('node', 'way')):
+            id_ = element.attrib['id']
+            if element.tag == 'node':
+                checker.add_nodes([id_])
+            else:
+                checker.check_way_nodes([(id_, nd.attrib['ref'], i) for i, nd in enumerate(element.iter('nd'))])
+    finally:
+        if f is not None:
+            f.close()
+    print checker.report()
+    print 'checked in {:.2f} s'.format(time.time() - start)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Load an OSM XML file straight into the SQLite database used by query.py.
+
+data.py writes five csv files that then have to be imported into the tables
+of data_wrangling_schema.sql by hand. This module skips that step: elements
+are shaped with data.shape_rows as they are parsed and inserted with
+batched executemany calls inside large transactions.
+
+The tables are those of typed_schema.sql rather than data_wrangling_schema.sql:
+ids, uids, versions and changesets are stored as integers, timestamps as
+seconds since the epoch and coordinates as fixed point integers (lat_e7,
+lon_e7, in 1e-7 degrees), with lat and lon computed from them when read.
+User names go into a users table keyed by uid instead of being repeated on
+every node and way; a uid keeps the name of its most recent edit.
+
+The connection is tuned for a one-off bulk load (no rollback journal, no
+fsync), so an interrupted load leaves a database that should be thrown away
+and rebuilt. Secondary indexes are created once all rows are in, and foreign
+keys are only checked at the end, since SQLite cannot add them to an existing
+table. Dangling references (e.g. way nodes outside the exported bounding box)
+are reported rather than rejected, just as they would be after a csv import.
+Finally R*Tree indexes over node coordinates and way bounding boxes are built
+for the spatial helpers in query.py, optionally the way_geometry table of
+geometry.py, and the summary tables of summary.py read by the report queries.
+"""
+
+import argparse
+import calendar
+import os
+import sqlite3
+from collections import defaultdict
+
+from data import get_element, shape_rows, rows_to_element, NODE_FIELDS, WAY_FIELDS, RELATION_FIELDS
+from summary import build_summaries
+from validation import CompiledValidator, ValidationError
+
+OSM_PATH = "manhattan_new-york.osm"
+DB_PATH = "opensm-manhattan.db"
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "typed_schema.sql")
+
+BATCH_SIZE = 10000          # rows per executemany call
+TRANSACTION_SIZE = 500000   # rows per commit
+
+
+def fixed_point(coordinate):
+    """Return a decimal coordinate string in 1e-7 degrees, without going through a float
+
+    Digits past the 7th decimal round half away from zero, on the exact decimal value.
+
+    >>> fixed_point('40.7580'), fixed_point('-73.98551234')
+    (407580000, -739855123)
+    >>> fixed_point('40.75801235'), fixed_point('-73.98551235'), fixed_point('-0.00000005')
+    (407580124, -739855124, -1)
+    """
+    whole, _, fraction = coordinate.partition('.')
+    value = int(whole + (fraction + '0000000')[:7])
+    if fraction[7:8] >= '5':
+        value += -1 if whole.startswith('-') else 1
+    return value
+
+
+# seconds since the epoch of each day seen by epoch, edits cluster on few days
+DAYS = {}
+
+
+def epoch(timestamp):
+    """Return an ISO 8601 UTC timestamp (2016-07-01T19:29:52Z) in seconds since the epoch"""
+    day = timestamp[:10]
+    seconds = DAYS.get(day)
+    if seconds is None:
+        seconds = DAYS[day] = calendar.timegm((int(day[0:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+    return seconds + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+
+
+# convert the rows of shape_rows (text, in ROW_FIELDS order) to the columns of TABLES
+def node_row(row):
+    id_, lat, lon, user, uid, version, changeset, timestamp = row
+    return int(id_), fixed_point(lat), fixed_point(lon), int(uid), int(version), int(changeset), epoch(timestamp)
+
+
+def element_row(row):
+    id_, user, uid, version, changeset, timestamp = row
+    return int(id_), int(uid), int(version), int(changeset), epoch(timestamp)
+
+
+def tag_row(row):
+    # keys with problematic characters have no key and type, stored as '' as in the csv files
+    id_, key, value, type_ = row
+    return int(id_), '' if key is None else key, value, '' if type_ is None else type_
+
+
+def way_node_row(row):
+    id_, node_id, position = row
+    return int(id_), int(node_id), position
+
+
+def member_row(row):
+    id_, type_, ref, role, position = row
+    return int(id_), type_, int(ref), role, position
+
+
+# (table, key in the shape_rows output, columns, row conversion)
+TABLES = [
+    ('nodes', 'node', ['id', 'lat_e7', 'lon_e7', 'uid', 'version', 'changeset', 'timestamp'], node_row),
+    ('nodes_tags', 'node_tags', ['id', 'key', 'value', 'type'], tag_row),
+    ('ways', 'way', ['id', 'uid', 'version', 'changeset', 'timestamp'], element_row),
+    ('ways_nodes', 'way_nodes', ['id', 'node_id', 'position'], way_node_row),
+    ('ways_tags', 'way_tags', ['id', 'key', 'value', 'type'], tag_row),
+    ('relations', 'relation', ['id', 'uid', 'version', 'changeset', 'timestamp'], element_row),
+    ('relation_members', 'relation_members', ['id', 'type', 'ref', 'role', 'position'], member_row),
+    ('relations_tags', 'relation_tags', ['id', 'key', 'value', 'type'], tag_row),
+]
+
+# shape_rows key of an element -> positions of uid, user and timestamp in its row
+USER_COLUMNS = dict((key, (fields.index('uid'), fields.index('user'), fields.index('timestamp')))
+                    for key, fields in [('node', NODE_FIELDS), ('way', WAY_FIELDS), ('relation', RELATION_FIELDS)])
+
+
+def record_user(users, key, row):
+    """Remember the user name of the element row, if it is the most recent edit of its uid seen so far"""
+    uid_column, user_column, timestamp_column = USER_COLUMNS[key]
+    uid, timestamp = row[uid_column], row[timestamp_column]
+    # ISO timestamps sort like the times they stand for
+    if uid not in users or timestamp >= users[uid][0]:
+        users[uid] = (timestamp, row[user_column])
+
+
+def insert_users(con, users):
+    con.executemany('INSERT OR REPLACE INTO users (uid, user) VALUES (?, ?)',
+                    [(int(uid), user) for uid, (_, user) in users.iteritems()])
+
+
+# rollback journal and fsync are pointless while building a database from scratch
+BULK_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA foreign_keys = OFF',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -262144',  # 256 MB
+]
+
+# indexes on the foreign key columns, built once the tables are filled. The
+# tag indexes cover key and value too, so the report queries of query.py
+# never read the tag tables themselves
+POST_LOAD_SQL = [
+    'CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags (id, key, value)',
+    'CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags (id, key, value)',
+    'CREATE INDEX IF NOT EXISTS nodes_tags_key_value ON nodes_tags (key, value, id)',
+    'CREATE INDEX IF NOT EXISTS ways_tags_key_value ON ways_tags (key, value, id)',
+    # the bike rack queries look for a value under any key
+    'CREATE INDEX IF NOT EXISTS nodes_tags_value ON nodes_tags (value, id)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_id ON ways_nodes (id)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes (node_id)',
+    'CREATE INDEX IF NOT EXISTS relation_members_id ON relation_members (id)',
+    'CREATE INDEX IF NOT EXISTS relations_tags_id ON relations_tags (id)',
+    'ANALYZE',
+]
+
+
+# R*Tree indexes over node coordinates and way bounding boxes. rtree stores
+# 32 bit floats rounded outwards, so lookups recheck the exact nodes.lat/lon.
+SPATIAL_INDEX_SQL = [
+    'DROP TABLE IF EXISTS nodes_rtree',
+    'CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)',
+    'INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes WHERE lat IS NOT NULL',
+    'DROP TABLE IF EXISTS ways_rtree',
+    'CREATE VIRTUAL TABLE ways_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)',
+    # ways with nodes outside the export are bounded by the nodes that are present
+    """INSERT INTO ways_rtree
+       SELECT ways_nodes.id, min(lat), max(lat), min(lon), max(lon)
+       FROM ways_nodes JOIN nodes ON nodes.id = ways_nodes.node_id
+       GROUP BY ways_nodes.id""",
+]
+
+
+def insert_sql(table, fields):
+    return 'INSERT INTO {} ({}) VALUES ({})'.format(
+        table, ', '.join('"{}"'.format(f) for f in fields), ', '.join('?' * len(fields)))
+
+
+def create_tables(con, schema_path=SCHEMA_PATH):
+    """Create the tables of typed_schema.sql"""
+    with open(schema_path) as f:
+        con.executescript(f.read())
+
+
+def load_elements(con, elements, validate=False, batch_size=BATCH_SIZE,
+                  transaction_size=TRANSACTION_SIZE):
+    """Shape each element and insert the rows in batches, return the number of rows per table"""
+
+    inserts = [(table, key, convert, insert_sql(table, columns)) for table, key, columns, convert in TABLES]
+    batches = dict((table, []) for table, _, _, _ in TABLES)
+    counts = defaultdict(int)
+    validator = CompiledValidator()
+    users = {}
+    uncommitted = 0
+
+    for element in elements:
+        shaped = shape_rows(element)
+        if not shaped:
+            continue
+        if validate is True and not validator.validate(rows_to_element(shaped)):
+            if validator.failed >= validator.max_errors:
+                raise ValidationError(validator.report())
+
+        if element.tag in USER_COLUMNS:
+            record_user(users, element.tag, shaped[element.tag][0])
+        for table, key, convert, sql in inserts:
+            if key not in shaped:
+                continue
+            batch = batches[table]
+            batch.extend(convert(row) for row in shaped[key])
+            if len(batch) >= batch_size:
+                con.executemany(sql, batch)
+                counts[table] += len(batch)
+                uncommitted += len(batch)
+                del batch[:]
+
+        if uncommitted >= transaction_size:
+            con.commit()
+            uncommitted = 0
+
+    for table, _, _, sql in inserts:
+        batch = batches[table]
+        if batch:
+            con.executemany(sql, batch)
+            counts[table] += len(batch)
+    insert_users(con, users)
+    counts['users'] = len(users)
+    con.commit()
+
+    if validator.failed:
+        raise ValidationError(validator.report())
+    return dict(counts)
+
+
+def finish_load(con):
+    """Build the indexes, switch foreign keys on and count rows that violate them"""
+    for sql in POST_LOAD_SQL:
+        con.execute(sql)
+    con.commit()
+
+    con.execute('PRAGMA foreign_keys = ON')
+    violations = defaultdict(int)
+    for table, _, parent, _ in con.execute('PRAGMA foreign_key_check'):
+        violations[(table, parent)] += 1
+    return dict(violations)
+
+
+def build_spatial_index(con):
+    """(Re)build the R*Tree indexes over nodes and way bounding boxes"""
+    for sql in SPATIAL_INDEX_SQL:
+        con.execute(sql)
+    con.commit()
+
+
+def load_map(file_in, db_path=DB_PATH, validate=False, relations=False, spatial=True,
+             geometry=False, summaries=True, replace=False):
+    """Parse file_in and load it into a new SQLite database at db_path
+
+    The relation tables are always created but only filled when relations is True.
+    An existing file at db_path is an IOError, checked before parsing starts,
+    unless replace is True, in which case it is deleted.
+    """
+
+    if os.path.exists(db_path):
+        if not replace:
+            raise IOError('{} already exists, remove it or load with replace'.format(db_path))
+        os.remove(db_path)
+    con = sqlite3.connect(db_path)
+    try:
+        for pragma in BULK_PRAGMAS:
+            con.execute(pragma)
+        create_tables(con)
+        tags = ('node', 'way', 'relation', 'member') if relations else ('node', 'way')
+        counts = load_elements(con, get_element(file_in, tags=tags), validate)
+        violations = finish_load(con)
+        if spatial:
+            build_spatial_index(con)
+        if geometry:
+            # needs numpy, only imported when asked for
+            from geometry import build_way_geometry
+            build_way_geometry(con)
+            con.commit()
+        if summaries:
+            build_summaries(con)
+            con.commit()
+    finally:
+        con.close()
+    return counts, violations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load an OSM XML file into a new SQLite database')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    parser.add_argument('--db', default=DB_PATH, help='database file to create')
+    parser.add_argument('--validate', action='store_true')
+    parser.add_argument('--relations', action='store_true',
+                        help='also load relations, their members and tags')
+    parser.add_argument('--no-spatial', dest='spatial', action='store_false',
+                        help='skip the R*Tree indexes used by the query.py spatial helpers')
+    parser.add_argument('--geometry', action='store_true',
+                        help='also build the way_geometry table (requires numpy)')
+    parser.add_argument('--no-summaries', dest='summaries', action='store_false',
+                        help='skip the summary tables read by the query.py report queries')
+    parser.add_argument('--replace', action='store_true', help='delete the database file if it exists')
+    args = parser.parse_args()
+    if os.path.exists(args.db) and not args.replace:
+        parser.error('{} already exists, remove it or use --replace'.format(args.db))
+
+    counts, violations = load_map(args.osm_file, args.db, validate=args.validate,
+                                  relations=args.relations, spatial=args.spatial,
+                                  geometry=args.geometry, summaries=args.summaries, replace=args.replace)
+    for table in ['users'] + [table for table, _, _, _ in TABLES]:
+        print '{:<18}{:>10} rows'.format(table, counts.get(table, 0))
+    for (table, parent), n in sorted(violations.items()):
+        print '{} rows in {} reference a missing {} row'.format(n, table, parent)
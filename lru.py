@@ -0,0 +1,82 @@
+"""
+Small bounded caches for values that repeat heavily in an OSM extract
+(tag keys, street names, postcodes).
+"""
+
+import itertools
+
+
+class LRUCache(object):
+    """Mapping of at most maxsize entries that evicts the least recently used ones
+
+    Keeps hit and miss counters so the cache size can be checked against a real run.
+
+    A hit only stamps the entry with a use counter, which keeps lookups far cheaper
+    than reordering an OrderedDict. When the cache overflows, the least recently
+    used quarter is evicted in one go.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = {}
+        self.clock = itertools.count()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        entry[1] = next(self.clock)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        self.data[key] = [value, next(self.clock)]
+        if len(self.data) > self.maxsize:
+            self.evict(len(self.data) - self.maxsize + self.maxsize // 4)
+
+    def evict(self, n):
+        """Drop the n least recently used entries"""
+        oldest = sorted(self.data.iteritems(), key=lambda item: item[1][1])[:n]
+        for key, _ in oldest:
+            del self.data[key]
+
+    def memoize(self, func):
+        """Wrap a one argument function so its results are served from this cache"""
+        data = self.data
+        clock = self.clock
+
+        def cached(key):
+            # same as get/put, inlined since this sits on the per-tag path
+            entry = data.get(key)
+            if entry is not None:
+                entry[1] = next(clock)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            value = func(key)
+            self.put(key, value)
+            return value
+        cached.cache = self
+        return cached
+
+    def clear(self):
+        # clear in place, memoized functions hold a reference to self.data
+        self.data.clear()
+        self.hits = self.misses = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data),
+                'maxsize': self.maxsize, 'hit_rate': self.hit_rate()}
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Apply an OpenStreetMap change file (.osc) to the SQLite database built by
+load.py, instead of re-importing a whole new export.
+
+An osmChange document groups elements in <create>, <modify> and <delete>
+blocks. Created and modified elements are shaped with data.shape_rows and
+replace the stored element with all its tags, way nodes or members. They are
+stored typed, with their user in the users table, in databases built by
+load.py, and as text in databases imported from the csv files of data.py. Deleted
+elements are removed with their child rows. Every change is keyed by id and
+version: a change whose version is not newer than the stored one is skipped,
+so applying the same diff twice, or an older one, does nothing.
+
+The R*Tree indexes and way_geometry table built by load.py are kept in step
+with the changes, and the summary tables of summary.py are rebuilt, if the
+database has them. The whole file is applied in one
+transaction.
+"""
+
+import argparse
+import sqlite3
+import xml.etree.cElementTree as ET
+from collections import defaultdict
+
+from data import shape_element, shape_rows, TOP_LEVEL_TAGS, \
+    NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS, \
+    RELATION_FIELDS, RELATION_MEMBERS_FIELDS, RELATION_TAGS_FIELDS
+from load import DB_PATH, TABLES, POST_LOAD_SQL, insert_sql, record_user, insert_users
+from summary import build_summaries, has_summaries
+
+OSC_PATH = "manhattan_new-york.osc"
+
+ACTIONS = ('create', 'modify', 'delete')
+
+# element type -> main table, then the tables holding its child rows
+ELEMENT_TABLES = {
+    'node': ('nodes', ['nodes_tags']),
+    'way': ('ways', ['ways_nodes', 'ways_tags']),
+    'relation': ('relations', ['relation_members', 'relations_tags']),
+}
+
+# (table, key in the shape_element output, columns) of data_wrangling_schema.sql
+TEXT_TABLES = [
+    ('nodes', 'node', NODE_FIELDS),
+    ('nodes_tags', 'node_tags', NODE_TAGS_FIELDS),
+    ('ways', 'way', WAY_FIELDS),
+    ('ways_nodes', 'way_nodes', WAY_NODES_FIELDS),
+    ('ways_tags', 'way_tags', WAY_TAGS_FIELDS),
+    ('relations', 'relation', RELATION_FIELDS),
+    ('relation_members', 'relation_members', RELATION_MEMBERS_FIELDS),
+    ('relations_tags', 'relation_tags', RELATION_TAGS_FIELDS),
+]
+
+
+def get_changes(osc_file):
+    """Yield (action, element) for each element of an osmChange file"""
+
+    action = block = None
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ACTIONS:
+                action, block = elem.tag, elem
+        elif elem.tag in TOP_LEVEL_TAGS and block is not None:
+            yield action, elem
+            block.clear()
+        elif elem.tag in ACTIONS:
+            root.clear()
+
+
+def existing_tables(con):
+    return set(name for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+
+
+class ChangeApplier(object):
+    """Apply shaped creates, modifies and deletes to the tables of typed_schema.sql or data_wrangling_schema.sql"""
+
+    def __init__(self, con):
+        self.con = con
+        tables = existing_tables(con)
+        # load.py databases have a users table, csv imports keep everything as text
+        self.typed = 'users' in tables
+        if self.typed:
+            self.inserts = dict((key, (convert, insert_sql(table, columns)))
+                                for table, key, columns, convert in TABLES if table in tables)
+        else:
+            self.inserts = dict((key, (fields, insert_sql(table, fields)))
+                                for table, key, fields in TEXT_TABLES if table in tables)
+        # databases imported from the csvs may not have the relation tables
+        self.element_tables = dict((tag, tables_) for tag, tables_ in ELEMENT_TABLES.items()
+                                   if tables_[0] in tables)
+        # keep the R*Tree indexes of load.build_spatial_index in step, if present
+        self.spatial = 'nodes_rtree' in tables and 'ways_rtree' in tables
+        # and the way_geometry table of geometry.py
+        self.geometry = 'way_geometry' in tables
+        self.dirty_ways = set()
+        self.counts = defaultdict(int)
+
+    def stored_version(self, tag, id_):
+        table, _ = self.element_tables[tag]
+        row = self.con.execute('SELECT version FROM {} WHERE id = ?'.format(table), (id_,)).fetchone()
+        return int(row[0]) if row and row[0] not in (None, '') else None
+
+    def delete(self, tag, id_):
+        table, child_tables = self.element_tables[tag]
+        for child in child_tables:
+            self.con.execute('DELETE FROM {} WHERE id = ?'.format(child), (id_,))
+        self.con.execute('DELETE FROM {} WHERE id = ?'.format(table), (id_,))
+
+    def apply(self, action, element):
+        """Apply one change, return False if it was skipped"""
+        tag = element.tag
+        if tag not in self.element_tables:
+            self.counts[(action, tag, 'unsupported')] += 1
+            return False
+
+        id_ = int(element.attrib['id'])
+        stored = self.stored_version(tag, id_)
+        if stored is None and action == 'delete':
+            self.counts[(action, tag, 'missing')] += 1
+            return False
+        if stored is not None and stored >= int(element.attrib['version']):
+            self.counts[(action, tag, 'skipped')] += 1
+            return False
+
+        # a modify replaces the element with all its child rows
+        self.delete(tag, id_)
+        if action != 'delete':
+            self.insert(element)
+        if self.spatial:
+            self.update_spatial(action, element, id_)
+        if self.spatial or self.geometry:
+            self.mark_dirty_ways(element, id_)
+        self.counts[(action, tag, 'applied')] += 1
+        return True
+
+    def insert(self, element):
+        if self.typed:
+            users = {}
+            shaped = shape_rows(element)
+            record_user(users, element.tag, shaped[element.tag][0])
+            insert_users(self.con, users)
+            for key, rows in shaped.iteritems():
+                convert, sql = self.inserts[key]
+                self.con.executemany(sql, [convert(row) for row in rows])
+        else:
+            for key, rows in shape_element(element).iteritems():
+                fields, sql = self.inserts[key]
+                if isinstance(rows, dict):
+                    rows = [rows]
+                self.con.executemany(sql, [tuple(row.get(f, '') for f in fields) for row in rows])
+
+    def update_spatial(self, action, element, id_):
+        if element.tag == 'node':
+            self.con.execute('DELETE FROM nodes_rtree WHERE id = ?', (id_,))
+            if action != 'delete':
+                lat, lon = float(element.attrib['lat']), float(element.attrib['lon'])
+                self.con.execute('INSERT INTO nodes_rtree VALUES (?, ?, ?, ?, ?)', (id_, lat, lat, lon, lon))
+
+    def mark_dirty_ways(self, element, id_):
+        if element.tag == 'node':
+            # a moved node changes the shape of every way it is part of
+            self.dirty_ways.update(way_id for way_id, in self.con.execute(
+                'SELECT id FROM ways_nodes WHERE node_id = ?', (id_,)))
+        elif element.tag == 'way':
+            self.dirty_ways.add(id_)
+
+    def refresh_ways(self):
+        """Recompute the bounding boxes and geometries of the ways touched by the applied changes"""
+        if self.geometry and self.dirty_ways:
+            # needs numpy, only imported when the database has the table
+            from geometry import build_way_geometry
+            build_way_geometry(self.con, self.dirty_ways)
+        for way_id in (self.dirty_ways if self.spatial else ()):
+            self.con.execute('DELETE FROM ways_rtree WHERE id = ?', (way_id,))
+            self.con.execute("""INSERT INTO ways_rtree
+                                SELECT ways_nodes.id, min(lat), max(lat), min(lon), max(lon)
+                                FROM ways_nodes JOIN nodes ON nodes.id = ways_nodes.node_id
+                                WHERE ways_nodes.id = ?
+                                GROUP BY ways_nodes.id""", (way_id,))
+        self.dirty_ways.clear()
+
+
+def apply_changes(osc_file, db_path=DB_PATH):
+    """Apply every change in osc_file to the database, return counts per (action, type, outcome)"""
+
+    con = sqlite3.connect(db_path)
+    try:
+        # deleting child rows by id needs the id indexes, which a csv import lacks
+        tables = existing_tables(con)
+        for sql in POST_LOAD_SQL:
+            if sql.startswith('CREATE INDEX') and sql.split(' ON ')[1].split()[0] in tables:
+                con.execute(sql)
+
+        applier = ChangeApplier(con)
+        for action, element in get_changes(osc_file):
+            applier.apply(action, element)
+        applier.refresh_ways()
+        if has_summaries(tables):
+            build_summaries(con)
+        con.commit()
+    except:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+    return dict(applier.counts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply an osmChange file to the SQLite database')
+    parser.add_argument('osc_file', nargs='?', default=OSC_PATH)
+    parser.add_argument('--db', default=DB_PATH)
+    args = parser.parse_args()
+
+    for (action, tag, outcome), n in sorted(apply_changes(args.osc_file, args.db).items()):
+        print '{:<8}{:<10}{:<13}{:>8}'.format(action, tag, outcome, n)
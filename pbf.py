@@ -0,0 +1,759 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Read OSM PBF files (https://wiki.openstreetmap.org/wiki/PBF_Format).
+
+A PBF extract is several times smaller than the same data as XML, and reading
+it skips XML parsing altogether. iter_pbf yields the same LightElements as
+the expat backend of stream.py, with the attributes formatted the way they
+are in osm XML files, so data.shape_rows gives the same rows for both:
+
+    import pbf
+    for elem in pbf.iter_pbf('manhattan_new-york.osm.pbf'):
+        print elem.tag, elem.attrib['id']
+
+stream.iter_elements, and with it data.process_map, read paths ending in .pbf
+with iter_pbf.
+
+The file is a sequence of independent zlib compressed blocks of a few
+thousand elements, each with its own string table. scan_blobs finds them
+without decoding anything and decode_block turns one into elements, so
+get_chunks can hand ranges of blocks to separate processes.
+
+The protobuf messages are decoded here directly, only the fields osm data
+uses, so no protobuf library is needed. Long packed fields (node ids and
+coordinates, way refs) are decoded with numpy when it is installed, which
+is several times faster than the byte by byte loop.
+
+write_pbf converts an osm XML file to PBF, which is used to check the reader
+against the XML path. The writer shares its encoding with the reader here, so
+running this file with --pbf also checks PBF files of the same export written
+by a standard tool (osmium cat map.osm -o map.osm.pbf, or osmosis --rx map.osm
+--wb map.osm.pbf), which process_map must turn into the same csvs.
+"""
+
+import argparse
+import calendar
+import os
+import struct
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from stream import iter_elements, LightElement, TOP_LEVEL_TAGS
+
+OSM_PATH = "manhattan_new-york.osm"
+PBF_SUFFIX = '.pbf'
+
+BLOCK_ELEMENTS = 8000  # elements per block written by write_pbf, as osmium does
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BLOB_SIZE = 32 * 1024 * 1024
+REQUIRED_FEATURES = ('OsmSchema-V0.6', 'DenseNodes')
+
+# packed fields shorter than this are decoded faster in Python than with numpy
+NUMPY_MIN_SIZE = 256
+LOW_BYTES = ''.join(chr(i) for i in range(0x80))
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+make = tuple.__new__
+
+
+def is_pbf(path):
+    return isinstance(path, basestring) and path.endswith(PBF_SUFFIX)
+
+
+# ================================================== #
+#               Protobuf decoding                    #
+# ================================================== #
+def read_varint(buf, pos):
+    """Return the varint starting at buf[pos] (a bytearray) and the position after it"""
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def iter_fields(data):
+    """Yield (field number, value) of a message, value is an int or the bytes of a length delimited field"""
+    buf = bytearray(data)
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            size, pos = read_varint(buf, pos)
+            value = data[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            value = struct.unpack_from('<q', data, pos)[0]
+            pos += 8
+        elif wire_type == 5:
+            value = struct.unpack_from('<i', data, pos)[0]
+            pos += 4
+        else:
+            raise ValueError('unsupported protobuf wire type {}'.format(wire_type))
+        yield key >> 3, value
+
+
+def message_fields(data):
+    """Return {field number: value} of a message whose fields are not repeated (or packed)
+
+    The same as dict(iter_fields(data)), with the varint decoding inlined: it is
+    called for every way and relation and every Info.
+    """
+    fields = {}
+    buf = bytearray(data)
+    pos, end = 0, len(buf)
+    while pos < end:
+        key = buf[pos]
+        pos += 1
+        if key >= 0x80:
+            key, pos = read_varint(buf, pos - 1)
+        wire_type = key & 7
+        if wire_type == 0:
+            value = buf[pos]
+            pos += 1
+            if value >= 0x80:
+                value, pos = read_varint(buf, pos - 1)
+        elif wire_type == 2:
+            size = buf[pos]
+            pos += 1
+            if size >= 0x80:
+                size, pos = read_varint(buf, pos - 1)
+            value = data[pos:pos + size]
+            pos += size
+        else:
+            # fixed size fields are not used by osm data
+            return dict(iter_fields(data))
+        fields[key >> 3] = value
+    return fields
+
+
+def unpack_python(data):
+    values = []
+    append = values.append
+    value = shift = 0
+    for byte in bytearray(data):
+        if byte < 0x80:
+            append(value | (byte << shift))
+            value = shift = 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+    return values
+
+
+def unpack_array(data):
+    """Decode packed varints into a uint64 array, all at once"""
+    b = np.frombuffer(data, np.uint8)
+    last = b < 0x80
+    ends = np.flatnonzero(last)
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    # position of each byte within its varint
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = ((np.arange(len(b)) - starts[group]) * 7).astype(np.uint64)
+    return np.add.reduceat((b & 0x7f).astype(np.uint64) << shifts, starts)
+
+
+def unzigzag_array(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def unpack(data):
+    """Decode a packed repeated varint field"""
+    if np is not None and len(data) >= NUMPY_MIN_SIZE:
+        return unpack_array(data).tolist()
+    return unpack_python(data)
+
+
+def unpack_delta(data):
+    """Decode a packed, delta coded sint64 field"""
+    if np is not None and len(data) >= NUMPY_MIN_SIZE:
+        return np.cumsum(unzigzag_array(unpack_array(data))).tolist()
+    values = []
+    append = values.append
+    total = 0
+    for v in unpack_python(data):
+        total += (v >> 1) ^ -(v & 1)
+        append(total)
+    return values
+
+
+def count_varints(data):
+    # every varint ends with the one byte below 0x80
+    return len(data) - len(data.translate(None, LOW_BYTES))
+
+
+def split(values, counts):
+    out = []
+    i = 0
+    for n in counts:
+        out.append(values[i:i + n])
+        i += n
+    return out
+
+
+def unpack_many(chunks):
+    """Decode several packed varint fields in one go, return a list of values per field"""
+    return split(unpack(''.join(chunks)), [count_varints(c) for c in chunks])
+
+
+def unpack_delta_many(chunks):
+    """Decode several packed, delta coded sint64 fields in one go, each with its own running sum"""
+    counts = [count_varints(c) for c in chunks]
+    data = ''.join(chunks)
+    if np is None or len(data) < NUMPY_MIN_SIZE:
+        return [unpack_delta(c) for c in chunks]
+    totals = np.cumsum(unzigzag_array(unpack_array(data)))
+    # subtract the running sum of the fields before each one
+    ends = np.cumsum(counts)
+    bases = np.zeros(len(counts), np.int64)
+    before = ends - counts - 1
+    bases[before >= 0] = totals[before[before >= 0]]
+    return split((totals - np.repeat(bases, counts)).tolist(), counts)
+
+
+def to_int64(value):
+    # int64 fields are sent as 64 bit two's complement varints
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def decode_string(s):
+    # like the XML parsers of Python 2: str for ascii, unicode otherwise
+    try:
+        s.decode('ascii')
+        return s
+    except UnicodeDecodeError:
+        return s.decode('utf-8')
+
+
+# ================================================== #
+#               File structure                       #
+# ================================================== #
+def scan_blobs(f):
+    """Yield (type, offset, size) of each blob of an open PBF file, offset being where its header starts"""
+    offset = f.tell()
+    while True:
+        prefix = f.read(4)
+        if not prefix:
+            return
+        if len(prefix) < 4:
+            raise ValueError('truncated PBF file at offset {}'.format(offset))
+        header_size = struct.unpack('>I', prefix)[0]
+        if header_size > MAX_HEADER_SIZE:
+            raise ValueError('PBF blob header of {} bytes at offset {}'.format(header_size, offset))
+        blob_type, data_size = None, 0
+        for field, value in iter_fields(f.read(header_size)):
+            if field == 1:
+                blob_type = value
+            elif field == 3:
+                data_size = value
+        if data_size > MAX_BLOB_SIZE:
+            raise ValueError('PBF blob of {} bytes at offset {}'.format(data_size, offset))
+        f.seek(data_size, os.SEEK_CUR)
+        size = 4 + header_size + data_size
+        yield blob_type, offset, size
+        offset += size
+
+
+def read_blob(f, offset):
+    """Return the type and uncompressed contents of the blob at offset"""
+    f.seek(offset)
+    header_size = struct.unpack('>I', f.read(4))[0]
+    blob_type, data_size = None, 0
+    for field, value in iter_fields(f.read(header_size)):
+        if field == 1:
+            blob_type = value
+        elif field == 3:
+            data_size = value
+    raw = zlib_data = None
+    for field, value in iter_fields(f.read(data_size)):
+        if field == 1:
+            raw = value
+        elif field == 3:
+            zlib_data = value
+        elif field in (4, 5, 6, 7):
+            raise ValueError('unsupported PBF blob compression (field {}), only zlib is'.format(field))
+    return blob_type, raw if raw is not None else zlib.decompress(zlib_data)
+
+
+def check_header(data):
+    for field, value in iter_fields(data):
+        if field == 4 and value not in REQUIRED_FEATURES:
+            raise ValueError('PBF file needs unsupported feature {}'.format(value))
+
+
+# ================================================== #
+#               Block decoding                       #
+# ================================================== #
+def format_coordinate(nanodegrees):
+    """Format a coordinate as osm XML does: 7 decimals"""
+    if nanodegrees % 100:
+        return '{:.9f}'.format(nanodegrees * 1e-9)
+    units = nanodegrees // 100
+    if units < 0:
+        return '-%d.%07d' % divmod(-units, 10 ** 7)
+    return '%d.%07d' % divmod(units, 10 ** 7)
+
+
+def format_timestamp(milliseconds):
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(milliseconds // 1000))
+
+
+class Block(object):
+    """Decoding state of one PrimitiveBlock: string table, coordinate and date scales"""
+
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.date_granularity = 1000
+        self.lat_offset = self.lon_offset = 0
+        for field, value in iter_fields(data):
+            if field == 1:
+                self.strings = [decode_string(s) for f, s in iter_fields(value) if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = to_int64(value)
+            elif field == 20:
+                self.lon_offset = to_int64(value)
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return tuple([make(LightElement, ('tag', {'k': strings[k], 'v': strings[v]}, ()))
+                      for k, v in zip(keys, vals)])
+
+    def info(self, attrib, data):
+        info = message_fields(data)
+        if 1 in info:
+            attrib['version'] = str(info[1])
+        if 2 in info:
+            attrib['timestamp'] = format_timestamp(to_int64(info[2]) * self.date_granularity)
+        if 3 in info:
+            attrib['changeset'] = str(to_int64(info[3]))
+        if 4 in info:
+            attrib['uid'] = str(to_int64(info[4]))
+        if 5 in info:
+            attrib['user'] = self.strings[info[5]]
+
+    def coordinates(self, values, offset):
+        granularity = self.granularity
+        if granularity % 100 or offset % 100:
+            return [format_coordinate(offset + granularity * v) for v in values]
+        # whole 1e-7 degrees: a float holds them exactly enough for '%.7f' to print them back
+        return ['%.7f' % ((offset + granularity * v) / 1e9) for v in values]
+
+    def timestamps(self, values):
+        date_granularity = self.date_granularity
+        if np is None:
+            return [format_timestamp(v * date_granularity) for v in values]
+        milliseconds = np.array(values, np.int64) * date_granularity
+        return [t + 'Z' for t in np.datetime_as_string(milliseconds.astype('datetime64[ms]'), unit='s').astype('S').tolist()]
+
+    def dense_nodes(self, data):
+        fields = message_fields(data)
+        ids = unpack_delta(fields.get(1, ''))
+        attribs = [{'id': str(id_), 'lat': lat, 'lon': lon} for id_, lat, lon in zip(
+            ids,
+            self.coordinates(unpack_delta(fields.get(8, '')), self.lat_offset),
+            self.coordinates(unpack_delta(fields.get(9, '')), self.lon_offset))]
+
+        # DenseInfo: version is plain, the others are delta coded
+        info = message_fields(fields.get(5, ''))
+        columns = []
+        if 1 in info:
+            columns.append(('version', [str(v) for v in unpack(info[1])]))
+        if 2 in info:
+            columns.append(('timestamp', self.timestamps(unpack_delta(info[2]))))
+        if 3 in info:
+            columns.append(('changeset', [str(v) for v in unpack_delta(info[3])]))
+        if 4 in info:
+            columns.append(('uid', [str(v) for v in unpack_delta(info[4])]))
+        if 5 in info:
+            strings = self.strings
+            columns.append(('user', [strings[v] for v in unpack_delta(info[5])]))
+        for name, column in columns:
+            for attrib, value in zip(attribs, column):
+                attrib[name] = value
+
+        # keys_vals holds k, v, k, v, ..., 0 for each node, and is empty when no node has tags
+        keys_vals = unpack(fields.get(10, ''))
+        if not keys_vals:
+            return [make(LightElement, ('node', attrib, ())) for attrib in attribs]
+        strings = self.strings
+        elems = []
+        kv = 0
+        for attrib in attribs:
+            if keys_vals[kv]:
+                start = kv
+                while keys_vals[kv]:
+                    kv += 2
+                children = tuple([
+                    make(LightElement, ('tag', {'k': strings[keys_vals[j]], 'v': strings[keys_vals[j + 1]]}, ()))
+                    for j in xrange(start, kv, 2)])
+            else:
+                children = ()
+            kv += 1
+            elems.append(make(LightElement, ('node', attrib, children)))
+        return elems
+
+    def node(self, data):
+        attrib = {}
+        keys = vals = ()
+        lat = lon = 0
+        for field, value in iter_fields(data):
+            if field == 1:
+                attrib['id'] = str((value >> 1) ^ -(value & 1))
+            elif field == 2:
+                keys = unpack(value)
+            elif field == 3:
+                vals = unpack(value)
+            elif field == 4:
+                self.info(attrib, value)
+            elif field == 8:
+                lat = (value >> 1) ^ -(value & 1)
+            elif field == 9:
+                lon = (value >> 1) ^ -(value & 1)
+        attrib['lat'] = format_coordinate(self.lat_offset + self.granularity * lat)
+        attrib['lon'] = format_coordinate(self.lon_offset + self.granularity * lon)
+        return make(LightElement, ('node', attrib, self.tags(keys, vals)))
+
+    def ways(self, messages):
+        # the refs, keys and vals of all ways of a group are decoded together, which
+        # is much faster than decoding a few values at a time
+        ways = [message_fields(data) for data in messages]
+        keys = unpack_many([way.get(2, '') for way in ways])
+        vals = unpack_many([way.get(3, '') for way in ways])
+        refs = unpack_delta_many([way.get(8, '') for way in ways])
+        elems = []
+        for i, way in enumerate(ways):
+            attrib = {'id': str(to_int64(way[1]))}
+            if 4 in way:
+                self.info(attrib, way[4])
+            nds = tuple([make(LightElement, ('nd', {'ref': str(ref)}, ())) for ref in refs[i]])
+            elems.append(make(LightElement, ('way', attrib, nds + self.tags(keys[i], vals[i]))))
+        return elems
+
+    def relation(self, data):
+        attrib = {}
+        keys = vals = roles = memids = types = ()
+        for field, value in iter_fields(data):
+            if field == 1:
+                attrib['id'] = str(to_int64(value))
+            elif field == 2:
+                keys = unpack(value)
+            elif field == 3:
+                vals = unpack(value)
+            elif field == 4:
+                self.info(attrib, value)
+            elif field == 8:
+                roles = unpack(value)
+            elif field == 9:
+                memids = unpack_delta(value)
+            elif field == 10:
+                types = unpack(value)
+        strings = self.strings
+        members = tuple([make(LightElement, ('member', {'type': MEMBER_TYPES[t], 'ref': str(ref), 'role': strings[role]}, ()))
+                         for t, ref, role in zip(types, memids, roles)])
+        return make(LightElement, ('relation', attrib, members + self.tags(keys, vals)))
+
+    def elements(self, tags=TOP_LEVEL_TAGS):
+        """Return the elements of the block whose tag is in tags, in file order"""
+        elems = []
+        for group in self.groups:
+            ways = []
+            for field, value in iter_fields(group):
+                if field == 2 and 'node' in tags:
+                    elems.extend(self.dense_nodes(value))
+                elif field == 1 and 'node' in tags:
+                    elems.append(self.node(value))
+                elif field == 3 and 'way' in tags:
+                    ways.append(value)
+                elif field == 4 and 'relation' in tags:
+                    elems.append(self.relation(value))
+            # a group only holds one type of element
+            if ways:
+                elems.extend(self.ways(ways))
+        return elems
+
+
+def decode_block(data, tags=TOP_LEVEL_TAGS):
+    """Decode the uncompressed contents of an OSMData blob into LightElements"""
+    return Block(data).elements(tags)
+
+
+# ================================================== #
+#               Reading                              #
+# ================================================== #
+def get_chunks(pbf_file, num_chunks):
+    """Split a PBF file into about num_chunks byte ranges of whole data blobs"""
+    with open(pbf_file, 'rb') as f:
+        blobs = [(offset, size) for blob_type, offset, size in scan_blobs(f) if blob_type == 'OSMData']
+    if not blobs:
+        return []
+    per_chunk = max(1, -(-len(blobs) // num_chunks))
+    groups = [blobs[i:i + per_chunk] for i in range(0, len(blobs), per_chunk)]
+    return [(group[0][0], group[-1][0] + group[-1][1]) for group in groups]
+
+
+def iter_pbf(pbf_file, tags=TOP_LEVEL_TAGS, start=None, end=None):
+    """Yield the elements of pbf_file whose tag is in tags, as LightElements
+
+    start and end restrict reading to the blobs in that byte range (see get_chunks).
+    """
+    with open(pbf_file, 'rb') as f:
+        if start is None:
+            blobs = list(scan_blobs(f))
+        else:
+            f.seek(start)
+            blobs = []
+            for blob in scan_blobs(f):
+                if blob[1] >= end:
+                    break
+                blobs.append(blob)
+        for blob_type, offset, size in blobs:
+            blob_type, data = read_blob(f, offset)
+            if blob_type == 'OSMHeader':
+                check_header(data)
+            elif blob_type == 'OSMData':
+                for elem in decode_block(data, tags):
+                    yield elem
+
+
+# ================================================== #
+#               Writing                              #
+# ================================================== #
+def varint(value):
+    out = bytearray()
+    value &= (1 << 64) - 1
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field_varint(field, value):
+    return varint(field << 3) + varint(value)
+
+
+def field_bytes(field, data):
+    return varint(field << 3 | 2) + varint(len(data)) + data
+
+
+def field_packed(field, values):
+    return field_bytes(field, ''.join(varint(v) for v in values))
+
+
+def deltas(values):
+    previous = 0
+    out = []
+    for v in values:
+        out.append(zigzag(v - previous))
+        previous = v
+    return out
+
+
+def write_blob(f, blob_type, data):
+    blob = field_varint(2, len(data)) + field_bytes(3, zlib.compress(data))
+    header = field_bytes(1, blob_type) + field_varint(3, len(blob))
+    f.write(struct.pack('>I', len(header)))
+    f.write(header)
+    f.write(blob)
+
+
+def parse_coordinate(s):
+    return int(round(float(s) * 1e7))
+
+
+def parse_timestamp(s):
+    return calendar.timegm(time.strptime(s, TIMESTAMP_FORMAT))
+
+
+class BlockWriter(object):
+    """Collect the elements of one PrimitiveBlock and encode it"""
+
+    def __init__(self):
+        self.strings = {'': 0}
+        self.elements = []
+
+    def sid(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        if s not in self.strings:
+            self.strings[s] = len(self.strings)
+        return self.strings[s]
+
+    def info(self, attrib):
+        return (field_varint(1, int(attrib['version'])) +
+                field_varint(2, parse_timestamp(attrib['timestamp'])) +
+                field_varint(3, int(attrib['changeset'])) +
+                field_varint(4, int(attrib['uid'])) +
+                field_varint(5, self.sid(attrib['user'])))
+
+    def keys_vals(self, elem):
+        tags = [(self.sid(t.attrib['k']), self.sid(t.attrib['v'])) for t in elem.iter('tag')]
+        return field_packed(2, [k for k, v in tags]) + field_packed(3, [v for k, v in tags])
+
+    def dense(self, nodes):
+        attribs = [n.attrib for n in nodes]
+        keys_vals = []
+        for node in nodes:
+            for t in node.iter('tag'):
+                keys_vals.extend((self.sid(t.attrib['k']), self.sid(t.attrib['v'])))
+            keys_vals.append(0)
+        info = (field_packed(1, [int(a['version']) for a in attribs]) +
+                field_packed(2, deltas([parse_timestamp(a['timestamp']) for a in attribs])) +
+                field_packed(3, deltas([int(a['changeset']) for a in attribs])) +
+                field_packed(4, deltas([int(a['uid']) for a in attribs])) +
+                field_packed(5, deltas([self.sid(a['user']) for a in attribs])))
+        return field_bytes(2, (
+            field_packed(1, deltas([int(a['id']) for a in attribs])) +
+            field_bytes(5, info) +
+            field_packed(8, deltas([parse_coordinate(a['lat']) for a in attribs])) +
+            field_packed(9, deltas([parse_coordinate(a['lon']) for a in attribs])) +
+            field_packed(10, keys_vals)))
+
+    def way(self, elem):
+        return field_bytes(3, (
+            field_varint(1, int(elem.attrib['id'])) + self.keys_vals(elem) +
+            field_bytes(4, self.info(elem.attrib)) +
+            field_packed(8, deltas([int(nd.attrib['ref']) for nd in elem.iter('nd')]))))
+
+    def relation(self, elem):
+        members = elem.iter('member')
+        return field_bytes(4, (
+            field_varint(1, int(elem.attrib['id'])) + self.keys_vals(elem) +
+            field_bytes(4, self.info(elem.attrib)) +
+            field_packed(8, [self.sid(m.attrib['role']) for m in members]) +
+            field_packed(9, deltas([int(m.attrib['ref']) for m in members])) +
+            field_packed(10, [MEMBER_TYPES.index(m.attrib['type']) for m in members])))
+
+    def encode(self):
+        # one group per run of elements of the same type
+        groups = []
+        i = 0
+        while i < len(self.elements):
+            tag = self.elements[i].tag
+            j = i
+            while j < len(self.elements) and self.elements[j].tag == tag:
+                j += 1
+            run = self.elements[i:j]
+            if tag == 'node':
+                groups.append(self.dense(run))
+            else:
+                encode = self.way if tag == 'way' else self.relation
+                groups.append(''.join(encode(elem) for elem in run))
+            i = j
+        strings = sorted(self.strings, key=self.strings.get)
+        table = ''.join(field_bytes(1, s) for s in strings)
+        return field_bytes(1, table) + ''.join(field_bytes(2, g) for g in groups)
+
+
+def write_pbf(osm_file, pbf_file, block_elements=BLOCK_ELEMENTS):
+    """Convert an osm XML file to PBF, return the number of elements written"""
+    n = 0
+    with open(pbf_file, 'wb') as f:
+        header = ''.join(field_bytes(4, feature) for feature in REQUIRED_FEATURES)
+        write_blob(f, 'OSMHeader', header + field_bytes(16, 'osm-data-wrangling'))
+        block = BlockWriter()
+        # expat elements stay valid after the next one is parsed, unlike the etree ones
+        for elem in iter_elements(osm_file, backend='expat'):
+            block.elements.append(elem)
+            n += 1
+            if len(block.elements) >= block_elements:
+                write_blob(f, 'OSMData', block.encode())
+                block = BlockWriter()
+        if block.elements:
+            write_blob(f, 'OSMData', block.encode())
+    return n
+
+
+if __name__ == '__main__':
+    import tempfile
+    import data
+
+    parser = argparse.ArgumentParser(description='Convert an osm file to PBF and compare reading both')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    parser.add_argument('-j', '--workers', type=int, default=4)
+    parser.add_argument('--pbf', nargs='+', default=[], metavar='PBF_FILE',
+                        help='PBF files of osm_file written by osmium or osmosis, checked as well')
+    args = parser.parse_args()
+
+    osm_file = os.path.abspath(args.osm_file)
+    pbf_file = osm_file + PBF_SUFFIX
+    if not os.path.exists(pbf_file) or os.path.getmtime(pbf_file) < os.path.getmtime(osm_file):
+        print '{} elements written to {}'.format(write_pbf(osm_file, pbf_file), pbf_file)
+    tool_files = [os.path.abspath(path) for path in args.pbf]
+    paths = [osm_file, pbf_file] + tool_files
+
+    def label(path):
+        # tool marks the PBF files that were not written by write_pbf
+        return 'tool' if path in tool_files else 'pbf' if is_pbf(path) else 'xml'
+
+    for path in paths:
+        print '{} {:.1f} MB  {}'.format(label(path), os.path.getsize(path) / 1e6, path)
+
+    print '{:<6}{:<8}{:>10}{:>10}{:>14}'.format('input', 'stage', 'elements', 'seconds', 'elements/s')
+    for path in paths:
+        for shape in (False, True):
+            start = time.time()
+            n = 0
+            for elem in data.get_element(path):
+                if shape:
+                    data.shape_rows(elem)
+                n += 1
+            seconds = time.time() - start
+            print '{:<6}{:<8}{:>10}{:>10.2f}{:>14,.0f}'.format(
+                label(path), 'shape' if shape else 'read', n, seconds, n / seconds)
+
+    # process_map writes to the working directory
+    tmp_dir = tempfile.mkdtemp(prefix='osm-pbf-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmp_dir)
+        print
+        print '{:<6}{:>8}{:>16}'.format('input', 'workers', 'process_map s')
+        outputs = {}
+        for path in paths:
+            for workers in (1, args.workers):
+                start = time.time()
+                data.process_map(path, validate=False, workers=workers, relations=True)
+                seconds = time.time() - start
+                print '{:<6}{:>8}{:>16.2f}'.format(label(path), workers, seconds)
+                for _, table, _ in data.CSV_TABLES + data.RELATION_CSV_TABLES:
+                    with open(table, 'rb') as f:
+                        outputs.setdefault(table, set()).add(f.read())
+        identical = all(len(contents) == 1 for contents in outputs.values())
+        print 'csvs identical: {}'.format(identical)
+    finally:
+        os.chdir(cwd)
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+    if not identical:
+        raise SystemExit('the csvs of some inputs differ')
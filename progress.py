@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Progress reports for long runs of data.process_map and audit.run_audits.
+
+Progress counts the elements of each type as they go by, and every
+interval seconds reports:
+- the elements done and their rate
+- the bytes read from the input, and an ETA from the share of the file read
+- the RSS of the process
+- the tag counters of data.TAG_STATS: keys with problematic characters and
+  values fixed by the street and postcode cleaners
+
+Reports are written as one line to stderr, and as one JSON object per line
+to a metrics file if one is given. The clock is only read every CHECK_EVERY
+elements, so tracking costs a counter increment and a comparison per
+element.
+
+The bytes read are counted on the file object the parser reads from (see
+open_input). For compressed files that is the decompressed stream, whose
+size is unknown, so there is no ETA. PBF files are read by pbf.iter_pbf
+itself and are only counted by element. With several workers,
+data.process_map reports each chunk as it is merged, which does give an ETA.
+"""
+
+import json
+import os
+import sys
+import time
+
+from compress import codec_of, open_input
+
+INTERVAL = 10.0  # seconds between reports
+CHECK_EVERY = 1000  # elements between looks at the clock
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError):
+    PAGE_SIZE = None
+
+
+def rss_mb():
+    """Current RSS of this process in MB, the peak RSS where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE / 1e6
+    except (IOError, TypeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+class CountingReader(object):
+    """File object wrapper that counts the bytes read through it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class Progress(object):
+    """Count elements by type and report at intervals
+
+    out is a stream for the one line reports (None for none), metrics_path a
+    file that gets every report as a JSON line. stats, if given, returns a
+    dict of extra counters to report, such as data.tag_stats.
+    """
+
+    def __init__(self, label='elements', out=sys.stderr, metrics_path=None, interval=INTERVAL, stats=None):
+        self.label = label
+        self.out = out
+        self.metrics = open(metrics_path, 'a') if metrics_path else None
+        self.interval = interval
+        self.stats = stats
+        self.counts = {}
+        self.n = 0
+        self.next_check = CHECK_EVERY
+        self.reader = None
+        self.bytes_done = 0  # for inputs not read through a CountingReader
+        self.total_bytes = None
+        self.start = self.last_report = time.time()
+        self.last_n = 0
+
+    def open_input(self, path):
+        """Open path for the parser, counting the bytes read; PBF paths are returned as they are"""
+        if path.endswith('.pbf'):
+            return path
+        if not codec_of(path):
+            self.total_bytes = os.path.getsize(path)
+        self.reader = CountingReader(open_input(path))
+        return self.reader
+
+    def track(self, elements):
+        """Yield elements, counting each of them
+
+        Elements come in runs of the same type, so the counts by type are only
+        updated when the type changes and when the clock is read.
+        """
+        counts = self.counts
+        tag = None
+        n = start = self.n  # elements up to start are in counts
+        next_check = self.next_check
+        try:
+            for element in elements:
+                n += 1
+                if element.tag != tag:
+                    if tag is not None:
+                        counts[tag] = counts.get(tag, 0) + n - 1 - start
+                    tag, start = element.tag, n - 1
+                if n >= next_check:
+                    counts[tag] = counts.get(tag, 0) + n - start
+                    self.n = start = n
+                    self.check()
+                    next_check = self.next_check
+                yield element
+        finally:
+            if tag is not None:
+                counts[tag] = counts.get(tag, 0) + n - start
+            self.n = n
+
+    def add(self, counts, bytes_done=0):
+        """Add elements (and input bytes) processed elsewhere, e.g. by a worker process"""
+        for tag, n in counts.iteritems():
+            self.counts[tag] = self.counts.get(tag, 0) + n
+            self.n += n
+        self.bytes_done += bytes_done
+        self.check()
+
+    def check(self):
+        self.next_check = self.n + CHECK_EVERY
+        if self.interval is not None and time.time() - self.last_report >= self.interval:
+            self.report()
+
+    def metrics_dict(self):
+        now = time.time()
+        elapsed = now - self.start
+        done = self.bytes_done + (self.reader.bytes if self.reader is not None else 0)
+        eta = None
+        if self.total_bytes and done:
+            eta = elapsed * (self.total_bytes - done) / done
+        metrics = {
+            'time': now,
+            'elapsed': round(elapsed, 2),
+            'elements': self.n,
+            'counts': dict(self.counts),
+            'per_sec': round(self.n / elapsed, 1) if elapsed else None,
+            'recent_per_sec': round((self.n - self.last_n) / (now - self.last_report), 1)
+                              if now > self.last_report else None,
+            'bytes': done,
+            'total_bytes': self.total_bytes,
+            'eta': round(eta, 1) if eta is not None else None,
+            'rss_mb': round(rss_mb(), 1),
+        }
+        if self.stats is not None:
+            metrics.update(self.stats())
+        return metrics
+
+    def report(self, final=False):
+        metrics = self.metrics_dict()
+        metrics['final'] = final
+        self.last_report, self.last_n = metrics['time'], self.n
+        if self.metrics is not None:
+            self.metrics.write(json.dumps(metrics, sort_keys=True) + '\n')
+            self.metrics.flush()
+        if self.out is not None:
+            counts = ' '.join('{} {}'.format(n, tag) for tag, n in sorted(self.counts.items()))
+            if metrics['total_bytes']:
+                position = '{:.1f}% of {:.0f} MB'.format(100. * metrics['bytes'] / metrics['total_bytes'],
+                                                       metrics['total_bytes'] / 1e6)
+            elif self.reader is not None:
+                position = '{:.0f} MB read'.format(metrics['bytes'] / 1e6)
+            else:
+                position = 'input position unknown'
+            extra = ''.join(', {} {}'.format(key.replace('_', ' '), metrics[key])
+                            for key in sorted(self.stats() if self.stats is not None else ()))
+            self.out.write('{} {} {} ({}), {:,.0f}/s, {}, ETA {}, RSS {:.0f} MB{}\n'.format(
+                format_seconds(metrics['elapsed']), self.n, self.label, counts or 'none',
+                metrics['per_sec'] or 0, position, format_seconds(0 if final else metrics['eta']),
+                metrics['rss_mb'], extra))
+            self.out.flush()
+        return metrics
+
+    def close(self):
+        """Write the final report"""
+        metrics = self.report(final=True)
+        if self.metrics is not None:
+            self.metrics.close()
+        return metrics
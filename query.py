@@ -1,153 +1,530 @@
+"""
+Report queries over the SQLite database built by load.py.
+
+select runs SQL through one pooled connection per database, opened read
+only (query_only), instead of connecting for every query. Results are
+cached in memory and in a small SQLite file next to the database
+(<db>.cache), keyed on the query and a fingerprint of the database file:
+its inode, size, modification time and the change counter SQLite bumps on
+every commit. Re-running a query on an unchanged database reads the cached
+DataFrame instead of scanning the tables again; any load or change file
+applied in between changes the fingerprint, and the stale results are
+dropped the next time a result is stored.
+
+The report queries are in QUERIES, by name (see run and report). They read
+the summary tables of summary.py; TABLE_QUERIES holds the same queries over
+the base tables, TEXT_TABLE_QUERIES over the base tables of a database
+without a users table. run and report pick the catalog that fits the
+database (catalog), so a database imported from the csvs of data.py or
+loaded with --no-summaries is reported from its base tables. analytics.py
+computes them in memory with NumPy and pandas.
+
+Run with --check to also report from a copy of the database without the
+summary tables and compare the results.
+"""
+
+import argparse
+import cPickle as pickle
+import hashlib
+import math
+import os
+import shutil
 import sqlite3
+import struct
+import tempfile
 import pandas as pd
 
-def select(filename, QUERY):
-	con = sqlite3.connect(filename)
-	df = pd.read_sql_query(QUERY, con)
-	con.close()
-	return df
+from lru import LRUCache
+from summary import SUMMARY_TABLES, has_summaries, has_users
 
-if __name__ == '__main__':
+EARTH_RADIUS = 6371008.8	# mean radius in meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
 
-	# find the total number of tags with postal codes
-	QUERY = """
-		SELECT COUNT(a.value) AS total_postalTags
-		FROM (SELECT * FROM nodes_tags UNION ALL
-			  SELECT * FROM ways_tags) a
-		WHERE a.key = 'postcode';
-	"""
-
-	# find number of tags with postal codes grouped by borough
-	QUERY0 = """
-		SELECT CASE
-					WHEN (a.value BETWEEN 10000 AND 10299)
-						THEN 'manhattan'
-					WHEN (a.value LIKE '112%')
-						THEN 'brooklyn'
-					WHEN (a.value LIKE '104%' OR a.value = '11370')
-						THEN 'bronx'
-					WHEN (a.value LIKE '07%')
-						THEN 'nj'
-					WHEN (a.value LIKE '111%'
-						OR	   (a.value LIKE '113%' AND a.value != '11370')
-						OR 	   a.value LIKE '114%'
-						OR 	   a.value LIKE '116%'
-						OR 	   a.value between '11004' AND '11005')
-						THEN 'queens'
-					END as borough,
-			   COUNT(a.value) AS numTags
-		FROM (SELECT * FROM nodes_tags UNION ALL
-			  SELECT * FROM ways_tags) a
-		WHERE a.key = 'postcode'
-		GROUP BY borough
-		ORDER BY numTags DESC;
-	"""
-
-	# number of nodes
-	QUERY_numNodes = """
-		SELECT count(*) as numNodes FROM nodes;
-	"""
-
-	# number of ways
-	QUERY_numWays = """
-		SELECT count(*) as numWays FROM ways;
-	"""
-
-	# number of unique users
-	QUERY_numUsers = """
-		SELECT count(distinct(a.uid)) AS numUsers
+DB_PATH = 'opensm-manhattan.db'
+CACHE_SUFFIX = '.cache'
+
+# ================================================== #
+#     Report queries over the base tables            #
+# ================================================== #
+# find the total number of tags with postal codes
+QUERY = """
+	SELECT COUNT(a.value) AS total_postalTags
+	FROM (SELECT * FROM nodes_tags UNION ALL
+		  SELECT * FROM ways_tags) a
+	WHERE a.key = 'postcode';
+"""
+
+# find number of tags with postal codes grouped by borough
+QUERY0 = """
+	SELECT CASE
+				WHEN (a.value BETWEEN 10000 AND 10299)
+					THEN 'manhattan'
+				WHEN (a.value LIKE '112%')
+					THEN 'brooklyn'
+				WHEN (a.value LIKE '104%' OR a.value = '11370')
+					THEN 'bronx'
+				WHEN (a.value LIKE '07%')
+					THEN 'nj'
+				WHEN (a.value LIKE '111%'
+					OR	   (a.value LIKE '113%' AND a.value != '11370')
+					OR 	   a.value LIKE '114%'
+					OR 	   a.value LIKE '116%'
+					OR 	   a.value between '11004' AND '11005')
+					THEN 'queens'
+				END as borough,
+		   COUNT(a.value) AS numTags
+	FROM (SELECT * FROM nodes_tags UNION ALL
+		  SELECT * FROM ways_tags) a
+	WHERE a.key = 'postcode'
+	GROUP BY borough
+	ORDER BY numTags DESC, borough;
+"""
+
+# number of nodes
+QUERY_numNodes = """
+	SELECT count(*) as numNodes FROM nodes;
+"""
+
+# number of ways
+QUERY_numWays = """
+	SELECT count(*) as numWays FROM ways;
+"""
+
+# number of unique users
+QUERY_numUsers = """
+	SELECT count(distinct(a.uid)) AS numUsers
+	FROM (SELECT uid FROM nodes UNION ALL
+		  SELECT uid FROM ways) a;
+"""
+
+# top 10 users by contribution
+QUERY_topUsers = """
+	SELECT users.user, count(*) AS num
+	FROM (SELECT uid FROM nodes UNION ALL
+		  SELECT uid FROM ways) a
+	JOIN users USING (uid)
+	GROUP BY 1
+	ORDER BY 2 DESC, 1
+	LIMIT 10;
+"""
+
+# number of users contributing once
+QUERY_numOnetimeUsers = """
+	SELECT count(*) as numOnetimeUsers
+	FROM (
+		SELECT users.user, count(*) as num
 		FROM (SELECT uid FROM nodes UNION ALL
-			  SELECT uid FROM ways) a;
-	"""
+			  SELECT uid FROM ways) a
+		JOIN users USING (uid)
+		GROUP BY 1
+		HAVING num=1) u;
+"""
 
-	# top 10 users by contribution
-	QUERY_topUsers = """
-		SELECT a.user, count(*) AS num
+# the same two over databases imported from the csv files of data.py,
+# which have the user name on every row instead of a users table
+QUERY_topUsersText = """
+	SELECT a.user, count(*) AS num
+	FROM (SELECT user FROM nodes UNION ALL
+		  SELECT user FROM ways) a
+	GROUP BY 1
+	ORDER BY 2 DESC, 1
+	LIMIT 10;
+"""
+
+QUERY_numOnetimeUsersText = """
+	SELECT count(*) as numOnetimeUsers
+	FROM (
+		SELECT a.user, count(*) as num
 		FROM (SELECT user FROM nodes UNION ALL
 			  SELECT user FROM ways) a
 		GROUP BY 1
-		ORDER BY 2 DESC
-		LIMIT 10;
-	"""
-
-	# number of users contributing once
-	QUERY_numOnetimeUsers = """
-		SELECT count(*) as numOnetimeUsers
-		FROM (
-			SELECT a.user, count(*) as num
-			FROM (SELECT user FROM nodes UNION ALL
-				  SELECT user FROM ways) a
-			GROUP BY 1
-			HAVING num=1) u;
-	"""
-
-	QUERY_topZips = """
-		SELECT a.value, count(*) as numTags
-		FROM nodes_tags a
-		WHERE a.key = 'postcode'
+		HAVING num=1) u;
+"""
+
+QUERY_topZips = """
+	SELECT a.value, count(*) as numTags
+	FROM nodes_tags a
+	WHERE a.key = 'postcode'
+	GROUP BY 1
+	ORDER BY 2 DESC, 1
+	LIMIT 5;
+"""
+
+# top 5 Manhattan zip codes
+QUERY_topManZips = """
+	SELECT a.value, count(*) as numTags
+	FROM nodes_tags a
+	WHERE a.key = 'postcode'
+	AND (a.value BETWEEN 10000 AND 10299)
+	GROUP BY 1
+	ORDER BY 2 DESC, 1
+	LIMIT 5;
+"""
+
+# top 10 amenities
+QUERY_topAmenities = """
+	SELECT nodes_tags.value, COUNT(*) as num
+	FROM nodes_tags
+	WHERE nodes_tags.key='amenity'
+	GROUP BY nodes_tags.value
+	ORDER BY num DESC, nodes_tags.value
+	LIMIT 10;
+"""
+
+# return a list of values for the capacities of bikeracks
+QUERY_bikerackCaps = """
+	SELECT value
+	FROM nodes_tags
+    	JOIN (SELECT DISTINCT(id) FROM nodes_tags
+			  WHERE value='bicycle_parking') i
+    	ON nodes_tags.id=i.id
+	WHERE nodes_tags.key = 'capacity';
+"""
+
+# top 10 bike rack capacities
+QUERY__ = """
+	SELECT value as capacity, count(*) as num
+	FROM nodes_tags
+		JOIN (SELECT DISTINCT(id) FROM nodes_tags
+			  WHERE value='bicycle_parking') i
+			  ON nodes_tags.id=i.id
+	WHERE nodes_tags.key = 'capacity'
+	GROUP BY 1
+	ORDER BY 2 DESC, 1
+	LIMIT 10;
+"""
+
+# query name -> SQL over the base tables
+TABLE_QUERIES = {
+	'postcode_tags': QUERY,
+	'postcodes_by_borough': QUERY0,
+	'num_nodes': QUERY_numNodes,
+	'num_ways': QUERY_numWays,
+	'num_users': QUERY_numUsers,
+	'top_users': QUERY_topUsers,
+	'num_onetime_users': QUERY_numOnetimeUsers,
+	'top_zips': QUERY_topZips,
+	'top_manhattan_zips': QUERY_topManZips,
+	'top_amenities': QUERY_topAmenities,
+	'bikerack_capacities': QUERY_bikerackCaps,
+	'top_bikerack_capacities': QUERY__,
+}
+
+# TABLE_QUERIES for databases without a users table (see summary.has_users)
+TEXT_TABLE_QUERIES = dict(TABLE_QUERIES,
+	top_users=QUERY_topUsersText,
+	num_onetime_users=QUERY_numOnetimeUsersText)
+
+# ================================================== #
+#     Report queries over the summary tables         #
+#     (built by summary.build_summaries)             #
+# ================================================== #
+# query name -> SQL, the queries of the report. Same results as TABLE_QUERIES,
+# read from the summary tables or through the tag indexes instead of scanning
+QUERIES = {
+	'postcode_tags': """
+		SELECT COALESCE(SUM(num), 0) AS total_postalTags
+		FROM tag_counts
+		WHERE key = 'postcode' AND value IS NOT NULL;
+	""",
+	'postcodes_by_borough': """
+		SELECT borough, SUM(num) AS numTags
+		FROM postcode_boroughs
+		GROUP BY borough
+		ORDER BY numTags DESC, borough;
+	""",
+	'num_nodes': """
+		SELECT COALESCE(SUM(nodes), 0) AS numNodes FROM user_counts;
+	""",
+	'num_ways': """
+		SELECT COALESCE(SUM(ways), 0) AS numWays FROM user_counts;
+	""",
+	'num_users': """
+		SELECT count(distinct(uid)) AS numUsers FROM user_counts;
+	""",
+	'top_users': """
+		SELECT user, SUM(nodes + ways) AS num
+		FROM user_counts
 		GROUP BY 1
-		ORDER BY 2 DESC
+		ORDER BY 2 DESC, 1
+		LIMIT 10;
+	""",
+	'num_onetime_users': """
+		SELECT count(*) AS numOnetimeUsers
+		FROM (SELECT user FROM user_counts
+			  GROUP BY user
+			  HAVING SUM(nodes + ways) = 1) u;
+	""",
+	'top_zips': """
+		SELECT value, num AS numTags
+		FROM tag_counts
+		WHERE key = 'postcode' AND source = 'node'
+		ORDER BY 2 DESC, 1
 		LIMIT 5;
-	"""
-
-	# top 5 Manhattan zip codes
-	QUERY_topManZips = """
-		SELECT a.value, count(*) as numTags
-		FROM nodes_tags a
-		WHERE a.key = 'postcode'
-		AND (a.value BETWEEN 10000 AND 10299)
-		GROUP BY 1
-		ORDER BY 2 DESC
+	""",
+	'top_manhattan_zips': """
+		SELECT value, num AS numTags
+		FROM tag_counts
+		WHERE key = 'postcode' AND source = 'node'
+		AND (value BETWEEN 10000 AND 10299)
+		ORDER BY 2 DESC, 1
 		LIMIT 5;
-	"""
-
-	# top 10 amenities
-	QUERY_topAmenities = """
-		SELECT nodes_tags.value, COUNT(*) as num
-		FROM nodes_tags
-		WHERE nodes_tags.key='amenity'
-		GROUP BY nodes_tags.value
-		ORDER BY num DESC
+	""",
+	'top_amenities': """
+		SELECT value, num
+		FROM tag_counts
+		WHERE key = 'amenity' AND source = 'node'
+		ORDER BY num DESC, value
 		LIMIT 10;
-	"""
-
-	# return a list of values for the capacities of bikeracks
-	QUERY_bikerackCaps = """
-		SELECT value
-		FROM nodes_tags
-	    	JOIN (SELECT DISTINCT(id) FROM nodes_tags
-				  WHERE value='bicycle_parking') i
-	    	ON nodes_tags.id=i.id
-		WHERE nodes_tags.key = 'capacity';
-	"""
-
-	# top 10 bike rack capacities
-	QUERY__ = """
-		SELECT value as capacity, count(*) as num
-		FROM nodes_tags
-			JOIN (SELECT DISTINCT(id) FROM nodes_tags
-				  WHERE value='bicycle_parking') i
-				  ON nodes_tags.id=i.id
-		WHERE nodes_tags.key = 'capacity'
-		GROUP BY 1
-		ORDER BY 2 DESC
-		LIMIT 10;
-	"""
-
-	# print select('opensm-manhattan.db', QUERY_numNodes)
-	# print select('opensm-manhattan.db', QUERY_numWays)
-	# print select('opensm-manhattan.db', QUERY_numUsers)
-	# print select('opensm-manhattan.db', QUERY_topUsers)
-	# print select('opensm-manhattan.db', QUERY_numOnetimeUsers)
-	# print select('opensm-manhattan.db', QUERY)
-	# print select('opensm-manhattan.db', QUERY0)
-	# print select('opensm-manhattan.db', QUERY_topZips)
-	# print select('opensm-manhattan.db', QUERY_topManZips)
-	# print select('opensm-manhattan.db', QUERY_topAmenities)
-	# print select('opensm-manhattan.db', QUERY_)
-
-	df = select('opensm-manhattan.db', QUERY_bikerackCaps)
+	""",
+	# not aggregates, these search the nodes_tags indexes
+	'bikerack_capacities': QUERY_bikerackCaps,
+	'top_bikerack_capacities': QUERY__,
+}
+
+# ================================================== #
+#     Pooled connections and the result cache        #
+# ================================================== #
+CONNECTIONS = {}	# database path -> (read only connection, inode of the file it opened)
+RESULTS = LRUCache(maxsize=256)	# (path, fingerprint, query key) -> DataFrame
+CATALOGS = {}	# database path -> (fingerprint, query catalog that fits it)
+
+def connection(filename):
+	# return the pooled read only connection to filename, opening it on first use
+	path = os.path.abspath(filename)
+	if not os.path.exists(path):
+		# connect would create an empty database
+		raise IOError('no database at {}'.format(path))
+	inode = os.stat(path).st_ino
+	con, pooled_inode = CONNECTIONS.get(path, (None, None))
+	if con is not None and pooled_inode != inode:
+		# the database was deleted and built again, the old connection still reads the old file
+		con.close()
+		con = None
+	if con is None:
+		con = sqlite3.connect(path)
+		con.execute('PRAGMA query_only = ON')
+		CONNECTIONS[path] = (con, inode)
+	return con
+
+def close_connections():
+	for con, _ in CONNECTIONS.values():
+		con.close()
+	CONNECTIONS.clear()
+
+def fingerprint(filename):
+	# inode, size, mtime and the file change counter of the database (bytes 24-27 of the
+	# header, incremented by every commit), plus the write-ahead log in WAL mode
+	st = os.stat(filename)
+	with open(filename, 'rb') as f:
+		header = f.read(28)
+	counter = struct.unpack('>I', header[24:28])[0] if len(header) == 28 else 0
+	parts = [st.st_ino, st.st_size, st.st_mtime, counter]
+	if os.path.exists(filename + '-wal'):
+		wal = os.stat(filename + '-wal')
+		parts += [wal.st_size, wal.st_mtime]
+	return ':'.join(repr(part) for part in parts)
+
+def query_key(QUERY, params=None):
+	return hashlib.sha1(repr((' '.join(QUERY.split()), params))).hexdigest()
+
+def open_cache(filename):
+	con = sqlite3.connect(os.path.abspath(filename) + CACHE_SUFFIX)
+	con.execute("""CREATE TABLE IF NOT EXISTS results (
+		key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, result BLOB NOT NULL)""")
+	return con
+
+def cached_result(filename, key, fp):
+	if not os.path.exists(os.path.abspath(filename) + CACHE_SUFFIX):
+		return None
+	cache = open_cache(filename)
+	try:
+		row = cache.execute('SELECT result FROM results WHERE key = ? AND fingerprint = ?', (key, fp)).fetchone()
+	finally:
+		cache.close()
+	return pickle.loads(str(row[0])) if row else None
+
+def store_result(filename, key, fp, df):
+	cache = open_cache(filename)
+	try:
+		# results of any other fingerprint belong to an older state of the database
+		cache.execute('DELETE FROM results WHERE fingerprint != ?', (fp,))
+		cache.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+			(key, fp, sqlite3.Binary(pickle.dumps(df, pickle.HIGHEST_PROTOCOL))))
+		cache.commit()
+	finally:
+		cache.close()
+
+def select(filename, QUERY, params=None, cache=True):
+	# run QUERY on the database filename and return the result as a DataFrame,
+	# served from the cache when the database has not changed since it was last run
+	if not cache:
+		return pd.read_sql_query(QUERY, connection(filename), params=params)
+	fp = fingerprint(filename)
+	key = query_key(QUERY, params)
+	memory_key = (os.path.abspath(filename), fp, key)
+	df = RESULTS.get(memory_key)
+	if df is None:
+		df = cached_result(filename, key, fp)
+		if df is None:
+			df = pd.read_sql_query(QUERY, connection(filename), params=params)
+			store_result(filename, key, fp, df)
+		RESULTS.put(memory_key, df)
+	# a copy, so callers cannot change the cached result
+	return df.copy()
+
+def catalog(filename):
+	# the report queries that fit the database: QUERIES with the summary tables,
+	# otherwise TABLE_QUERIES, or TEXT_TABLE_QUERIES without a users table.
+	# Chosen again whenever the database changes (summary.py may have built the tables)
+	path = os.path.abspath(filename)
+	fp = fingerprint(filename)
+	pooled_fp, queries = CATALOGS.get(path, (None, None))
+	if pooled_fp != fp:
+		con = connection(filename)
+		tables = set(row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+		if has_summaries(tables):
+			queries = QUERIES
+		else:
+			queries = TABLE_QUERIES if has_users(con) else TEXT_TABLE_QUERIES
+		CATALOGS[path] = (fp, queries)
+	return queries
+
+def run(filename, name, cache=True):
+	# run the report query called name (see QUERIES) from the catalog that fits the database,
+	# its results are cached under the SQL of that catalog
+	return select(filename, catalog(filename)[name], cache=cache)
+
+def report(filename, names=None, cache=True):
+	# return {name: DataFrame} of the report queries, all of them by default
+	return dict((name, run(filename, name, cache)) for name in (names or sorted(QUERIES)))
+
+def clear_cache(filename=None):
+	# forget cached results, of one database or of all of them in memory
+	RESULTS.clear()
+	CATALOGS.clear()
+	if filename is not None and os.path.exists(os.path.abspath(filename) + CACHE_SUFFIX):
+		os.remove(os.path.abspath(filename) + CACHE_SUFFIX)
+
+# ================================================== #
+#     Spatial helpers (need the R*Tree tables        #
+#     built by load.build_spatial_index)             #
+# ================================================== #
+def check_without_summaries(filename, names=None):
+	# report from a copy of the database without the summary tables and return
+	# the names of the queries whose rows differ from report(filename)
+	expected = report(filename, names, cache=False)
+	fd, copy = tempfile.mkstemp(suffix='.db')
+	os.close(fd)
+	try:
+		shutil.copyfile(filename, copy)
+		con = sqlite3.connect(copy)
+		try:
+			for table in SUMMARY_TABLES:
+				con.execute('DROP TABLE IF EXISTS {}'.format(table))
+			con.commit()
+		finally:
+			con.close()
+		found = report(copy, names, cache=False)
+	finally:
+		pooled, _ = CONNECTIONS.pop(os.path.abspath(copy), (None, None))
+		if pooled is not None:
+			pooled.close()
+		CATALOGS.pop(os.path.abspath(copy), None)
+		os.remove(copy)
+	return [name for name in sorted(expected)
+			if expected[name].values.tolist() != found[name].values.tolist()]
+
+def distance(lat1, lon1, lat2, lon2):
+	# great circle (haversine) distance in meters
+	dlat = math.radians(lat2 - lat1)
+	dlon = math.radians(lon2 - lon1)
+	a = (math.sin(dlat / 2) ** 2 +
+		 math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2)
+	return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+def bbox_around(lat, lon, meters):
+	# (south, west, north, east) of a box containing every point within meters of (lat, lon)
+	dlat = meters / METERS_PER_DEGREE
+	dlon = meters / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+	return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+def nodes_in_bbox(con, south, west, north, east, key=None, value=None):
+	# return (id, lat, lon) of the nodes inside the box, optionally only those with a tag key and/or value
+	sql = """
+		SELECT nodes.id, nodes.lat, nodes.lon
+		FROM nodes_rtree JOIN nodes ON nodes.id = nodes_rtree.id
+		WHERE nodes_rtree.max_lat >= ? AND nodes_rtree.min_lat <= ?
+		AND nodes_rtree.max_lon >= ? AND nodes_rtree.min_lon <= ?
+		AND nodes.lat BETWEEN ? AND ? AND nodes.lon BETWEEN ? AND ?"""
+	params = [south, north, west, east, south, north, west, east]
+	if key is not None or value is not None:
+		sql += """
+		AND EXISTS (SELECT 1 FROM nodes_tags t WHERE t.id = nodes.id"""
+		if key is not None:
+			sql += " AND t.key = ?"
+			params.append(key)
+		if value is not None:
+			sql += " AND t.value = ?"
+			params.append(value)
+		sql += ")"
+	return con.execute(sql, params).fetchall()
+
+def ways_in_bbox(con, south, west, north, east):
+	# return (id, min_lat, max_lat, min_lon, max_lon) of the ways whose bounding box meets the box
+	return con.execute("""
+		SELECT id, min_lat, max_lat, min_lon, max_lon FROM ways_rtree
+		WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?""",
+		(south, north, west, east)).fetchall()
+
+def nodes_within(con, lat, lon, meters, key=None, value=None):
+	# return (distance, id, lat, lon) of the nodes within meters of (lat, lon), nearest first
+	found = []
+	for id_, node_lat, node_lon in nodes_in_bbox(con, *bbox_around(lat, lon, meters), key=key, value=value):
+		d = distance(lat, lon, node_lat, node_lon)
+		if d <= meters:
+			found.append((d, id_, node_lat, node_lon))
+	return sorted(found)
+
+def nearest_nodes(con, lat, lon, k=1, key=None, value=None, start=100., max_distance=50000.):
+	# return the k nearest (distance, id, lat, lon), searching circles of doubling radius
+	meters = start
+	while True:
+		found = nodes_within(con, lat, lon, meters, key, value)
+		if len(found) >= k or meters >= max_distance:
+			return found[:k]
+		meters = min(meters * 2, max_distance)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Print the report queries')
+	parser.add_argument('db', nargs='?', default=DB_PATH)
+	parser.add_argument('names', nargs='*', metavar='name',
+		help='queries to run, all by default: ' + ', '.join(sorted(QUERIES)))
+	parser.add_argument('--no-cache', action='store_true', help='run the queries even if cached results are current')
+	parser.add_argument('--check', action='store_true',
+		help='also report from a copy without the summary tables and check that the results are the same')
+	args = parser.parse_args()
+	unknown = [name for name in args.names if name not in QUERIES]
+	if unknown:
+		parser.error('unknown queries: {}'.format(', '.join(unknown)))
+
+	if args.check:
+		differ = check_without_summaries(args.db, args.names)
+		if differ:
+			raise SystemExit('reports without the summary tables differ: {}'.format(', '.join(differ)))
+		print 'reports without the summary tables are the same'
+
+	for name, df in sorted(report(args.db, args.names, cache=not args.no_cache).items()):
+		print '# {}'.format(name)
+		print df
+		print
+
+	# bike racks with a capacity of 0
+	df = run(args.db, 'bikerack_capacities', cache=not args.no_cache)
 	df = df.apply(pd.to_numeric)
 	print df[df.value == 0].size
 
-	print select('opensm-manhattan.db', QUERY__)
+	# bike racks within 200 m of Times Square, and the 5 nearest ones
+	# con = connection(args.db)
+	# print nodes_within(con, 40.7580, -73.9855, 200, key='amenity', value='bicycle_parking')
+	# print nearest_nodes(con, 40.7580, -73.9855, k=5, key='amenity', value='bicycle_parking')
@@ -2,53 +2,223 @@
 # -*- coding: utf-8 -*-
 '''
 Use the following code to take a systematic sample of elements from your original OSM region. Try changing the value of k so that your resulting SAMPLE_FILE ends up at different sizes. When starting out, try using a larger k, then move on to an intermediate k before processing your whole dataset.
+
+Other sampling modes (see write_sample):
+- reservoir: a uniform random sample of a fixed number of elements
+- bbox: a grid over a bounding box, with up to a fixed number of nodes and of ways per cell,
+  so sparse areas are represented as well as dense ones
+- closed: every k-th way and relation plus every node they reference, so the sample has
+  no dangling references
+
+The elements are copied byte for byte from the original file, which is much
+faster than serializing them again. The original file may be compressed.
 '''
 
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+import argparse
+import array
+import bisect
+import random
+import xml.etree.cElementTree as ET
 import pprint
 
+import index
+from compress import codec_of, open_input, read_all
+from idset import IdSet
+from stream import iter_elements, iter_expat, TOP_LEVEL_TAGS
+
 OSM_FILE = "manhattan_new-york.osm"  # Replace this with your osm file
 SAMPLE_FILE = "sample.osm"
 
 k = 100 # Parameter: take every k-th top level element
+SIZE = 10000  # elements in a reservoir sample
+GRID = 10  # bbox sample: cells per side
+PER_CELL = 100  # bbox sample: nodes and ways kept per cell
+BUFFER_SIZE = 1 << 20
+
+MODES = ('systematic', 'reservoir', 'bbox', 'closed')
 
-def get_specific_element(osm_file, id, tags=('node', 'way', 'relation')):
-    # return element with a specific id and which has the right kind of tag
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            if elem.attrib['id'] == id:
-                return elem
-                root.clear()
+def get_specific_element(osm_file, id, tags=TOP_LEVEL_TAGS):
+    # return element with a specific id and which has the right kind of tag,
+    # looked up in the on-disk index of index.py (built on first use)
+    return index.get_specific_element(osm_file, id, tags)
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag
+def get_element(osm_file, tags=TOP_LEVEL_TAGS):
+    """Yield element if it is the right type of tag (see stream.py)
 
     Reference:
     http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    # cElementTree elements, which can be serialized with ET.tostring
+    return iter_elements(osm_file, tags, backend='etree')
+
+
+def get_spans(osm_file):
+    """Yield (element, offset, length) of each top level element, see stream.iter_expat"""
+    return iter_expat(osm_file, spans=True)
+
+
+class Reservoir(object):
+    """Uniform random sample of up to size items from a stream (algorithm R)"""
+
+    def __init__(self, size, rnd):
+        self.size = size
+        self.rnd = rnd
+        self.seen = 0
+        self.items = []
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            i = self.rnd.randrange(self.seen)
+            if i < self.size:
+                self.items[i] = item
+
+
+def systematic_spans(osm_file, k=k):
+    # every kth top level element
+    for i, (element, offset, length) in enumerate(get_spans(osm_file)):
+        if i % k == 0:
+            yield offset, length
+
+def reservoir_spans(osm_file, size=SIZE, seed=None):
+    reservoir = Reservoir(size, random.Random(seed))
+    for element, offset, length in get_spans(osm_file):
+        reservoir.add((offset, length))
+    # back in file order: nodes, then ways, then relations
+    return sorted(reservoir.items)
+
+def bbox_spans(osm_file, bbox, grid=GRID, per_cell=PER_CELL, seed=None):
+    """Stratified sample: up to per_cell nodes and per_cell ways in each cell of a grid x grid bbox
+
+    A way belongs to the cell of its first node inside the bbox. Relations are not sampled.
+    """
+    south, west, north, east = bbox
+    rnd = random.Random(seed)
+    strata = {}
+    # cell of every node in the bbox, as two arrays since ids come sorted in osm files
+    node_ids = array.array('l')
+    node_cells = array.array('i')
+
+    def add(key, span):
+        if key not in strata:
+            strata[key] = Reservoir(per_cell, rnd)
+        strata[key].add(span)
 
+    def cell_of(node_id):
+        i = bisect.bisect_left(node_ids, node_id)
+        if i < len(node_ids) and node_ids[i] == node_id:
+            return node_cells[i]
+        return None
 
-def write_sample(samplefile):
-    with open(samplefile, 'wb') as output:
-        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        output.write('<osm>\n  ')
+    for element, offset, length in get_spans(osm_file):
+        attrib = element.attrib
+        if element.tag == 'node':
+            lat, lon = float(attrib['lat']), float(attrib['lon'])
+            if not (south <= lat < north and west <= lon < east):
+                continue
+            cell = int((lat - south) / (north - south) * grid) * grid + int((lon - west) / (east - west) * grid)
+            node_id = int(attrib['id'])
+            if node_ids and node_id <= node_ids[-1]:
+                raise ValueError('bbox sampling needs nodes sorted by id, node {} is out of order'.format(node_id))
+            node_ids.append(node_id)
+            node_cells.append(cell)
+            add(('node', cell), (offset, length))
+        elif element.tag == 'way':
+            for nd in element.iter('nd'):
+                cell = cell_of(int(nd.attrib['ref']))
+                if cell is not None:
+                    add(('way', cell), (offset, length))
+                    break
 
-        # Write every kth top level element
-        for i, element in enumerate(get_element(OSM_FILE)):
-            if i % k == 0:
-                output.write(ET.tostring(element, encoding='utf-8'))
+    return sorted(span for reservoir in strata.values() for span in reservoir.items)
+
+def closed_spans(osm_file, k=k):
+    """Every kth way, and every kth relation whose members are all in the sample, plus every node they use
+
+    Two passes: the first picks the ways and relations and marks the ids to keep,
+    the second copies them.
+    """
+    nodes, ways, relations = IdSet(), IdSet(), IdSet()
+    kept = {'node': nodes, 'way': ways, 'relation': relations}
+    counts = {'node': 0, 'way': 0, 'relation': 0}
 
-        output.write('</osm>')
+    for element in iter_elements(osm_file, ('way', 'relation'), backend='expat'):
+        i = counts[element.tag]
+        counts[element.tag] += 1
+        if i % k:
+            continue
+        if element.tag == 'way':
+            ways.add(element.attrib['id'])
+            nodes.update(nd.attrib['ref'] for nd in element.iter('nd'))
+        elif all(member.attrib['ref'] in kept[member.attrib['type']]
+                 for member in element.iter('member')):
+            relations.add(element.attrib['id'])
+
+    for element, offset, length in get_spans(osm_file):
+        if element.attrib['id'] in kept[element.tag]:
+            yield offset, length
+
+
+def copy_spans(osm_file, spans, samplefile, buffer_size=BUFFER_SIZE):
+    """Write the byte ranges spans of osm_file as a new osm document, return the number of elements"""
+    n = 0
+    source = open_input(osm_file)
+    try:
+        with open(samplefile, 'wb', buffer_size) as output:
+            output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            output.write('<osm>\n  ')
+            position = 0
+            for offset, length in spans:
+                # spans come in file order, so a compressed source is only read forward
+                if offset != position:
+                    if codec_of(osm_file):
+                        read_all(source, offset - position)
+                    else:
+                        source.seek(offset)
+                output.write(source.read(length))
+                position = offset + length
+                n += 1
+            output.write('</osm>')
+    finally:
+        source.close()
+    return n
+
+
+def write_sample(samplefile, osm_file=None, mode='systematic', k=k, size=SIZE, bbox=None,
+                 grid=GRID, per_cell=PER_CELL, seed=None):
+    """Write a sample of osm_file (OSM_FILE by default) to samplefile, return the number of elements"""
+    osm_file = osm_file or OSM_FILE
+    if mode == 'systematic':
+        spans = systematic_spans(osm_file, k)
+    elif mode == 'reservoir':
+        spans = reservoir_spans(osm_file, size, seed)
+    elif mode == 'bbox':
+        if bbox is None:
+            raise ValueError('bbox sampling needs a bbox (south, west, north, east)')
+        spans = bbox_spans(osm_file, bbox, grid, per_cell, seed)
+    elif mode == 'closed':
+        spans = closed_spans(osm_file, k)
+    else:
+        raise ValueError('unknown sampling mode {!r}, use one of {}'.format(mode, ', '.join(MODES)))
+    return copy_spans(osm_file, spans, samplefile)
 
 if __name__ == "__main__":
-    write_sample(SAMPLE_FILE)
+    parser = argparse.ArgumentParser(description='Write a sample of an OSM XML file')
+    parser.add_argument('osm_file', nargs='?', default=OSM_FILE)
+    parser.add_argument('sample_file', nargs='?', default=SAMPLE_FILE)
+    parser.add_argument('--mode', choices=MODES, default='systematic')
+    parser.add_argument('-k', type=int, default=k, help='systematic and closed: keep every kth element')
+    parser.add_argument('--size', type=int, default=SIZE, help='reservoir: number of elements')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'))
+    parser.add_argument('--grid', type=int, default=GRID, help='bbox: cells per side')
+    parser.add_argument('--per-cell', type=int, default=PER_CELL, help='bbox: nodes and ways per cell')
+    parser.add_argument('--seed', type=int, help='random seed of the reservoir and bbox samples')
+    args = parser.parse_args()
+
+    n = write_sample(args.sample_file, args.osm_file, args.mode, k=args.k, size=args.size, bbox=args.bbox,
+                     grid=args.grid, per_cell=args.per_cell, seed=args.seed)
+    print '{} elements written to {}'.format(n, args.sample_file)
 
     # print ET.tostring(get_specific_element(OSM_FILE, '265347583'), encoding = 'utf-8')
@@ -11,7 +11,7 @@ schema = {
             'lon': {'required': True, 'type': 'float', 'coerce': float},
             'user': {'required': True, 'type': 'string'},
             'uid': {'required': True, 'type': 'integer', 'coerce': int},
-            'version': {'required': True, 'type': 'string'},
+            'version': {'required': True, 'type': 'integer', 'coerce': int},
             'changeset': {'required': True, 'type': 'integer', 'coerce': int},
             'timestamp': {'required': True, 'type': 'string'}
         }
@@ -34,7 +34,7 @@ schema = {
             'id': {'required': True, 'type': 'integer', 'coerce': int},
             'user': {'required': True, 'type': 'string'},
             'uid': {'required': True, 'type': 'integer', 'coerce': int},
-            'version': {'required': True, 'type': 'string'},
+            'version': {'required': True, 'type': 'integer', 'coerce': int},
             'changeset': {'required': True, 'type': 'integer', 'coerce': int},
             'timestamp': {'required': True, 'type': 'string'}
         }
@@ -61,5 +61,41 @@ schema = {
                 'type': {'required': True, 'type': 'string'}
             }
         }
+    },
+    'relation': {
+        'type': 'dict',
+        'schema': {
+            'id': {'required': True, 'type': 'integer', 'coerce': int},
+            'user': {'required': True, 'type': 'string'},
+            'uid': {'required': True, 'type': 'integer', 'coerce': int},
+            'version': {'required': True, 'type': 'integer', 'coerce': int},
+            'changeset': {'required': True, 'type': 'integer', 'coerce': int},
+            'timestamp': {'required': True, 'type': 'string'}
+        }
+    },
+    'relation_members': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'required': True, 'type': 'integer', 'coerce': int},
+                'type': {'required': True, 'type': 'string'},
+                'ref': {'required': True, 'type': 'integer', 'coerce': int},
+                'role': {'required': True, 'type': 'string'},
+                'position': {'required': True, 'type': 'integer', 'coerce': int}
+            }
+        }
+    },
+    'relation_tags': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'required': True, 'type': 'integer', 'coerce': int},
+                'key': {'required': True, 'type': 'string'},
+                'value': {'required': True, 'type': 'string'},
+                'type': {'required': True, 'type': 'string'}
+            }
+        }
     }
 }
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stream the top level elements (nodes, ways, relations) of an OSM XML file.
+
+Every script used to build its own iterparse loop. They all go through
+iter_elements now, which can use one of three parsers:
+
+- 'etree': xml.etree.cElementTree.iterparse. Yields Elements.
+- 'lxml': lxml.etree.iterparse with tag= filtering, so no events are
+  generated for the <tag>, <nd> and <member> children. Yields Elements.
+  Requires lxml.
+- 'expat': a bare expat handler that builds no tree at all and yields
+  LightElement tuples, which have the tag, attrib and iter() that
+  data.shape_element and audit.py use, but cannot be serialized. Its
+  Python callbacks make it slower than cElementTree on CPython 2.
+
+lxml is used when it is installed, cElementTree otherwise.
+
+Paths ending in .bz2, .gz or .zst are decompressed on the fly (see compress.py).
+Paths ending in .pbf are read with pbf.py, whatever the backend.
+
+Each yielded element is only valid until the next one is requested: the
+element, and any skipped siblings before it, are cleared so memory stays
+flat however large the file is.
+
+A relation can have hundreds of thousands of members. With 'member' in tags
+(next to 'relation'), every <member> is yielded on its own as soon as it is
+parsed, as a LightElement whose attrib has the relation id and the position
+of the member besides type, ref and role, and is then dropped from its
+relation. The relation itself follows with its tags only, so memory stays
+flat on large relations too. PBF relations keep their members.
+
+Running this file compares the backends on one or more osm files.
+"""
+
+import argparse
+import os
+import time
+import xml.etree.cElementTree as ET
+import xml.parsers.expat
+from collections import namedtuple
+
+from compress import codec_of, open_input
+
+try:
+    import lxml.etree as LET
+except ImportError:
+    LET = None
+
+OSM_PATH = "manhattan_new-york.osm"
+SAMPLE_PATH = "sample.osm"
+
+TOP_LEVEL_TAGS = ('node', 'way', 'relation')
+# lxml parses about twice as fast as cElementTree, see the benchmark below
+BACKEND = 'lxml' if LET is not None else 'etree'
+BLOCK_SIZE = 1 << 16  # bytes fed to expat at a time
+
+
+def iter_etree(osm_file, tags=TOP_LEVEL_TAGS):
+    # the start events are only needed to get hold of the root, which is
+    # cleared after every top level element to drop it and its earlier siblings
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    members = streams_members(tags)
+    relation, position = None, 0
+    for event, elem in context:
+        if event == 'end':
+            if elem.tag in TOP_LEVEL_TAGS:
+                if elem.tag in tags:
+                    yield elem
+                root.clear()
+            elif members and elem.tag == 'member' and relation is not None:
+                yield member_element(elem.attrib, relation.get('id'), position)
+                position += 1
+                relation.remove(elem)
+        elif members and elem.tag == 'relation':
+            relation, position = elem, 0
+
+
+def iter_lxml(osm_file, tags=TOP_LEVEL_TAGS):
+    if LET is None:
+        raise ImportError('lxml is required for the lxml backend')
+    members = streams_members(tags)
+    position = 0  # of the next member of the current relation
+    # ask for every top level tag, not only tags, so skipped elements are cleared as well
+    for _, elem in LET.iterparse(osm_file, events=('end',),
+                                 tag=TOP_LEVEL_TAGS + ('member',) if members else TOP_LEVEL_TAGS):
+        if elem.tag == 'member':
+            relation = elem.getparent()
+            yield member_element(elem.attrib, relation.get('id'), position)
+            position += 1
+            relation.remove(elem)
+            continue
+        position = 0
+        if elem.tag in tags:
+            yield elem
+        elem.clear()
+        # the cleared elements are still children of the root, drop them too
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+class LightElement(namedtuple('LightElement', ['tag', 'attrib', 'children'])):
+    """A parsed element without a tree: tag, attribute dict and a tuple of child elements"""
+
+    __slots__ = ()
+
+    def iter(self, tag=None):
+        # a list rather than a generator: top level elements only have leaf children,
+        # so this is a single flat pass and the children are usually all consumed
+        elems = [self] if tag is None or self[0] == tag else []
+        for child in self[2]:
+            if child[2]:
+                elems.extend(child.iter(tag))
+            elif tag is None or child[0] == tag:
+                elems.append(child)
+        return elems
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+
+def streams_members(tags):
+    return 'member' in tags and 'relation' in tags
+
+
+def member_element(attrib, relation_id, position):
+    """LightElement of a <member> yielded apart from its relation"""
+    # items() first: dict() of an lxml attribute proxy goes through its keys one by one
+    attrib = dict(attrib.items())
+    attrib['id'] = relation_id
+    attrib['position'] = position
+    return tuple.__new__(LightElement, ('member', attrib, ()))
+
+
+def iter_expat(osm_file, tags=TOP_LEVEL_TAGS, spans=False):
+    """Yield LightElements, or (element, offset, length) tuples when spans is True
+
+    offset and length give the bytes of the element in the file. An element extends
+    to the start of the next child of the root (or the </osm> end tag), so its
+    trailing whitespace is included.
+    """
+    if isinstance(osm_file, basestring):
+        f = open_input(osm_file)
+        try:
+            for elem in iter_expat(f, tags, spans):
+                yield elem
+        finally:
+            f.close()
+        return
+
+    parsed = []
+    # (attrib, children) of each open element, starting with the <osm> root
+    stack = []
+    members = streams_members(tags) and not spans
+    # tag of the open top level element, position of its next member
+    current = [None, 0]
+    # [element or None, offset] of the last top level element, until the next one starts
+    open_span = []
+
+    def start(tag, attrib):
+        if len(stack) == 1:
+            current[:] = [tag, 0]
+            if spans:
+                close_span(parser.CurrentByteIndex)
+                open_span[:] = [None, parser.CurrentByteIndex]
+        stack.append((attrib, []))
+
+    def close_span(end_offset):
+        if open_span and open_span[0] is not None:
+            elem, offset = open_span
+            parsed.append((elem, offset, end_offset - offset))
+        del open_span[:]
+
+    # skips the argument handling of the namedtuple constructor, called once per xml element
+    make = tuple.__new__
+
+    def end(tag):
+        attrib, children = stack.pop()
+        if len(stack) > 1:
+            if members and tag == 'member' and len(stack) == 2 and current[0] == 'relation':
+                parsed.append(member_element(attrib, stack[1][0]['id'], current[1]))
+                current[1] += 1
+                return
+            # a child of a top level element, kept until its parent ends
+            stack[-1][1].append(make(LightElement, (tag, attrib, tuple(children))))
+        elif len(stack) == 1 and tag in tags:
+            elem = make(LightElement, (tag, attrib, tuple(children)))
+            if spans:
+                open_span[0] = elem
+            else:
+                parsed.append(elem)
+        elif not stack and spans:
+            close_span(parser.CurrentByteIndex)
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+
+    while True:
+        block = osm_file.read(BLOCK_SIZE)
+        parser.Parse(block, not block)
+        for elem in parsed:
+            yield elem
+        del parsed[:]
+        if not block:
+            break
+
+
+BACKENDS = {
+    'etree': iter_etree,
+    'lxml': iter_lxml,
+    'expat': iter_expat,
+}
+
+
+def iter_elements(osm_file, tags=TOP_LEVEL_TAGS, backend=BACKEND):
+    """Yield the top level elements of osm_file (a path or file object) whose tag is in tags"""
+    if isinstance(osm_file, basestring) and osm_file.endswith('.pbf'):
+        # imported here since pbf.py builds on this module
+        import pbf
+        return pbf.iter_pbf(osm_file, tags)
+    if isinstance(osm_file, basestring) and codec_of(osm_file):
+        return iter_compressed(osm_file, tags, backend)
+    return BACKENDS[backend](osm_file, tags)
+
+
+def iter_compressed(path, tags=TOP_LEVEL_TAGS, backend=BACKEND):
+    f = open_input(path)
+    try:
+        for elem in BACKENDS[backend](f, tags):
+            yield elem
+    finally:
+        f.close()
+
+
+def time_backend(args):
+    """Parse (and shape) osm_file with one backend, return (elements, seconds, peak RSS in MB)"""
+    import resource
+    from data import shape_rows
+
+    osm_file, backend, shape = args
+    start = time.time()
+    n = 0
+    for elem in iter_elements(osm_file, backend=backend):
+        if shape:
+            shape_rows(elem)
+        n += 1
+    seconds = time.time() - start
+    return n, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+if __name__ == '__main__':
+    import multiprocessing
+
+    parser = argparse.ArgumentParser(description='Compare the parser backends on osm files')
+    parser.add_argument('osm_files', nargs='*', default=[SAMPLE_PATH, OSM_PATH])
+    parser.add_argument('--backends', nargs='+', default=sorted(BACKENDS), choices=sorted(BACKENDS))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print '{:<28}{:<7}{:<7}{:>10}{:>10}{:>14}{:>10}'.format(
+        'file', 'stage', 'parser', 'elements', 'seconds', 'elements/s', 'RSS MB')
+    for osm_file in args.osm_files:
+        if not os.path.exists(osm_file):
+            print '{}: not found, skipped'.format(osm_file)
+            continue
+        for shape in (False, True):
+            for backend in args.backends:
+                if backend == 'lxml' and LET is None:
+                    continue
+                # a fresh process per run, so peak RSS belongs to that backend alone
+                runs = []
+                for _ in range(args.repeat):
+                    pool = multiprocessing.Pool(1)
+                    runs.append(pool.apply(time_backend, [(osm_file, backend, shape)]))
+                    pool.close()
+                    pool.join()
+                n, seconds, rss = min(runs, key=lambda run: run[1])
+                print '{:<28}{:<7}{:<7}{:>10}{:>10.2f}{:>14,.0f}{:>10.1f}'.format(
+                    os.path.basename(osm_file), 'shape' if shape else 'parse', backend,
+                    n, seconds, n / seconds, rss)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Materialize the aggregates behind the report queries after a load.
+
+The report queries of query.py count tags and contributions over the whole
+of nodes, ways, nodes_tags and ways_tags. This stage counts them once into
+three small tables, which the queries in query.QUERIES read instead:
+
+- tag_counts: number of node and way tags per (source, key, value)
+- user_counts: number of nodes and ways per (user, uid)
+- postcode_boroughs: borough of every postcode value, with its number of tags
+
+load.py builds them after the indexes, and osc.py rebuilds them after
+applying a change file, so they always match the base tables. The original
+queries over the base tables are kept in query.TABLE_QUERIES.
+
+Running this file (re)builds the tables of a database and checks every
+catalog query: the EXPLAIN QUERY PLAN must not scan a base table, and the
+result must equal the base table query, which is timed against it.
+"""
+
+import argparse
+import sqlite3
+import time
+
+# tables of typed_schema.sql (or data_wrangling_schema.sql), which the catalog queries should only search
+BASE_TABLES = ('users', 'nodes', 'nodes_tags', 'ways', 'ways_tags', 'ways_nodes',
+               'relations', 'relation_members', 'relations_tags')
+
+# same grouping as query.QUERY0
+BOROUGH_SQL = """CASE
+        WHEN (value BETWEEN 10000 AND 10299)
+            THEN 'manhattan'
+        WHEN (value LIKE '112%')
+            THEN 'brooklyn'
+        WHEN (value LIKE '104%' OR value = '11370')
+            THEN 'bronx'
+        WHEN (value LIKE '07%')
+            THEN 'nj'
+        WHEN (value LIKE '111%'
+            OR     (value LIKE '113%' AND value != '11370')
+            OR     value LIKE '114%'
+            OR     value LIKE '116%'
+            OR     value between '11004' AND '11005')
+            THEN 'queens'
+        END"""
+
+USER_COUNTS_SQL = """INSERT INTO user_counts
+       SELECT users.user, uid, sum(node), sum(way)
+       FROM (SELECT uid, 1 AS node, 0 AS way FROM nodes UNION ALL
+             SELECT uid, 0, 1 FROM ways)
+       LEFT JOIN users USING (uid)
+       GROUP BY uid"""
+
+# databases imported from the csv files of data.py have the user names on every row
+TEXT_USER_COUNTS_SQL = """INSERT INTO user_counts
+       SELECT user, uid, sum(node), sum(way)
+       FROM (SELECT user, uid, 1 AS node, 0 AS way FROM nodes UNION ALL
+             SELECT user, uid, 0, 1 FROM ways)
+       GROUP BY user, uid"""
+
+SUMMARY_SQL = [
+    'DROP TABLE IF EXISTS tag_counts',
+    'CREATE TABLE tag_counts (source TEXT NOT NULL, key TEXT, value TEXT, num INTEGER NOT NULL)',
+    """INSERT INTO tag_counts
+       SELECT 'node', key, value, count(*) FROM nodes_tags GROUP BY key, value""",
+    """INSERT INTO tag_counts
+       SELECT 'way', key, value, count(*) FROM ways_tags GROUP BY key, value""",
+    'CREATE INDEX tag_counts_key ON tag_counts (key, source, value, num)',
+
+    'DROP TABLE IF EXISTS user_counts',
+    'CREATE TABLE user_counts (user TEXT, uid INTEGER, nodes INTEGER NOT NULL, ways INTEGER NOT NULL)',
+    USER_COUNTS_SQL,
+
+    'DROP TABLE IF EXISTS postcode_boroughs',
+    'CREATE TABLE postcode_boroughs (postcode TEXT, borough TEXT, num INTEGER NOT NULL)',
+    """INSERT INTO postcode_boroughs
+       SELECT value, {}, sum(num) FROM tag_counts
+       WHERE key = 'postcode' AND value IS NOT NULL
+       GROUP BY value""".format(BOROUGH_SQL),
+]
+
+SUMMARY_TABLES = ('tag_counts', 'user_counts', 'postcode_boroughs')
+
+
+def has_users(con):
+    """Whether the database has the users table of typed_schema.sql, or user names on every row"""
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone() is not None
+
+
+def build_summaries(con):
+    """(Re)build the summary tables from the base tables, without committing"""
+    typed = has_users(con)
+    for sql in SUMMARY_SQL:
+        if sql is USER_COUNTS_SQL and not typed:
+            sql = TEXT_USER_COUNTS_SQL
+        con.execute(sql)
+    # so the planner knows how small they are
+    for table in SUMMARY_TABLES:
+        con.execute('ANALYZE {}'.format(table))
+
+
+def has_summaries(tables):
+    return all(table in tables for table in SUMMARY_TABLES)
+
+
+def query_plan(con, sql):
+    return [row[3] for row in con.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+
+def base_scans(plan):
+    """Return the steps of a query plan that scan a whole base table or one of its indexes"""
+    return [step for step in plan
+            if step.startswith('SCAN ') and step.split()[1] in BASE_TABLES]
+
+
+def best_time(con, sql, repeat=3):
+    seconds = []
+    for _ in range(repeat):
+        start = time.time()
+        con.execute(sql).fetchall()
+        seconds.append(time.time() - start)
+    return min(seconds)
+
+
+if __name__ == '__main__':
+    import query
+    from load import DB_PATH
+
+    parser = argparse.ArgumentParser(description='Build the summary tables and check the report query plans')
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--no-build', dest='build', action='store_false',
+                        help='check the existing tables without rebuilding them')
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.db)
+    try:
+        if args.build:
+            start = time.time()
+            build_summaries(con)
+            con.commit()
+            print 'summary tables built in {:.2f} s'.format(time.time() - start)
+
+        print '{:<26}{:>12}{:>12}{:>8}{:>8}  {}'.format('query', 'tables ms', 'catalog ms', 'speedup', 'same', 'base table scans')
+        failed = False
+        table_queries = query.TABLE_QUERIES if has_users(con) else query.TEXT_TABLE_QUERIES
+        for name in sorted(query.QUERIES):
+            sql, table_sql = query.QUERIES[name], table_queries[name]
+            scans = base_scans(query_plan(con, sql))
+            same = con.execute(sql).fetchall() == con.execute(table_sql).fetchall()
+            table_ms, catalog_ms = 1000 * best_time(con, table_sql), 1000 * best_time(con, sql)
+            failed |= bool(scans) or not same
+            print '{:<26}{:>12.2f}{:>12.2f}{:>7.0f}x{:>8}  {}'.format(
+                name, table_ms, catalog_ms, table_ms / max(catalog_ms, 1e-3), 'yes' if same else 'NO',
+                '; '.join(scans) or 'none')
+    finally:
+        con.close()
+    if failed:
+        raise SystemExit('some catalog queries scan a base table or differ from the base table queries')
@@ -0,0 +1,82 @@
+-- Typed, compact version of data_wrangling_schema.sql, created by load.py.
+-- Ids, uids, versions and changesets are integers, timestamps are seconds
+-- since the epoch and coordinates are fixed point integers in 1e-7 degrees,
+-- as in OSM itself. lat and lon are computed from them when read, so they
+-- take no space. User names are stored once, in users.
+
+CREATE TABLE users (
+    uid INTEGER PRIMARY KEY NOT NULL,
+    user TEXT NOT NULL
+);
+
+CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat_e7 INTEGER,
+    lon_e7 INTEGER,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp INTEGER,
+    lat REAL GENERATED ALWAYS AS (lat_e7 / 1e7) VIRTUAL,
+    lon REAL GENERATED ALWAYS AS (lon_e7 / 1e7) VIRTUAL,
+    FOREIGN KEY (uid) REFERENCES users(uid)
+);
+
+CREATE TABLE nodes_tags (
+    id INTEGER,
+    key TEXT,
+    value TEXT,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES nodes(id)
+);
+
+CREATE TABLE ways (
+    id INTEGER PRIMARY KEY NOT NULL,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp INTEGER,
+    FOREIGN KEY (uid) REFERENCES users(uid)
+);
+
+CREATE TABLE ways_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES ways(id)
+);
+
+CREATE TABLE ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways(id),
+    FOREIGN KEY (node_id) REFERENCES nodes(id)
+);
+
+CREATE TABLE relations (
+    id INTEGER PRIMARY KEY NOT NULL,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp INTEGER,
+    FOREIGN KEY (uid) REFERENCES users(uid)
+);
+
+CREATE TABLE relation_members (
+    id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    ref INTEGER NOT NULL,
+    role TEXT,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES relations(id)
+);
+
+CREATE TABLE relations_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES relations(id)
+);
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fast validation of shaped elements against schema.py.
+
+data.validate_element runs a cerberus Validator over the nested schema for
+every element, which handles about a hundred elements per second (see
+bench.py), far too slow for a full run. Here the schema is
+compiled once into flat per-field checks (required, null, coerce, type) that
+follow the same rules cerberus applies, so the whole extract can be validated
+and not only a sample. Failures are collected for the first max_errors
+elements together with their ids instead of stopping at the first one.
+
+cerberus stays the reference implementation: running this file compares
+both validators on the elements of an osm file and on corrupted copies of
+them, and prints any element they disagree on.
+"""
+
+import copy
+import pprint
+import sys
+import time
+
+import schema
+
+SCHEMA = schema.schema
+MAX_ERRORS = 20
+
+# python types accepted for each cerberus type name
+TYPES = {
+    'integer': (int, long),
+    'float': (float,),
+    'string': (basestring,),
+    'dict': (dict,),
+    'list': (list,),
+}
+
+
+class ValidationError(Exception):
+    pass
+
+
+def compile_rules(rules):
+    """Return a function that checks one value against its cerberus rules
+
+    The function returns a list of (path, message) tuples, empty if the value is valid.
+    """
+    type_name = rules['type']
+    types = TYPES[type_name]
+    coerce = rules.get('coerce')
+
+    if type_name == 'dict' and 'schema' in rules:
+        return compile_fields(rules['schema'])
+
+    if type_name == 'list' and 'schema' in rules:
+        check_item = compile_rules(rules['schema'])
+
+        def check_list(value):
+            if not isinstance(value, list):
+                return [((), 'must be of list type')]
+            errors = []
+            for i, item in enumerate(value):
+                errors.extend(((i,) + path, message) for path, message in check_item(item))
+            return errors
+        return check_list
+
+    def check_value(value):
+        if value is None:
+            return [((), 'null value not allowed')]
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except (TypeError, ValueError) as e:
+                return [((), 'cannot be coerced: {}'.format(e))]
+        if not isinstance(value, types):
+            return [((), 'must be of {} type'.format(type_name))]
+        return []
+    return check_value
+
+
+def compile_fields(fields):
+    """Return a function that checks a dict against a mapping of field name to rules"""
+    checks = [(name, rules.get('required', False), compile_rules(rules))
+              for name, rules in sorted(fields.items())]
+    known = frozenset(fields)
+
+    def check_dict(doc):
+        if not isinstance(doc, dict):
+            return [((), 'must be of dict type')]
+        errors = []
+        for name, required, check in checks:
+            if name not in doc:
+                if required:
+                    errors.append(((name,), 'required field'))
+                continue
+            for path, message in check(doc[name]):
+                errors.append(((name,) + path, message))
+        if not known.issuperset(doc):
+            errors.extend(((name,), 'unknown field') for name in doc if name not in known)
+        return errors
+    return check_dict
+
+
+class CompiledValidator(object):
+    """Validate shaped elements, keeping the errors of the first max_errors failures"""
+
+    def __init__(self, schema=SCHEMA, max_errors=MAX_ERRORS):
+        self.check = compile_fields(schema)
+        self.max_errors = max_errors
+        self.checked = 0
+        self.failed = 0
+        self.failures = []
+
+    def validate(self, element):
+        """Return True if element matches the schema, otherwise record its errors"""
+        self.checked += 1
+        errors = self.check(element)
+        if not errors:
+            return True
+        self.failed += 1
+        if len(self.failures) < self.max_errors:
+            self.failures.append((element_id(element), errors))
+        return False
+
+    def report(self):
+        lines = ['{} of {} elements do not match the schema, first {}:'.format(
+            self.failed, self.checked, len(self.failures))]
+        for (tag, id_), errors in self.failures:
+            lines.append("  {} {}".format(tag, id_))
+            for path, message in errors:
+                lines.append("      {}: {}".format('.'.join(str(p) for p in path), message))
+        return '\n'.join(lines)
+
+
+def element_id(element):
+    """Return (element type, id) of a shaped element"""
+    for tag in ('node', 'way', 'relation'):
+        if isinstance(element.get(tag), dict):
+            return tag, element[tag].get('id')
+    if element.get('relation_members'):
+        # a member shaped apart from its relation
+        return 'relation', element['relation_members'][0].get('id')
+    return None, None
+
+
+def corrupt(element):
+    """Yield copies of a shaped element that break the schema in different ways"""
+    tag, _ = element_id(element)
+    tags_field = tag + '_tags'
+
+    broken = copy.deepcopy(element)
+    del broken[tag]['id']
+    yield broken
+
+    broken = copy.deepcopy(element)
+    broken[tag]['uid'] = 'anonymous'
+    yield broken
+
+    broken = copy.deepcopy(element)
+    broken[tag]['visible'] = 'true'
+    yield broken
+
+    broken = copy.deepcopy(element)
+    broken[tag]['changeset'] = None
+    yield broken
+
+    broken = copy.deepcopy(element)
+    broken[tags_field] = {}
+    yield broken
+
+    if element[tags_field]:
+        broken = copy.deepcopy(element)
+        broken[tags_field][-1]['key'] = 5
+        yield broken
+
+    if tag == 'node':
+        broken = copy.deepcopy(element)
+        broken['node']['lat'] = '40.7N'
+        yield broken
+    elif tag == 'way':
+        broken = copy.deepcopy(element)
+        broken['way_nodes'].append({'id': broken['way']['id'], 'node_id': '', 'position': 0})
+        yield broken
+    else:
+        broken = copy.deepcopy(element)
+        broken['relation_members'].append({'id': broken['relation']['id'], 'type': 'way', 'ref': 'x'})
+        yield broken
+
+
+def compare(elements, schema=SCHEMA):
+    """Validate elements with cerberus and the compiled validator, return the ones they disagree on"""
+    import cerberus
+
+    reference = cerberus.Validator()
+    compiled = CompiledValidator(schema)
+    disagreements = []
+    for element in elements:
+        expected = reference.validate(element, schema)
+        if compiled.validate(element) != expected:
+            disagreements.append((element, expected, reference.errors))
+    return disagreements
+
+
+def time_validator(validate, elements):
+    start = time.time()
+    for element in elements:
+        validate(element)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    import cerberus
+    from data import get_element, shape_element
+
+    osm_file = sys.argv[1] if len(sys.argv) > 1 else 'sample.osm'
+    shaped = [shape_element(element) for element in get_element(osm_file)]
+    corpus = shaped + [broken for element in shaped for broken in corrupt(element)]
+
+    disagreements = compare(corpus)
+    print '{} elements checked, {} disagreements'.format(len(corpus), len(disagreements))
+    for element, expected, errors in disagreements[:5]:
+        print 'cerberus says {}:'.format(expected)
+        pprint.pprint(errors)
+        pprint.pprint(element)
+
+    reference = cerberus.Validator()
+    cerberus_time = time_validator(lambda el: reference.validate(el, SCHEMA), shaped)
+    compiled_time = time_validator(CompiledValidator(max_errors=0).validate, shaped)
+    print 'cerberus: {:.2f}s, compiled: {:.3f}s ({:.0f}X faster)'.format(
+        cerberus_time, compiled_time, cerberus_time / compiled_time)